@@ -0,0 +1,63 @@
+import difflib
+import re
+
+# Entries are separated by commas, semicolons or new lines
+ENTRY_SEPARATOR = re.compile(r'[,;\n]+')
+# "<name> <value>", the value being reps (50) or a duration (1:30, 0:01:30)
+ENTRY_PATTERN = re.compile(r'^(?P<name>.*?\S)\s+(?P<value>\d+(?::\d{1,2}){0,2})$')
+
+# Minimum difflib similarity for a fuzzy name match
+FUZZY_CUTOFF = 0.75
+
+
+def normalize_name(name):
+    # "Push-ups", "push ups" and "pushups" are the same activity
+    return re.sub(r'[\s\-_]+', '', name.lower())
+
+
+def parse_log_entries(text):
+    """
+    Split a quick log message such as "pushups 50, plank 1:30" into
+    (name, value) string pairs. Entries that don't look like "<name> <value>"
+    are returned with a value of None.
+    """
+    entries = []
+    for part in ENTRY_SEPARATOR.split(text):
+        part = part.strip()
+        if not part:
+            continue
+        match = ENTRY_PATTERN.match(part)
+        if match:
+            entries.append((match.group('name'), match.group('value')))
+        else:
+            entries.append((part, None))
+    return entries
+
+
+class ActivityNameIndex:
+    """
+    Resolves typed activity names to a user's reference activities: exact
+    match first (ignoring case, spaces and dashes), then a unique prefix
+    ("push" for "Push ups"), then the closest name by difflib similarity.
+    """
+
+    def __init__(self, reference_activities):
+        self._by_name = {}
+        for reference in reference_activities:
+            # Keep the first (oldest) reference for duplicate names
+            self._by_name.setdefault(normalize_name(reference[1]), reference)
+        self._names = sorted(self._by_name)
+
+    def match(self, name):
+        name = normalize_name(name)
+        if not name:
+            return None
+        if name in self._by_name:
+            return self._by_name[name]
+
+        prefixed = [known for known in self._names if known.startswith(name)]
+        if len(prefixed) == 1:
+            return self._by_name[prefixed[0]]
+
+        close = difflib.get_close_matches(name, prefixed or self._names, n=1, cutoff=FUZZY_CUTOFF)
+        return self._by_name[close[0]] if close else None
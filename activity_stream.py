@@ -0,0 +1,212 @@
+"""
+Write-behind ingestion of activities through a Redis stream.
+
+With ACTIVITY_WRITE_BEHIND enabled the bot appends validated activities to
+ACTIVITY_STREAM and replies straight away; the writer started with
+
+    python -m activity_stream
+
+reads them through a consumer group and inserts each batch with a single
+commit. Entries are acknowledged and removed from the stream only once
+committed, or once Postgres rejected them for good (e.g. their reference
+activity was purged). Entries that failed for any other reason, such as
+Postgres being down, and those of a writer that died mid-batch stay pending
+and are claimed again after CLAIM_IDLE_MS. Each row keeps its stream entry
+id, so an entry delivered twice is only inserted once.
+
+Every queued activity bumps a per-user pending counter that the writer
+decrements after commit. Reads that must see the user's own writes (/list,
+/stats, the /update and /delete menus) call wait_for_pending() first.
+"""
+import os
+import socket
+import time
+from datetime import datetime, timezone
+
+import psycopg2
+import redis
+
+from cache import user_cache
+from config import (ACTIVITY_STREAM_BATCH_SIZE, ACTIVITY_STREAM_BLOCK_MS, ACTIVITY_STREAM_READ_TIMEOUT,
+                    ACTIVITY_WRITE_BEHIND)
+from logger import log_error, log_info
+from redis_client import get_redis
+
+ACTIVITY_STREAM = 'activities:ingest'
+CONSUMER_GROUP = 'activity-writers'
+PENDING_KEY_PREFIX = 'activities:pending:'
+# Bounds how long a lost counter can make reads wait for writes that never land
+PENDING_TTL = 3600
+# Entries unacknowledged for this long are claimed again, from writers that
+# died or after failed inserts
+CLAIM_IDLE_MS = 60000
+# Insert errors that retrying won't fix
+PERMANENT_ERRORS = (psycopg2.IntegrityError, psycopg2.DataError)
+
+
+def _pending_key(user_id):
+    return f"{PENDING_KEY_PREFIX}{user_id}"
+
+
+def enqueue_activity(user_id, reference_activity_id, value):
+    """
+    Append an activity to the stream. Returns False when Redis is not
+    available, in which case the caller should insert it directly.
+    """
+    client = get_redis()
+    if client is None:
+        return False
+    try:
+        pipe = client.pipeline()
+        pipe.xadd(ACTIVITY_STREAM, {
+            'user_id': user_id,
+            'reference_activity_id': reference_activity_id,
+            'value': value,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+        })
+        pipe.incr(_pending_key(user_id))
+        pipe.expire(_pending_key(user_id), PENDING_TTL)
+        pipe.execute()
+        return True
+    except redis.RedisError as e:
+        log_error(f"Failed to queue activity for user {user_id}: {str(e)}")
+        return False
+
+
+def pending_count(user_id):
+    client = get_redis()
+    if client is None:
+        return 0
+    try:
+        return max(0, int(client.get(_pending_key(user_id)) or 0))
+    except redis.RedisError as e:
+        log_error(f"Failed to read pending activities for user {user_id}: {str(e)}")
+        return 0
+
+
+def wait_for_pending(user_id, timeout=ACTIVITY_STREAM_READ_TIMEOUT):
+    """
+    Block until the writer has committed the user's queued activities, or
+    timeout seconds have passed. Returns True if nothing is left pending.
+    """
+    if not ACTIVITY_WRITE_BEHIND or not pending_count(user_id):
+        return True
+    deadline = time.monotonic() + timeout
+    while pending_count(user_id):
+        if time.monotonic() >= deadline:
+            log_info(f"Timed out waiting for queued activities of user {user_id}")
+            return False
+        time.sleep(0.05)
+    # The writer's invalidation reaches this process over pub/sub, which may
+    # still be in flight
+    user_cache.invalidate_local(user_id)
+    return True
+
+
+def _decode(fields):
+    fields = {key.decode(): value.decode() for key, value in fields.items()}
+    return (int(fields['user_id']), int(fields['reference_activity_id']), int(fields['value']),
+            datetime.fromisoformat(fields['created_at']))
+
+
+def write_batch(db, client, entries):
+    """
+    Insert one batch of stream entries and acknowledge those that were
+    committed or can never be. Returns the number committed and the number
+    left queued.
+    """
+    done = []
+    rows = {}
+    for entry_id, fields in entries:
+        entry_id = entry_id.decode() if isinstance(entry_id, bytes) else entry_id
+        try:
+            rows[entry_id] = _decode(fields)
+        # Entries deleted while claimed come back with no fields
+        except (AttributeError, KeyError, ValueError) as e:
+            log_error(f"Dropping malformed activity stream entry {entry_id}: {str(e)}")
+            done.append((entry_id, None))
+
+    written = 0
+    try:
+        db.add_activities(list(rows.values()), stream_entry_ids=list(rows))
+        written = len(rows)
+        done += rows.items()
+    except PERMANENT_ERRORS as e:
+        # One bad row (e.g. its reference activity was purged meanwhile)
+        # must not hold back the rest of the batch
+        log_error(f"Batch insert of {len(rows)} activities failed, retrying one by one: {str(e)}")
+        for entry_id, row in rows.items():
+            try:
+                db.add_activities([row], stream_entry_ids=[entry_id])
+                written += 1
+            except PERMANENT_ERRORS as e:
+                log_error(f"Dropping activity {row} from the stream: {str(e)}")
+            except Exception as e:
+                log_error(f"Failed to insert activity {row}, leaving it queued: {str(e)}")
+                continue
+            done.append((entry_id, row))
+    except Exception as e:
+        log_error(f"Batch insert of {len(rows)} activities failed, leaving them queued: {str(e)}")
+
+    if done:
+        entry_ids = [entry_id for entry_id, _ in done]
+        pipe = client.pipeline()
+        pipe.xack(ACTIVITY_STREAM, CONSUMER_GROUP, *entry_ids)
+        pipe.xdel(ACTIVITY_STREAM, *entry_ids)
+        for _, row in done:
+            if row is not None:
+                pipe.decr(_pending_key(row[0]))
+        pipe.execute()
+    return written, len(entries) - len(done)
+
+
+def run_writer(db, consumer=None):
+    client = get_redis()
+    if client is None:
+        raise RuntimeError("REDIS_URL is not configured")
+    consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+    try:
+        client.xgroup_create(ACTIVITY_STREAM, CONSUMER_GROUP, id='0', mkstream=True)
+    except redis.ResponseError as e:
+        if 'BUSYGROUP' not in str(e):
+            raise
+    log_info(f"Activity writer {consumer} started")
+
+    # Entries delivered to this consumer name before a restart come first
+    stream_id = '0'
+    last_claim = 0
+    while True:
+        try:
+            if time.monotonic() - last_claim > CLAIM_IDLE_MS / 1000:
+                # Keep claiming while batches go through, e.g. after an outage
+                claim_from = '0-0'
+                while True:
+                    claim_from, claimed, *_ = client.xautoclaim(ACTIVITY_STREAM, CONSUMER_GROUP, consumer,
+                                                                CLAIM_IDLE_MS, start_id=claim_from,
+                                                                count=ACTIVITY_STREAM_BATCH_SIZE)
+                    if not claimed or write_batch(db, client, claimed)[1]:
+                        break
+                    if claim_from in (b'0-0', '0-0'):
+                        break
+                last_claim = time.monotonic()
+
+            response = client.xreadgroup(CONSUMER_GROUP, consumer, {ACTIVITY_STREAM: stream_id},
+                                         count=ACTIVITY_STREAM_BATCH_SIZE, block=ACTIVITY_STREAM_BLOCK_MS)
+            entries = response[0][1] if response else []
+            if not entries:
+                stream_id = '>'
+                continue
+            written, left = write_batch(db, client, entries)
+            log_info(f"Activity writer committed {written} activities")
+            if left:
+                # Postgres is failing. The entries stay pending and, while
+                # stream_id is '0', come straight back, so don't spin on them
+                time.sleep(1)
+        except redis.RedisError as e:
+            log_error(f"Activity writer Redis error: {str(e)}")
+            time.sleep(1)
+
+
+if __name__ == '__main__':
+    from database import db
+    run_writer(db)
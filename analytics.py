@@ -0,0 +1,167 @@
+"""
+Per-activity progression metrics for /stats and /trends.
+
+A user's history is loaded with one columnar query
+(Database.get_activity_history) into parallel NumPy arrays, and every
+metric is computed with array operations over all activities at once:
+totals, weekly volume, 7- and 30-day moving averages, personal records and
+the pace toward the challenge's active days (CHALLENGE_DAYS without one).
+"""
+import math
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pytz
+
+NICOSIA_TIMEZONE = pytz.timezone('Europe/Nicosia')
+EPOCH_DATE = date(1970, 1, 1)
+
+CHALLENGE_DAYS = 100
+# Weeks of volume shown by /trends
+TREND_WEEKS = 8
+# Days looked back for the moving averages and the pace
+PACE_WINDOW = 30
+
+
+class ActivityHistory:
+    """
+    A user's activities as parallel arrays, one entry per activity:
+    reference activity id, value, day (days since 1970-01-01) and time
+    (Unix seconds).
+    """
+
+    def __init__(self, reference_activities, reference_ids, values, days, timestamps):
+        self.references = {ref_id: (name, activity_type) for ref_id, name, activity_type in reference_activities}
+        self.reference_ids = np.asarray(reference_ids, dtype=np.int64)
+        self.values = np.asarray(values, dtype=np.int64)
+        self.days = np.asarray(days, dtype=np.int64)
+        self.timestamps = np.asarray(timestamps, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.values)
+
+
+def day_number(day):
+    return (day - EPOCH_DATE).days
+
+
+def moving_average(series, window):
+    """Trailing mean over `window` days along the last axis, days before the series count as 0."""
+    series = np.asarray(series, dtype=float)
+    padded = np.concatenate([np.zeros(series.shape[:-1] + (window,)), series], axis=-1)
+    sums = np.cumsum(padded, axis=-1)
+    return (sums[..., window:] - sums[..., :-window]) / window
+
+
+def current_streaks(daily_codes, daily_days, count, today):
+    """
+    Consecutive active days ending today or yesterday per activity, from
+    (activity, day) pairs sorted by activity and then day.
+    """
+    streaks = np.zeros(count, dtype=np.int64)
+    if not len(daily_days):
+        return streaks
+    index = np.arange(len(daily_days))
+    same_activity = daily_codes[1:] == daily_codes[:-1]
+    run_starts = np.ones(len(daily_days), dtype=bool)
+    run_starts[1:] = ~same_activity | (np.diff(daily_days) != 1)
+    run_lengths = index - np.maximum.accumulate(np.where(run_starts, index, 0)) + 1
+    last_days = np.ones(len(daily_days), dtype=bool)
+    last_days[:-1] = ~same_activity
+    alive = last_days & (daily_days >= day_number(today) - 1)
+    streaks[daily_codes[alive]] = run_lengths[alive]
+    return streaks
+
+
+def compute_trends(history, today=None, weeks=TREND_WEEKS, challenge_days=CHALLENGE_DAYS, start_date=None):
+    """
+    One dict of metrics per reference activity with entries, in reference
+    activity order. Days are compared by the day numbers stored in history.
+    challenge_days is the active days the user's challenge asks for, and
+    its start_date shortens the pace window while it is younger than that.
+    """
+    if not len(history):
+        return []
+    today = today or datetime.now(NICOSIA_TIMEZONE).date()
+
+    ref_ids, codes = np.unique(history.reference_ids, return_inverse=True)
+    count = len(ref_ids)
+    entries = np.bincount(codes, minlength=count)
+    totals = np.bincount(codes, weights=history.values, minlength=count)
+    best_entry = np.zeros(count, dtype=np.int64)
+    np.maximum.at(best_entry, codes, history.values)
+    last_timestamp = np.zeros(count, dtype=np.int64)
+    np.maximum.at(last_timestamp, codes, history.timestamps)
+
+    # Daily totals per activity, one element per (activity, day) with entries
+    first_day = history.days.min()
+    span = int(history.days.max() - first_day + 1)
+    keys, key_index = np.unique(codes * span + (history.days - first_day), return_inverse=True)
+    daily_totals = np.bincount(key_index, weights=history.values)
+    daily_codes = keys // span
+    daily_days = keys % span + first_day
+
+    days_active = np.bincount(daily_codes, minlength=count)
+    best_day = np.zeros(count)
+    np.maximum.at(best_day, daily_codes, daily_totals)
+
+    # The recent days as a dense (activities x days) matrix ending today
+    window = max(weeks * 7, PACE_WINDOW + 7)
+    recent = np.zeros((count, window))
+    offsets = daily_days - (day_number(today) - window + 1)
+    in_window = (offsets >= 0) & (offsets < window)
+    recent[daily_codes[in_window], offsets[in_window]] = daily_totals[in_window]
+
+    weekly = recent[:, -weeks * 7:].reshape(count, weeks, 7).sum(axis=2)
+    average_7 = moving_average(recent, 7)
+    average_30 = moving_average(recent, PACE_WINDOW)
+    active_recently = np.count_nonzero(recent[:, -PACE_WINDOW:], axis=1)
+
+    streaks = current_streaks(daily_codes, daily_days, count, today)
+    days_left = np.maximum(0, challenge_days - days_active)
+    # Active days per day over the pace window
+    pace_days = PACE_WINDOW
+    if start_date is not None:
+        pace_days = max(1, min(PACE_WINDOW, (today - start_date).days + 1))
+    pace = active_recently / pace_days
+
+    # Reference activity order, then any entries of references not passed in
+    position = {int(ref_id): i for i, ref_id in enumerate(ref_ids)}
+    ordered = [ref_id for ref_id in history.references if ref_id in position]
+    ordered += [ref_id for ref_id in position if ref_id not in history.references]
+
+    trends = []
+    for ref_id in ordered:
+        i = position[ref_id]
+        name, activity_type = history.references.get(ref_id, (str(ref_id), 'reps'))
+        finish = None
+        if days_left[i] == 0:
+            finish = today
+        elif pace[i] > 0:
+            finish = today + timedelta(days=math.ceil(days_left[i] / pace[i]))
+        trends.append({
+            'name': name,
+            'type': activity_type,
+            'entries': int(entries[i]),
+            'total': int(totals[i]),
+            'days_active': int(days_active[i]),
+            'days_left': int(days_left[i]),
+            'current_streak': int(streaks[i]),
+            'last_performed': datetime.fromtimestamp(int(last_timestamp[i]), NICOSIA_TIMEZONE),
+            'best_entry': int(best_entry[i]),
+            'best_day': int(best_day[i]),
+            'weekly': weekly[i].astype(int).tolist(),
+            'average_7': float(average_7[i, -1]),
+            'previous_average_7': float(average_7[i, -8]),
+            'average_30': float(average_30[i, -1]),
+            'active_days_per_week': float(pace[i] * 7),
+            'projected_finish': finish,
+        })
+    return trends
+
+
+def totals_by_type(trends):
+    """(total reps, total seconds) over all activities."""
+    total_reps = sum(trend['total'] for trend in trends if trend['type'] == 'reps')
+    total_duration = sum(trend['total'] for trend in trends if trend['type'] == 'time')
+    return total_reps, total_duration
@@ -0,0 +1,238 @@
+"""
+Broadcast throughput benchmark for the Celery encouragement pipeline.
+
+Seeds synthetic users into a *_bench Postgres database, starts a Celery
+worker against the configured Redis broker with TeleBot replaced by a stub,
+triggers send_encouragement and waits until every inactive user has been
+messaged:
+
+    POSTGRES_HOST=localhost POSTGRES_DB=hdays_bench ... REDIS_URL=redis://localhost:6379/0 \
+        python -m benchmarks.bench_broadcast --users 50000 --concurrency 8 --send-latency 0.05
+
+Reports time to reach all users, broker messages published, database queries
+per user and worker CPU time, to size the celery_worker_broadcast service.
+The worker consumes only the broadcast queue, like that service. The admin_id
+control flag is ignored by the worker so the fan-out covers every user.
+"""
+import argparse
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+
+from benchmarks import synthetic_data
+
+KEY_PREFIX = 'bench:broadcast:'
+
+
+class StubMessage:
+    def __init__(self, message_id):
+        self.message_id = message_id
+
+
+class StubBot:
+    """Stands in for TeleBot in the worker; counts sends in Redis."""
+
+    def __init__(self, redis_client, latency):
+        self.redis = redis_client
+        self.latency = latency
+
+    def send_message(self, chat_id, text, **kwargs):
+        if self.latency:
+            time.sleep(self.latency)
+        pipe = self.redis.pipeline()
+        pipe.incr(KEY_PREFIX + 'sent')
+        pipe.set(KEY_PREFIX + 'last_sent', time.time())
+        message_id = pipe.execute()[0]
+        return StubMessage(message_id)
+
+
+def run_worker(args):
+    import psycopg2.extensions
+    import redis
+    from celery.signals import after_task_publish, task_postrun
+
+    import control_plane
+    import tasks
+    from database import Database
+
+    redis_client = redis.Redis.from_url(tasks.REDIS_URL)
+    tasks.bot = StubBot(redis_client, args.send_latency)
+    get_flag = control_plane.get_flag
+    control_plane.get_flag = lambda name, default=None: None if name == 'admin_id' else get_flag(name, default)
+
+    counters = {'queries': 0, 'published': 0}
+
+    class CountingCursor(psycopg2.extensions.cursor):
+        def execute(self, query, vars=None):
+            counters['queries'] += 1
+            return super().execute(query, vars)
+
+    get_connection = Database.get_connection
+
+    def counting_get_connection(self):
+        conn = get_connection(self)
+        conn.cursor_factory = CountingCursor
+        return conn
+
+    Database.get_connection = counting_get_connection
+
+    @after_task_publish.connect(weak=False)
+    def count_publish(**kwargs):
+        counters['published'] += 1
+
+    @task_postrun.connect(weak=False)
+    def flush_counters(**kwargs):
+        pipe = redis_client.pipeline()
+        pipe.incrby(KEY_PREFIX + 'queries', counters['queries'])
+        pipe.incrby(KEY_PREFIX + 'published', counters['published'])
+        pipe.incr(KEY_PREFIX + 'tasks')
+        pipe.execute()
+        counters['queries'] = 0
+        counters['published'] = 0
+
+    tasks.app.worker_main([
+        'worker', '-Q', 'broadcast', '--loglevel=warning', '--without-heartbeat', '--without-gossip', '--without-mingle',
+        f'--concurrency={args.concurrency}', f'--pool={args.pool}',
+    ])
+
+
+def count_expected_recipients(db, today):
+    return db.execute_query("""
+        SELECT COUNT(*) FROM users u
+        WHERE u.telegram_id > %s
+        AND NOT EXISTS (
+            SELECT 1 FROM activities a WHERE a.user_id = u.id AND DATE(a.created_at) = %s
+        )
+    """, (synthetic_data.SYNTHETIC_TELEGRAM_ID_BASE, today))[0][0]
+
+
+def run_benchmark(args):
+    import pytz
+    import redis
+
+    from config import POSTGRES_DB, REDIS_URL
+    if not (POSTGRES_DB or '').endswith('_bench') and not args.force:
+        sys.exit(f"Refusing to truncate tables in '{POSTGRES_DB}'. Use a *_bench database or pass --force.")
+
+    from database import db
+    import tasks
+
+    print(f"Seeding {args.users} users ({args.active_ratio:.0%} active today)...")
+    synthetic_data.generate(db, args.users, args.references, args.history, args.years)
+    synthetic_data.seed_active_today(db, int(args.users * args.active_ratio))
+    today = datetime.now(pytz.timezone('Europe/Nicosia')).date()
+    expected = count_expected_recipients(db, today)
+
+    redis_client = redis.Redis.from_url(REDIS_URL)
+    # Reminder dedupe keys from an earlier run would suppress this one
+    for prefix in (KEY_PREFIX, tasks.REMINDER_KEY_PREFIX):
+        for key in redis_client.scan_iter(prefix + '*'):
+            redis_client.delete(key)
+    tasks.app.control.purge()
+
+    env = dict(os.environ, ADMIN_ID='', BROADCAST_BATCH_SIZE=str(args.batch_size),
+               BROADCAST_SEND_CONCURRENCY=str(args.send_concurrency), BROADCAST_SEND_RATE=str(args.send_rate))
+    worker = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.bench_broadcast', 'worker',
+         '--concurrency', str(args.concurrency), '--pool', args.pool,
+         '--send-latency', str(args.send_latency)],
+        env=env,
+    )
+    time.sleep(args.worker_startup)
+
+    print(f"Broadcasting to {expected} inactive users...")
+    start = time.time()
+    tasks.send_encouragement.delay()
+    deadline = start + args.timeout
+    sent = 0
+    while time.time() < deadline:
+        sent = int(redis_client.get(KEY_PREFIX + 'sent') or 0)
+        if sent >= expected:
+            break
+        time.sleep(0.2)
+    last_sent = float(redis_client.get(KEY_PREFIX + 'last_sent') or start)
+    # Let the remaining task bookkeeping settle before reading the counters
+    time.sleep(1)
+
+    worker.send_signal(signal.SIGTERM)
+    worker.wait()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu_seconds = usage.ru_utime + usage.ru_stime
+
+    queries = int(redis_client.get(KEY_PREFIX + 'queries') or 0)
+    # +1 for the send_encouragement message published above
+    published = int(redis_client.get(KEY_PREFIX + 'published') or 0) + 1
+    elapsed = last_sent - start
+
+    result = {
+        'case': 'broadcast',
+        'users': args.users,
+        'recipients': expected,
+        'sent': sent,
+        'completed': sent >= expected,
+        'time_to_reach_all_s': elapsed,
+        'sends_per_s': sent / elapsed if elapsed > 0 else None,
+        'broker_messages': published,
+        'tasks_executed': int(redis_client.get(KEY_PREFIX + 'tasks') or 0),
+        'db_queries': queries,
+        'db_queries_per_user': queries / args.users,
+        'worker_cpu_s': cpu_seconds,
+        'worker_cpu_ms_per_user': cpu_seconds * 1000 / args.users,
+    }
+    for name, value in result.items():
+        print(f"  {name:<24} {value}")
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'concurrency': args.concurrency,
+            'pool': args.pool,
+            'send_latency': args.send_latency,
+            'batch_size': args.batch_size,
+            'send_concurrency': args.send_concurrency,
+            'send_rate': args.send_rate,
+            'active_ratio': args.active_ratio,
+            'history': args.history,
+        },
+        'results': [result],
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('mode', nargs='?', choices=('run', 'worker'), default='run')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--references', type=int, default=3, help="Reference activities per user")
+    parser.add_argument('--history', type=int, default=0, help="Historical activities to seed")
+    parser.add_argument('--years', type=float, default=1, help="Spread historical activities over this many years")
+    parser.add_argument('--active-ratio', type=float, default=0.3, help="Share of users already active today")
+    parser.add_argument('--concurrency', type=int, default=4, help="Worker processes/threads")
+    parser.add_argument('--pool', default='prefork', help="Celery worker pool")
+    parser.add_argument('--send-latency', type=float, default=0.0, help="Simulated Telegram round trip in seconds")
+    parser.add_argument('--batch-size', type=int, default=200,
+                        help="Users per send_encouragement_batch task, 0 for one task per user")
+    parser.add_argument('--send-concurrency', type=int, default=16, help="Sends in flight per batch task")
+    parser.add_argument('--send-rate', type=float, default=0,
+                        help="Messages per second per worker process, 0 for unlimited")
+    parser.add_argument('--worker-startup', type=float, default=5, help="Seconds to wait for the worker to boot")
+    parser.add_argument('--timeout', type=float, default=3600)
+    parser.add_argument('--output', default='bench_broadcast.json')
+    parser.add_argument('--force', action='store_true', help="Allow running against a database not ending in _bench")
+    args = parser.parse_args()
+
+    if args.mode == 'worker':
+        run_worker(args)
+    else:
+        run_benchmark(args)
+
+
+if __name__ == '__main__':
+    main()
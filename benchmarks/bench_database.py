@@ -0,0 +1,139 @@
+"""
+Benchmark the Database hot paths against synthetic data.
+
+Usage (from the project root, against a throwaway database):
+
+    POSTGRES_HOST=localhost POSTGRES_DB=hdays_bench POSTGRES_USER=... POSTGRES_PASSWORD=... \
+        python -m benchmarks.bench_database --sizes 1k,100k,10m --output bench_results.json
+
+Every size truncates users, reference_activities and activities before
+seeding, so the target database name must end with "_bench" unless --force
+is given.
+"""
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import analytics
+from benchmarks import synthetic_data
+
+SIZE_SUFFIXES = {'k': 1000, 'm': 1000000}
+
+
+def parse_size(value):
+    value = value.strip().lower()
+    if value[-1] in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[value[-1]])
+    return int(value)
+
+
+def stats_path(db, user_id):
+    # Mirrors the /stats and /trends handlers: one columnar fetch, then NumPy
+    history = analytics.ActivityHistory(db.get_reference_activities(user_id), *db.get_activity_history(user_id))
+    analytics.compute_trends(history)
+
+
+def build_cases(db, today):
+    return {
+        'get_recent_activities': lambda user_id: db.get_recent_activities(user_id, limit=10),
+        'get_activity_streaks': lambda user_id: db.get_activity_streaks(user_id),
+        'get_global_ranking': lambda user_id: db.get_global_ranking(),
+        'was_user_active_today': lambda user_id: db.was_user_active_today(user_id, today),
+        'stats_path': lambda user_id: stats_path(db, user_id),
+    }
+
+
+def time_case(func, user_ids, repeat):
+    timings = []
+    for _ in range(repeat):
+        for user_id in user_ids:
+            start = time.perf_counter()
+            func(user_id)
+            timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        'calls': len(timings),
+        'mean_ms': statistics.fmean(timings),
+        'min_ms': timings[0],
+        'p50_ms': timings[len(timings) // 2],
+        'p95_ms': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+        'max_ms': timings[-1],
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True).strip()
+    except Exception:
+        return None
+
+
+def server_version(db):
+    return db.execute_query("SHOW server_version")[0][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1k,100k,10m', help="Comma separated activity row counts (k/m suffixes allowed)")
+    parser.add_argument('--users', type=int, default=1000, help="Number of synthetic users")
+    parser.add_argument('--references', type=int, default=5, help="Reference activities per user")
+    parser.add_argument('--years', type=float, default=3, help="Spread activities over this many years")
+    parser.add_argument('--samples', type=int, default=20, help="Users sampled per benchmark case")
+    parser.add_argument('--repeat', type=int, default=5, help="Repetitions per sampled user")
+    parser.add_argument('--cases', help="Comma separated subset of cases to run")
+    parser.add_argument('--output', default='bench_results.json', help="Where to write the JSON results")
+    parser.add_argument('--force', action='store_true', help="Allow running against a database not ending in _bench")
+    args = parser.parse_args()
+
+    from config import POSTGRES_DB
+    if not (POSTGRES_DB or '').endswith('_bench') and not args.force:
+        parser.error(f"Refusing to truncate tables in '{POSTGRES_DB}'. Use a *_bench database or pass --force.")
+
+    from database import db
+
+    today = datetime.now().date()
+    cases = build_cases(db, today)
+    if args.cases:
+        cases = {name: cases[name] for name in args.cases.split(',')}
+
+    results = []
+    for rows in map(parse_size, args.sizes.split(',')):
+        print(f"Seeding {rows} activities for {args.users} users...")
+        seed_start = time.perf_counter()
+        synthetic_data.generate(db, args.users, args.references, rows, args.years)
+        seed_seconds = time.perf_counter() - seed_start
+        user_ids = synthetic_data.sample_user_ids(db, args.samples)
+
+        for name, func in cases.items():
+            # Warm up caches and the connection pool before measuring
+            func(user_ids[0])
+            result = time_case(func, user_ids, args.repeat)
+            result.update({'case': name, 'rows': rows, 'seed_seconds': seed_seconds})
+            results.append(result)
+            print(f"  {name:<24} p50={result['p50_ms']:.2f}ms p95={result['p95_ms']:.2f}ms")
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'git_revision': git_revision(),
+            'python': platform.python_version(),
+            'postgres': server_version(db),
+            'users': args.users,
+            'references_per_user': args.references,
+            'years': args.years,
+            'samples': args.samples,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+"""
+Compare two benchmark result files written by the benchmark scripts.
+
+    python -m benchmarks.compare baseline.json candidate.json
+"""
+import argparse
+import json
+
+
+def load_results(path, metric):
+    with open(path) as f:
+        report = json.load(f)
+    # Database benchmarks are sized by rows, load tests by simulated users
+    return {(result['case'], result.get('rows', result.get('users'))): result
+            for result in report['results'] if metric in result}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--metric', default='p50_ms')
+    args = parser.parse_args()
+
+    baseline = load_results(args.baseline, args.metric)
+    candidate = load_results(args.candidate, args.metric)
+
+    print(f"{'case':<24} {'size':>10} {'baseline':>12} {'candidate':>12} {'change':>8}")
+    for key in sorted(baseline.keys() & candidate.keys()):
+        case, size = key
+        before = baseline[key][args.metric]
+        after = candidate[key][args.metric]
+        change = (after - before) / before * 100 if before else 0.0
+        print(f"{case:<24} {size:>10} {before:>12.2f} {after:>12.2f} {change:>+7.1f}%")
+
+
+if __name__ == '__main__':
+    main()
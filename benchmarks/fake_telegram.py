@@ -0,0 +1,296 @@
+"""
+A local fake of the Telegram Bot API for load tests.
+
+Serves getUpdates (long polling) or pushes updates to a webhook URL, and
+accepts and records sendMessage-style calls with configurable latency and
+429 behaviour. Point the bot at it with TELEGRAM_API_URL, e.g.
+
+    python -m benchmarks.fake_telegram --port 8081 --latency 0.05
+    TELEGRAM_API_URL=http://localhost:8081/bot{0}/{1} python main.py
+
+Control endpoints for driving it from another process:
+
+    POST /_control/updates   body: a Telegram "message" object to deliver
+    GET  /_control/sent      recorded outgoing calls as JSON
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+from urllib.request import Request, urlopen
+
+RECORDED_METHODS = {
+    'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'sendPhoto',
+    'answerCallbackQuery', 'deleteMessage',
+}
+
+
+class FakeTelegramServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0,
+                 retry_after=1, per_chat_rate=None, webhook_url=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.per_chat_rate = per_chat_rate
+        self.webhook_url = webhook_url
+
+        self.sent = []
+        self.listeners = []
+        self.throttled = 0
+
+        self._updates = deque()
+        self._update_id = 0
+        self._message_id = 0
+        self._chat_sends = defaultdict(deque)
+        self._lock = threading.Lock()
+        self._updates_available = threading.Condition(self._lock)
+
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_url(self):
+        # Format string understood by telebot.apihelper.API_URL
+        return self.base_url + "/bot{0}/{1}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def push_message(self, message):
+        """
+        Deliver a message update to the bot, either through getUpdates or by
+        POSTing it to the webhook URL. Returns the update id.
+        """
+        return self.push_update('message', message)
+
+    def push_callback_query(self, callback_query):
+        """Deliver an inline button press, see push_message."""
+        return self.push_update('callback_query', callback_query)
+
+    def push_update(self, kind, payload):
+        with self._updates_available:
+            self._update_id += 1
+            update = {'update_id': self._update_id, kind: payload}
+            if not self.webhook_url:
+                self._updates.append(update)
+                self._updates_available.notify_all()
+        if self.webhook_url:
+            threading.Thread(target=self._post_webhook, args=(update,), daemon=True).start()
+        return update['update_id']
+
+    def _post_webhook(self, update):
+        request = Request(self.webhook_url, data=json.dumps(update).encode(),
+                          headers={'Content-Type': 'application/json'})
+        try:
+            urlopen(request, timeout=30).read()
+        except Exception as e:
+            print(f"Webhook delivery of update {update['update_id']} failed: {e}")
+
+    def get_updates(self, offset=None, limit=100, timeout=0):
+        deadline = time.monotonic() + timeout
+        with self._updates_available:
+            while True:
+                if offset is not None:
+                    while self._updates and self._updates[0]['update_id'] < offset:
+                        self._updates.popleft()
+                if self._updates or time.monotonic() >= deadline:
+                    return list(self._updates)[:limit]
+                self._updates_available.wait(deadline - time.monotonic())
+
+    def _is_throttled(self, chat_id):
+        if self.error_rate and random.random() < self.error_rate:
+            return True
+        if not self.per_chat_rate or chat_id is None:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            sends = self._chat_sends[chat_id]
+            while sends and now - sends[0] > 1:
+                sends.popleft()
+            if len(sends) >= self.per_chat_rate:
+                return True
+            sends.append(now)
+        return False
+
+    def handle(self, method, params):
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_bot'}}
+        if method in ('deleteWebhook', 'setWebhook', 'setMyCommands'):
+            return 200, {'ok': True, 'result': True}
+        if method == 'getUpdates':
+            offset = int(params['offset']) if params.get('offset') else None
+            updates = self.get_updates(offset, int(params.get('limit', 100)), float(params.get('timeout', 0)))
+            return 200, {'ok': True, 'result': updates}
+        if method not in RECORDED_METHODS:
+            return 200, {'ok': True, 'result': True}
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        chat_id = int(params['chat_id']) if params.get('chat_id') else None
+        # Edits keep the id of the message they change
+        message_id = int(params['message_id']) if params.get('message_id') else None
+        record = {
+            'method': method,
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'text': params.get('text'),
+            'reply_to_message_id': _reply_to_message_id(params),
+            'reply_markup': json.loads(params['reply_markup']) if params.get('reply_markup') else None,
+            'timestamp': time.monotonic(),
+            'throttled': False,
+        }
+        if self._is_throttled(chat_id):
+            record['throttled'] = True
+            with self._lock:
+                self.throttled += 1
+            self._record(record)
+            return 429, {'ok': False, 'error_code': 429,
+                         'description': f"Too Many Requests: retry after {self.retry_after}",
+                         'parameters': {'retry_after': self.retry_after}}
+
+        if method in ('answerCallbackQuery', 'deleteMessage'):
+            self._record(record)
+            return 200, {'ok': True, 'result': True}
+        if message_id is None:
+            message_id = record['message_id'] = self.next_message_id()
+        self._record(record)
+        return 200, {'ok': True, 'result': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'FakeBot'},
+            'text': params.get('text') or '',
+        }}
+
+    def _record(self, record):
+        with self._lock:
+            self.sent.append(record)
+        for listener in self.listeners:
+            listener(record)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _params(self):
+                url = urlparse(self.path)
+                params = dict(parse_qsl(url.query))
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = self.rfile.read(length)
+                    content_type = self.headers.get('Content-Type', '')
+                    if content_type.startswith('application/json'):
+                        params.update(json.loads(body))
+                    elif content_type.startswith('application/x-www-form-urlencoded'):
+                        params.update(parse_qsl(body.decode()))
+                return url.path, params
+
+            def _respond(self, status, payload):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _dispatch(self):
+                path, params = self._params()
+                if path == '/_control/updates':
+                    message = params if 'chat' in params else json.loads(params.get('message', '{}'))
+                    return self._respond(200, {'ok': True, 'result': server.push_message(message)})
+                if path == '/_control/sent':
+                    return self._respond(200, {'ok': True, 'result': server.sent})
+                method = path.rsplit('/', 1)[-1]
+                self._respond(*server.handle(method, params))
+
+            do_GET = _dispatch
+            do_POST = _dispatch
+
+        return Handler
+
+
+def _reply_to_message_id(params):
+    if params.get('reply_to_message_id'):
+        return int(params['reply_to_message_id'])
+    if params.get('reply_parameters'):
+        return json.loads(params['reply_parameters']).get('message_id')
+    return None
+
+
+def make_text_message(server, telegram_id, text):
+    message = {
+        'message_id': server.next_message_id(),
+        'from': {'id': telegram_id, 'is_bot': False, 'first_name': f"Load {telegram_id}"},
+        'chat': {'id': telegram_id, 'type': 'private'},
+        'date': int(time.time()),
+        'text': text,
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return message
+
+
+def make_callback_query(server, telegram_id, message_id, data):
+    """A press of the inline button with callback data `data` under a bot message."""
+    return {
+        'id': str(server.next_message_id()),
+        'from': {'id': telegram_id, 'is_bot': False, 'first_name': f"Load {telegram_id}"},
+        'chat_instance': str(telegram_id),
+        'message': {
+            'message_id': message_id,
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'FakeBot'},
+            'chat': {'id': telegram_id, 'type': 'private'},
+            'date': int(time.time()),
+            'text': '',
+        },
+        'data': data,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds to delay each recorded call")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Probability of answering a send with 429")
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--per-chat-rate', type=int, help="Sends per chat per second before answering 429")
+    parser.add_argument('--webhook-url', help="Push updates to this URL instead of serving getUpdates")
+    args = parser.parse_args()
+
+    server = FakeTelegramServer(args.host, args.port, args.latency, args.error_rate,
+                                args.retry_after, args.per_chat_rate, args.webhook_url)
+    print(f"Fake Telegram Bot API listening on {server.base_url}")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+"""
+End-to-end load test for bot_handlers.
+
+Starts the fake Telegram Bot API, runs the real handlers in-process against
+it and replays scripted multi-step conversations from many simulated users:
+
+    POSTGRES_HOST=localhost POSTGRES_DB=hdays_bench ... \
+        python -m benchmarks.load_test --users 2000 --concurrency 200 --output load_results.json
+
+Every simulated user first registers with /start and creates a reps and a
+time reference activity, then runs the chosen scenarios. Latency is measured
+from delivering an update to the first bot reply in that chat.
+
+Handlers reply before registering their next-step handler, so simulated
+users wait --think-time seconds after each reply before answering, as a
+real user would.
+"""
+import argparse
+import json
+import queue
+import statistics
+import threading
+import time
+from collections import defaultdict, namedtuple
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.fake_telegram import FakeTelegramServer, make_callback_query, make_text_message
+from benchmarks.synthetic_data import SYNTHETIC_TELEGRAM_ID_BASE
+
+# Keep load-test users apart from the database benchmark's synthetic users
+LOAD_TEST_TELEGRAM_ID_BASE = SYNTHETIC_TELEGRAM_ID_BASE + 10000000
+
+
+class StepTimeout(Exception):
+    pass
+
+
+# An inline button press under the bot message with message_id
+Press = namedtuple('Press', 'message_id data')
+
+
+def press(reply, text=None):
+    """Press the button labelled text, or the first choice, under reply."""
+    markup = reply.get('reply_markup') or {}
+    buttons = [button for row in markup.get('inline_keyboard') or [] for button in row
+               if button['text'] not in ('Cancel', 'Skip') and text in (None, button['text'])]
+    return Press(reply['message_id'], buttons[0]['callback_data'])
+
+
+def value_for_prompt(reply):
+    return "00:10:00" if "HH:MM:SS" in (reply.get('text') or '') else "25"
+
+
+def setup_script():
+    yield '/start'
+    for name, activity_type in (('Pushups', 'Reps'), ('Plank', 'Time')):
+        yield '/addref'
+        reply = yield name
+        yield press(reply, activity_type)
+
+
+def add_script():
+    reply = yield '/add'
+    reply = yield press(reply)
+    yield value_for_prompt(reply)
+
+
+def addbulk_script():
+    reply = yield '/addbulk'
+    while (reply.get('text') or '').startswith('How'):
+        reply = yield value_for_prompt(reply)
+
+
+def list_script():
+    yield '/list'
+
+
+def stats_script():
+    yield '/stats'
+
+
+SCENARIOS = {
+    'add': add_script,
+    'addbulk': addbulk_script,
+    'list': list_script,
+    'stats': stats_script,
+}
+
+
+class LoadGenerator:
+    def __init__(self, server, step_timeout, think_time):
+        self.server = server
+        self.step_timeout = step_timeout
+        self.think_time = think_time
+        self.replies = defaultdict(queue.Queue)
+        self.latencies = defaultdict(list)
+        self.failures = defaultdict(int)
+        self._lock = threading.Lock()
+        server.listeners.append(self.on_record)
+
+    def on_record(self, record):
+        if record['chat_id'] is not None and not record['throttled']:
+            self.replies[record['chat_id']].put(record)
+
+    def send_step(self, telegram_id, text):
+        replies = self.replies[telegram_id]
+        # Drop trailing messages left over from the previous step
+        while not replies.empty():
+            replies.get_nowait()
+
+        start = time.monotonic()
+        if isinstance(text, Press):
+            # Answered by editing the message the button is under
+            reply_to = None
+            self.server.push_callback_query(make_callback_query(self.server, telegram_id, text.message_id, text.data))
+        else:
+            message = make_text_message(self.server, telegram_id, text)
+            reply_to = message['message_id']
+            self.server.push_message(message)
+        deadline = start + self.step_timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise StepTimeout(text)
+            try:
+                reply = replies.get(timeout=remaining)
+            except queue.Empty:
+                raise StepTimeout(text)
+            if reply['reply_to_message_id'] in (None, reply_to):
+                return reply, reply['timestamp'] - start
+
+    def run_script(self, name, telegram_id, script):
+        steps = script()
+        try:
+            text = next(steps)
+            while True:
+                reply, latency = self.send_step(telegram_id, text)
+                with self._lock:
+                    self.latencies[name].append(latency)
+                text = steps.send(reply)
+                time.sleep(self.think_time)
+        except StopIteration:
+            return True
+        except (StepTimeout, IndexError):
+            with self._lock:
+                self.failures[name] += 1
+            # Leave any pending next-step handler behind
+            time.sleep(self.think_time)
+            try:
+                self.send_step(telegram_id, '/exit')
+            except StepTimeout:
+                pass
+            return False
+
+    def run_user(self, telegram_id, scenarios, iterations):
+        if not self.run_script('setup', telegram_id, setup_script):
+            return
+        for _ in range(iterations):
+            for name in scenarios:
+                self.run_script(name, telegram_id, SCENARIOS[name])
+
+
+def summarize(name, latencies, failures, elapsed):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {'case': name, 'steps': 0, 'failures': failures}
+    return {
+        'case': name,
+        'steps': len(latencies),
+        'failures': failures,
+        'throughput_per_s': len(latencies) / elapsed,
+        'mean_ms': statistics.fmean(latencies) * 1000,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+
+def start_webhook_receiver(bot, port):
+    from telebot.types import Update
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            bot.process_new_updates([Update.de_json(body.decode())])
+            self.send_response(200)
+            self.end_headers()
+
+    httpd = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_address[1]}/webhook"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=100, help="Simulated users in flight at once")
+    parser.add_argument('--scenarios', default='add,addbulk,list,stats')
+    parser.add_argument('--iterations', type=int, default=3, help="Scenario rounds per user")
+    parser.add_argument('--bot-threads', type=int, default=2, help="TeleBot worker threads (num_threads)")
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default='polling')
+    parser.add_argument('--latency', type=float, default=0.0, help="Fake API latency per send in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Probability of a 429 per send")
+    parser.add_argument('--per-chat-rate', type=int, help="Sends per chat per second before 429")
+    parser.add_argument('--step-timeout', type=float, default=30)
+    parser.add_argument('--think-time', type=float, default=0.1, help="Pause between a reply and the next step")
+    parser.add_argument('--output', default='load_results.json')
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(',')
+    server = FakeTelegramServer(latency=args.latency, error_rate=args.error_rate,
+                                per_chat_rate=args.per_chat_rate)
+
+    from telebot import TeleBot, apihelper
+    from bot_handlers import register_handlers
+    from config import BOT_TOKEN
+
+    apihelper.API_URL = server.api_url
+    bot = TeleBot(BOT_TOKEN or "0:load-test", num_threads=args.bot_threads)
+    register_handlers(bot)
+
+    if args.mode == 'webhook':
+        server.webhook_url = start_webhook_receiver(bot, 0)
+    server.start()
+    if args.mode == 'polling':
+        threading.Thread(target=bot.infinity_polling, kwargs={'timeout': 5, 'long_polling_timeout': 1},
+                         daemon=True).start()
+
+    generator = LoadGenerator(server, args.step_timeout, args.think_time)
+    users = queue.Queue()
+    for n in range(1, args.users + 1):
+        users.put(LOAD_TEST_TELEGRAM_ID_BASE + n)
+
+    def worker():
+        while True:
+            try:
+                telegram_id = users.get_nowait()
+            except queue.Empty:
+                return
+            generator.run_user(telegram_id, scenarios, args.iterations)
+
+    print(f"Running {args.users} users with concurrency {args.concurrency} ({args.mode})...")
+    start = time.monotonic()
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    results = [summarize(name, generator.latencies[name], generator.failures[name], elapsed)
+               for name in ['setup'] + scenarios]
+    all_latencies = [latency for values in generator.latencies.values() for latency in values]
+    results.append(summarize('all', all_latencies, sum(generator.failures.values()), elapsed))
+    for result in results:
+        result['users'] = args.users
+        if result['steps']:
+            print(f"  {result['case']:<8} steps={result['steps']:<7} failures={result['failures']:<5} "
+                  f"throughput={result['throughput_per_s']:.1f}/s p50={result['p50_ms']:.1f}ms p99={result['p99_ms']:.1f}ms")
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'elapsed_seconds': elapsed,
+            'users': args.users,
+            'concurrency': args.concurrency,
+            'bot_threads': args.bot_threads,
+            'mode': args.mode,
+            'latency': args.latency,
+            'error_rate': args.error_rate,
+            'per_chat_rate': args.per_chat_rate,
+            'sent_calls': len(server.sent),
+            'throttled_calls': server.throttled,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    bot.stop_polling()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
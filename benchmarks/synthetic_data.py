@@ -0,0 +1,146 @@
+"""
+Synthetic data generator for benchmarks.
+
+Fills the configured Postgres database with fake users, reference activities
+and activities spread over a number of years. All rows are generated on the
+server with generate_series, so seeding 10M activities does not stream any
+data through Python.
+"""
+
+# Synthetic users get telegram ids above this value so they never collide
+# with real accounts.
+SYNTHETIC_TELEGRAM_ID_BASE = 900000000000
+
+ACTIVITY_BATCH_SIZE = 1000000
+
+
+def reset_tables(db):
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("TRUNCATE activities, reference_activities, users RESTART IDENTITY CASCADE")
+            conn.commit()
+    finally:
+        db.release_connection(conn)
+
+
+def seed_users(db, users):
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (telegram_id, username, first_name, last_name)
+                SELECT %s + g, 'bench_' || g, 'Bench ' || g, NULL
+                FROM generate_series(1, %s) g
+            """, (SYNTHETIC_TELEGRAM_ID_BASE, users))
+            conn.commit()
+    finally:
+        db.release_connection(conn)
+
+
+def seed_reference_activities(db, per_user):
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO reference_activities (user_id, activity_name, activity_type)
+                SELECT u.id, 'Exercise ' || r, CASE WHEN r %% 2 = 0 THEN 'time' ELSE 'reps' END
+                FROM users u
+                CROSS JOIN generate_series(1, %s) r
+                WHERE u.telegram_id > %s
+                ORDER BY u.id, r
+            """, (per_user, SYNTHETIC_TELEGRAM_ID_BASE))
+            conn.commit()
+    finally:
+        db.release_connection(conn)
+
+
+def seed_activities(db, rows, years, seed=0.42):
+    """
+    Insert `rows` activities spread uniformly over the synthetic reference
+    activities, with created_at uniformly distributed over the last `years`.
+    """
+    # Give the historical months their own partitions instead of the default one
+    db.ensure_activity_partitions(months_back=int(years * 12) + 1)
+
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT setseed(%s)", (seed,))
+            cur.execute("""
+                SELECT MIN(r.id), COUNT(*)
+                FROM reference_activities r
+                JOIN users u ON u.id = r.user_id
+                WHERE u.telegram_id > %s
+            """, (SYNTHETIC_TELEGRAM_ID_BASE,))
+            first_reference_id, reference_count = cur.fetchone()
+            if not reference_count:
+                raise ValueError("Seed reference activities before activities")
+
+            inserted = 0
+            while inserted < rows:
+                batch = min(ACTIVITY_BATCH_SIZE, rows - inserted)
+                cur.execute("""
+                    INSERT INTO activities (user_id, reference_activity_id, value, created_at)
+                    SELECT r.user_id, r.id,
+                           CASE WHEN r.activity_type = 'time' THEN 30 + (random() * 3600)::int
+                                ELSE 1 + (random() * 100)::int END,
+                           CURRENT_TIMESTAMP - random() * %s * INTERVAL '1 day'
+                    FROM generate_series(%s, %s) g
+                    JOIN reference_activities r ON r.id = %s + (g %% %s)
+                """, (years * 365, inserted + 1, inserted + batch, first_reference_id, reference_count))
+                conn.commit()
+                inserted += batch
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("VACUUM ANALYZE users, reference_activities, activities")
+        finally:
+            conn.autocommit = False
+    finally:
+        db.release_connection(conn)
+
+
+def generate(db, users, references_per_user, activities, years, seed=0.42):
+    reset_tables(db)
+    seed_users(db, users)
+    seed_reference_activities(db, references_per_user)
+    seed_activities(db, activities, years, seed)
+
+
+def sample_user_ids(db, count):
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT id FROM users
+                WHERE telegram_id > %s
+                ORDER BY random()
+                LIMIT %s
+            """, (SYNTHETIC_TELEGRAM_ID_BASE, count))
+            return [row[0] for row in cur.fetchall()]
+    finally:
+        db.release_connection(conn)
+
+
+def seed_active_today(db, users):
+    """
+    Log one activity today for the first `users` synthetic users, so they are
+    skipped by the encouragement broadcast.
+    """
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO activities (user_id, reference_activity_id, value, created_at)
+                SELECT DISTINCT ON (u.id) u.id, r.id, 1, CURRENT_TIMESTAMP
+                FROM users u
+                JOIN reference_activities r ON r.user_id = u.id
+                WHERE u.id IN (
+                    SELECT id FROM users WHERE telegram_id > %s ORDER BY id LIMIT %s
+                )
+                ORDER BY u.id, r.id
+            """, (SYNTHETIC_TELEGRAM_ID_BASE, users))
+            conn.commit()
+    finally:
+        db.release_connection(conn)
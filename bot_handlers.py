@@ -4,30 +4,86 @@ from database import Database  # Import the Database class
 from config import *
 import pytz
 from datetime import datetime, timedelta
-from tasks import send_encouragement_and_quote
+from tasks import send_encouragement_and_quote, purge_reference_activity, send_progress_chart, rebuild_leaderboard
 from logger import logger, log_error, log_info
 from tabulate import tabulate
 from error_messages import *
+from cache import user_cache
+import telegram_client
+import control_plane
+from activity_names import ActivityNameIndex, parse_log_entries
+import activity_stream
+import charts
+import analytics
+import metrics
+import leaderboard
+import catalog
+from conversation import CANCEL, FLOW_CALLBACK_PREFIX, SKIP, FlowMessage, cancel_keyboard, flow_keyboard
 
 # Add this constant at the top of your file
 NICOSIA_TIMEZONE = pytz.timezone('Europe/Nicosia')
 
+# Activity pagination
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+OLDER_BUTTON = "Older ▶"
+NEWER_BUTTON = "◀ Newer"
+LIST_CALLBACK_PREFIX = "list:"
+OLDER = "older"
+NEWER = "newer"
+
+YES_NO_KEYBOARD = flow_keyboard([("Yes", "yes"), ("No", "no")])
+
+# How far back /update can move an activity; it can't move one into the future
+MAX_BACKDATE_DAYS = 365
+
+# Longest challenge /challenge start and /challenge new accept, in days
+MAX_CHALLENGE_DAYS = 366
+CHALLENGE_USAGE = """Challenges:
+/challenge - Show your challenges and the open ones
+/challenge start [days] [name] - Start your own challenge today (100 days by default)
+/challenge join <id> - Join a challenge or switch back to one
+/challenge leave - Leave your current challenge"""
+
 # Create a Database instance
 db = Database()
 
 def create_bot():
+    telegram_client.configure()
+    control_plane.seed_admins(db.get_admin_telegram_ids())
     bot = TeleBot(BOT_TOKEN)
     register_handlers(bot)
     return bot
 
 def check_maintenance(message: Message, bot: TeleBot):
-    if MAINTENANCE_MODE:
-        user = db.get_user(message.from_user.id)
-        if not user or not user[5]:  # user[5] is the is_admin flag
-            bot.reply_to(message, MAINTENANCE_MODE_MESSAGE)
-            return True
+    # Both checks are answered from memory, see control_plane
+    if control_plane.is_maintenance() and not control_plane.is_admin(message.from_user.id):
+        bot.reply_to(message, MAINTENANCE_MODE_MESSAGE)
+        return True
+    return False
+
+def check_maintenance_callback(call: CallbackQuery, bot: TeleBot):
+    if control_plane.is_maintenance() and not control_plane.is_admin(call.from_user.id):
+        bot.answer_callback_query(call.id, MAINTENANCE_MODE_MESSAGE)
+        return True
     return False
 
+def check_admin(message: Message, bot: TeleBot):
+    if not control_plane.is_admin(message.from_user.id):
+        bot.reply_to(message, ADMIN_ONLY_MESSAGE)
+        return False
+    return True
+
+def encode_cursor(activity):
+    # (created_at, id) of an activity row, compact enough for callback data
+    created_at = activity[4]
+    delta = created_at - EPOCH
+    microseconds = (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+    return f"{microseconds}:{activity[0]}"
+
+def decode_cursor(cursor):
+    microseconds, activity_id = cursor.split(":")
+    return EPOCH + timedelta(microseconds=int(microseconds)), int(activity_id)
+
 def register_handlers(bot: TeleBot):
     @bot.message_handler(commands=['start'])
     def start(message: Message):
@@ -45,6 +101,9 @@ def register_handlers(bot: TeleBot):
             message_text = "Hey there! 👋 Are you ready for a challenge? 💪 I bet you do! 🎉"
             if user:
                 db.update_user(telegram_id, username, first_name, last_name)
+                # Users who blocked the bot are skipped by broadcasts until they come back
+                if db.reactivate_user(telegram_id):
+                    log_info(f"User {telegram_id} is reachable again")
                 bot.reply_to(message, message_text)
                 log_info(f"User {telegram_id} information updated")
             else:
@@ -66,11 +125,16 @@ def register_handlers(bot: TeleBot):
 
         Activity commands:
         /add - Add a new activity
+        /log - Add activities in one message, e.g. /log pushups 50, plank 1:30
+               (the same works without /log)
         /addbulk - Add multiple activities at once
         /update - Update an existing activity
         /delete - Delete an activity
         /list - List all activities
         /stats - Get activity statistics
+        /trends - Show weekly volume, averages, records and pace
+        /chart - Show your progress chart
+        /challenge - Start, join or switch challenges
         
         Reference activities:
         /addref - Add a new reference activity
@@ -79,7 +143,8 @@ def register_handlers(bot: TeleBot):
         /deleteref - Delete a reference activity
 
         Global ranking:
-        /ranking - Show global ranking
+        /ranking - Show global ranking and your place in it
+        /top <exercise> [week|month] - Show the leaderboard of one exercise
         """
         bot.reply_to(message, help_text)
         log_info(f"Help command used by user {message.from_user.id}")
@@ -151,7 +216,7 @@ def register_handlers(bot: TeleBot):
         
         try:
             for activity_id, value in added_activities.items():
-                db.add_activity(user[0], activity_id, value)
+                save_activity(user[0], activity_id, value)
             
             bot.reply_to(message, f"Successfully added {len(added_activities)} activities!", reply_markup=ReplyKeyboardRemove())
             log_info(f"Bulk add: User {telegram_id} added {len(added_activities)} activities")
@@ -159,6 +224,52 @@ def register_handlers(bot: TeleBot):
             log_error(f"Error in save_bulk_add_results for user {telegram_id}: {str(e)}")
             bot.reply_to(message, GENERAL_ERROR_MESSAGE, reply_markup=ReplyKeyboardRemove())
 
+    # Flows waiting for their next input, by chat: (flow, step, args). Kept in
+    # memory, like telebot's own next-step handlers.
+    pending_flows = {}
+
+    def wait_for_input(flow: FlowMessage, step, *args):
+        """Pass the user's next message, or the press of a flow button, to step."""
+        pending_flows[flow.chat_id] = (flow, step, args)
+        bot.register_next_step_handler_by_chat_id(flow.chat_id, receive_flow_message)
+
+    def receive_flow_message(message: Message):
+        pending = pending_flows.pop(message.chat.id, None)
+        if pending is None:
+            return
+        if check_maintenance(message, bot):
+            return
+        run_flow_step(pending, message.from_user.id, (message.text or "").strip())
+
+    @bot.callback_query_handler(func=lambda call: call.data.startswith(FLOW_CALLBACK_PREFIX))
+    def receive_flow_button(call: CallbackQuery):
+        if check_maintenance_callback(call, bot):
+            return
+        try:
+            chat_id = call.message.chat.id
+            pending = pending_flows.get(chat_id)
+            # Buttons of a finished flow, or of one started before a restart
+            if (pending is None or pending[0].message_id != call.message.message_id
+                    or pending_flows.pop(chat_id, None) is not pending):
+                bot.answer_callback_query(call.id, FLOW_EXPIRED_MESSAGE)
+                FlowMessage.from_callback(bot, call).close(call.message.text)
+                return
+            bot.clear_step_handler_by_chat_id(chat_id)
+            bot.answer_callback_query(call.id)
+            run_flow_step(pending, call.from_user.id, call.data[len(FLOW_CALLBACK_PREFIX):])
+        except Exception as e:
+            log_error(f"Error in receive_flow_button: {str(e)}")
+            bot.answer_callback_query(call.id, GENERAL_ERROR_MESSAGE)
+
+    def run_flow_step(pending, telegram_id, value):
+        flow, step, args = pending
+        if value.lower() in (CANCEL, '/exit'):
+            flow.close(OPERATION_CANCELLED_MESSAGE)
+            return
+        step(flow, telegram_id, value, *args)
+
+    ADD_ACTIVITY_PROMPT = "Please choose an activity or press 'Cancel' to abort:"
+
     @bot.message_handler(commands=['add'])
     def add_activity(message: Message):
         if check_maintenance(message, bot):
@@ -170,9 +281,11 @@ def register_handlers(bot: TeleBot):
             reference_activities = db.get_reference_activities(user[0])  # user[0] is the user_id
             
             if reference_activities:
-                keyboard = create_reference_activity_keyboard(reference_activities)
-                bot.reply_to(message, "Please choose an activity or press 'Cancel' to abort:", reply_markup=keyboard)
-                bot.register_next_step_handler(message, process_add_activity_choice, reference_activities)
+                keyboard = user_cache.get_or_set(user[0], 'reference_activities:flow_keyboard',
+                                                 lambda: create_reference_activity_keyboard(reference_activities).to_json())
+                flow = FlowMessage.for_message(bot, message)
+                flow.render(ADD_ACTIVITY_PROMPT, keyboard)
+                wait_for_input(flow, process_add_activity_choice, reference_activities)
                 log_info(f"User {telegram_id} started adding an activity")
             else:
                 bot.reply_to(message, NO_REFERENCE_ACTIVITIES_MESSAGE)
@@ -181,60 +294,30 @@ def register_handlers(bot: TeleBot):
             log_error(f"Error in add_activity for user {telegram_id}: {str(e)}")
             bot.reply_to(message, GENERAL_ERROR_MESSAGE)
 
-    def process_add_activity_choice(message: Message, valid_activities):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-        
-        choice = message.text.strip()
+    def process_add_activity_choice(flow: FlowMessage, telegram_id, choice, valid_activities):
         log_info(f"User choice: {choice}")
         
-        if choice.lower() == "cancel":
-            bot.reply_to(message, OPERATION_CANCELLED_MESSAGE, reply_markup=ReplyKeyboardRemove())
-            return
-        
         try:
-            reference_activity_id = int(choice.split(":")[0])
-            activity = next((act for act in valid_activities if act[0] == reference_activity_id), None)
-            
+            activity = find_by_id(valid_activities, choice)
             if not activity:
-                raise ValueError(INVALID_ACTIVITY_SELECTION_MESSAGE)
+                flow.render(f"{INVALID_ACTIVITY_SELECTION_MESSAGE}\n\n{ADD_ACTIVITY_PROMPT}",
+                            create_reference_activity_keyboard(valid_activities))
+                return wait_for_input(flow, process_add_activity_choice, valid_activities)
             
-            activity_id, activity_name, activity_type = activity  # Unpack 3 values
+            reference_activity_id, activity_name, activity_type = activity  # Unpack 3 values
             
-            keyboard = ReplyKeyboardMarkup(row_width=1, one_time_keyboard=True, resize_keyboard=True)
-            keyboard.add("Cancel")
-            
-            prompt_for_activity_value(message, bot, activity_name, activity_type, keyboard)
-            bot.register_next_step_handler(message, process_add_activity_value, reference_activity_id, activity_type)
+            flow.render(activity_value_prompt(activity_name, activity_type), cancel_keyboard())
+            wait_for_input(flow, process_add_activity_value, reference_activity_id, activity_name, activity_type)
         except Exception as e:
             log_error(f"Error in process_add_activity_choice: {str(e)}")
-            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
-            return add_activity(message)
+            flow.close(GENERAL_ERROR_MESSAGE)
 
-    def process_add_activity_value(message: Message, reference_activity_id, activity_type):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-        
-        value_input = message.text.strip()
-        telegram_id = message.from_user.id
-        
-        if value_input.lower() == "cancel":
-            bot.reply_to(message, OPERATION_CANCELLED_MESSAGE, reply_markup=ReplyKeyboardRemove())
-            return
-        
+    def process_add_activity_value(flow: FlowMessage, telegram_id, value_input, reference_activity_id, activity_name, activity_type):
         try:
             value = parse_activity_value(value_input, activity_type)
             
             user = db.get_user(telegram_id)
-            activity_id = db.add_activity(user[0], reference_activity_id, value)
-            
-            # Get the activity name
-            activity = db.get_reference_activity(reference_activity_id, user[0])
-            activity_name = activity[1] if activity else "Unknown"  # Assuming activity name is the second item
+            save_activity(user[0], reference_activity_id, value)
             
             # Get current time in Nicosia
             nicosia_time = datetime.now(NICOSIA_TIMEZONE)
@@ -242,41 +325,49 @@ def register_handlers(bot: TeleBot):
             value_str = format_activity_value(value, activity_type)
             date_str = nicosia_time.strftime('%b %d %H:%M')
             
-            bot.reply_to(message, f"Added: {activity_name} | {value_str} | {date_str}", reply_markup=ReplyKeyboardRemove())
+            flow.close(f"Added: {activity_name} | {value_str} | {date_str}")
         except ValueError as e:
-            # Get the activity name here as well
-            user = db.get_user(telegram_id)
-            activity = db.get_reference_activity(reference_activity_id, user[0])
-            activity_name = activity[1] if activity else "Unknown"  # Assuming activity name is the second item
-            
-            bot.reply_to(message, str(e))
-            keyboard = ReplyKeyboardMarkup(row_width=1, one_time_keyboard=True, resize_keyboard=True)
-            keyboard.add("Cancel")
-            prompt_for_activity_value(message, bot, activity_name, activity_type, keyboard)
-            bot.register_next_step_handler(message, process_add_activity_value, reference_activity_id, activity_type)
+            flow.render(f"{str(e)}\n\n{activity_value_prompt(activity_name, activity_type)}", cancel_keyboard())
+            wait_for_input(flow, process_add_activity_value, reference_activity_id, activity_name, activity_type)
         except Exception as e:
             log_error(f"Error in process_add_activity_value: {str(e)}")
-            bot.reply_to(message, GENERAL_ERROR_MESSAGE, reply_markup=ReplyKeyboardRemove())
+            flow.close(GENERAL_ERROR_MESSAGE)
 
     # Shared functions
+    def save_activity(user_id, reference_activity_id, value):
+        # Falls back to a direct insert when the stream is unavailable
+        if ACTIVITY_WRITE_BEHIND and activity_stream.enqueue_activity(user_id, reference_activity_id, value):
+            return
+        db.add_activity(user_id, reference_activity_id, value)
+
+    def find_by_id(rows, choice):
+        # Buttons send the bare id, older reply keyboards sent "<id>: <name> ..."
+        try:
+            row_id = int(choice.split(":")[0])
+        except ValueError:
+            return None
+        return next((row for row in rows if row[0] == row_id), None)
+
     def create_reference_activity_keyboard(reference_activities):
-        keyboard = ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-        for reference_activity in reference_activities:
-            activity_id, activity_name, activity_type = reference_activity
-            keyboard.add(f"{activity_id}: {activity_name} ({activity_type})")
-        keyboard.add("Cancel")
-        return keyboard
+        rows = [[(f"{activity_name} ({activity_type})", activity_id)]
+                for activity_id, activity_name, activity_type in reference_activities]
+        return flow_keyboard(*rows, [("Cancel", CANCEL)])
 
-    def prompt_for_activity_value(message: Message, bot: TeleBot, activity_name: str, activity_type: str, keyboard: ReplyKeyboardMarkup):
+    def activity_value_prompt(activity_name, activity_type):
         if activity_type == 'time':
-            bot.reply_to(message, f"How long was {activity_name}? (enter in HH:MM:SS format)\nOr press 'Cancel' to abort.", reply_markup=keyboard)
-        else:
-            bot.reply_to(message, f"How many reps did you do for {activity_name}?\nOr press 'Cancel' to abort.", reply_markup=keyboard)
+            return f"How long was {activity_name}? (enter in HH:MM:SS or MM:SS format)\nOr press 'Cancel' to abort."
+        return f"How many reps did you do for {activity_name}?\nOr press 'Cancel' to abort."
+
+    def prompt_for_activity_value(message: Message, bot: TeleBot, activity_name: str, activity_type: str, keyboard: ReplyKeyboardMarkup):
+        bot.reply_to(message, activity_value_prompt(activity_name, activity_type), reply_markup=keyboard)
 
     def parse_activity_value(value_input, activity_type):
         if activity_type == 'time':
             try:
-                hours, minutes, seconds = map(int, value_input.split(':'))
+                parts = list(map(int, value_input.split(':')))
+                if len(parts) == 2:  # MM:SS
+                    parts.insert(0, 0)
+                hours, minutes, seconds = parts
                 total_seconds = hours * 3600 + minutes * 60 + seconds
                 if total_seconds <= 0:
                     raise ValueError("Duration must be positive")
@@ -307,6 +398,63 @@ def register_handlers(bot: TeleBot):
             log_error(f"Error in format_duration: {str(e)}")
             return "00:00:00"  # Return a default value if there's an error
 
+    UPDATE_ACTIVITY_PROMPT = "Choose an activity to update or press 'Cancel' to abort:"
+    DELETE_ACTIVITY_PROMPT = "Choose an activity to delete:"
+
+    def show_activity_menu(flow: FlowMessage, user_id, prompt, next_step, before=None, after=None):
+        activity_stream.wait_for_pending(user_id)
+        activities, has_older, has_newer = db.get_activities_page(user_id, ACTIVITY_LIMIT, before=before, after=after)
+        if not activities:
+            return False
+
+        rows = []
+        for activity in activities:
+            activity_id, activity_name, value, activity_type, created_at = activity
+            value_str = format_activity_value(value, activity_type)
+            nicosia_time = created_at.astimezone(NICOSIA_TIMEZONE)
+            date_str = nicosia_time.strftime('%b %d %H:%M')
+            rows.append([(f"{activity_name}: {value_str} | {date_str}", activity_id)])
+        navigation = []
+        if has_newer:
+            navigation.append((NEWER_BUTTON, NEWER))
+        if has_older:
+            navigation.append((OLDER_BUTTON, OLDER))
+        # Paging keeps the prompt, so only the keyboard is edited
+        flow.render(prompt, flow_keyboard(*rows, navigation, [("Cancel", CANCEL)]))
+        wait_for_input(flow, next_step, activities)
+        return True
+
+    def page_activity_menu(flow: FlowMessage, telegram_id, direction, activities, prompt, next_step):
+        try:
+            user = db.get_user(telegram_id)
+            if direction == OLDER:
+                shown = show_activity_menu(flow, user[0], prompt, next_step, before=(activities[-1][4], activities[-1][0]))
+            else:
+                shown = show_activity_menu(flow, user[0], prompt, next_step, after=(activities[0][4], activities[0][0]))
+            # The neighbouring page may have been emptied in the meantime
+            if not shown and not show_activity_menu(flow, user[0], prompt, next_step):
+                flow.close(NO_ACTIVITIES_MESSAGE)
+        except Exception as e:
+            log_error(f"Error in page_activity_menu: {str(e)}")
+            flow.close(GENERAL_ERROR_MESSAGE)
+
+    def reshow_activity_menu(flow: FlowMessage, telegram_id, prompt, next_step):
+        # After an invalid choice, from the first page
+        user = db.get_user(telegram_id)
+        if not show_activity_menu(flow, user[0], f"{INVALID_ACTIVITY_SELECTION_MESSAGE}\n\n{prompt}", next_step):
+            flow.close(NO_ACTIVITIES_MESSAGE)
+
+    def update_value_prompt(activity_type, invalid=False):
+        if invalid:
+            if activity_type == 'time':
+                return f"{INVALID_INPUT_MESSAGE}\nEnter valid time (HH:MM:SS), press 'Skip' to keep current, or 'Cancel' to abort:"
+            return f"{INVALID_INPUT_MESSAGE}\nEnter valid number of reps, press 'Skip' to keep current, or 'Cancel' to abort:"
+        if activity_type == 'time':
+            return "Enter new time (HH:MM:SS), press 'Skip' to keep current, or 'Cancel' to abort:"
+        return "Enter new number of reps, press 'Skip' to keep current, or 'Cancel' to abort:"
+
+    UPDATE_DATETIME_PROMPT = "Enter new date and time (YYYY-MM-DD HH:MM:SS), press 'Skip' to keep current, or 'Cancel' to abort:"
+
     @bot.message_handler(commands=['update'])
     def update_activity(message: Message):
         if check_maintenance(message, bot):
@@ -321,116 +469,61 @@ def register_handlers(bot: TeleBot):
                 return
 
             user_id = user[0]  # Assuming the first element of the user tuple is the user_id
-            activities = db.get_recent_activities(user_id, limit=ACTIVITY_LIMIT)
-            
-            if activities:
-                keyboard = ReplyKeyboardMarkup(row_width=1, one_time_keyboard=True, resize_keyboard=True)
-                for activity in activities:
-                    activity_id, activity_name, value, activity_type, created_at = activity
-                    value_str = format_activity_value(value, activity_type)
-                    nicosia_time = created_at.astimezone(NICOSIA_TIMEZONE)
-                    date_str = nicosia_time.strftime('%b %d %H:%M')
-                    keyboard.add(f"{activity_id}: {activity_name}: {value_str} | {date_str}")
-                keyboard.add("Cancel")
-                bot.reply_to(message, "Choose an activity to update or press 'Cancel' to abort:", reply_markup=keyboard)
-                bot.register_next_step_handler(message, process_update_activity_choice, activities)
-            else:
+            flow = FlowMessage.for_message(bot, message)
+            if not show_activity_menu(flow, user_id, UPDATE_ACTIVITY_PROMPT, process_update_activity_choice):
                 bot.reply_to(message, NO_ACTIVITIES_MESSAGE)
         except Exception as e:
             log_error(f"Error in update_activity: {str(e)}")
             bot.reply_to(message, GENERAL_ERROR_MESSAGE)
 
-    def process_update_activity_choice(message: Message, activities):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-
-        choice = message.text.strip()
-        if choice.lower() == "cancel":
-            bot.reply_to(message, OPERATION_CANCELLED_MESSAGE, reply_markup=ReplyKeyboardRemove())
-            return
+    def process_update_activity_choice(flow: FlowMessage, telegram_id, choice, activities):
+        if choice in (OLDER, NEWER):
+            return page_activity_menu(flow, telegram_id, choice, activities, UPDATE_ACTIVITY_PROMPT, process_update_activity_choice)
         
         try:
-            activity_id = int(choice.split(":")[0])
-            chosen_activity = next((act for act in activities if act[0] == activity_id), None)
-            
+            chosen_activity = find_by_id(activities, choice)
             if not chosen_activity:
-                raise ValueError(INVALID_ACTIVITY_SELECTION_MESSAGE)
+                log_error(f"Error in process_update_activity_choice: invalid choice {choice!r}")
+                return reshow_activity_menu(flow, telegram_id, UPDATE_ACTIVITY_PROMPT, process_update_activity_choice)
             
             activity_id, activity_name, current_value, activity_type, created_at = chosen_activity
             
-            keyboard = ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-            keyboard.add("Skip", "Cancel")
-            
-            if activity_type == 'time':
-                bot.reply_to(message, f"Updating: {activity_name}\nCurrent: {format_activity_value(current_value, activity_type)}\nEnter new time (HH:MM:SS), press 'Skip' to keep current, or 'Cancel' to abort:", reply_markup=keyboard)
-            else:
-                bot.reply_to(message, f"Updating: {activity_name}\nCurrent: {current_value} reps\nEnter new number of reps, press 'Skip' to keep current, or 'Cancel' to abort:", reply_markup=keyboard)
-            bot.register_next_step_handler(message, process_update_activity_value, activity_id, activity_type, current_value, created_at)
-        except ValueError as e:
-            log_error(f"Error in process_update_activity_choice: {str(e)}")
-            bot.reply_to(message, INVALID_ACTIVITY_SELECTION_MESSAGE)
-            return update_activity(message)
+            flow.render(f"Updating: {activity_name}\nCurrent: {format_activity_value(current_value, activity_type)}\n"
+                        f"{update_value_prompt(activity_type)}", cancel_keyboard(skip=True))
+            wait_for_input(flow, process_update_activity_value, activity_id, activity_type, current_value, created_at)
         except Exception as e:
             log_error(f"Error in process_update_activity_choice: {str(e)}")
-            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
+            flow.close(GENERAL_ERROR_MESSAGE)
 
-    def process_update_activity_value(message: Message, activity_id, activity_type, current_value, created_at):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-        
-        new_value = message.text.strip()
-        telegram_id = message.from_user.id
-        
-        if new_value.lower() == "cancel":
-            bot.reply_to(message, OPERATION_CANCELLED_MESSAGE, reply_markup=ReplyKeyboardRemove())
-            return
-        elif new_value.lower() == "skip":
+    def process_update_activity_value(flow: FlowMessage, telegram_id, new_value, activity_id, activity_type, current_value, created_at):
+        if new_value.lower() == SKIP:
             new_value = current_value
         else:
             try:
                 new_value = parse_activity_value(new_value, activity_type)
             except ValueError as e:
                 log_error(f"Error in process_update_activity_value: {str(e)}")
-                bot.reply_to(message, INVALID_INPUT_MESSAGE)
-                keyboard = ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-                keyboard.add("Skip", "Cancel")
-                if activity_type == 'time':
-                    bot.reply_to(message, "Enter valid time (HH:MM:SS), press 'Skip' to keep current, or 'Cancel' to abort:", reply_markup=keyboard)
-                else:
-                    bot.reply_to(message, "Enter valid number of reps, press 'Skip' to keep current, or 'Cancel' to abort:", reply_markup=keyboard)
-                return bot.register_next_step_handler(message, process_update_activity_value, activity_id, activity_type, current_value, created_at)
+                flow.render(update_value_prompt(activity_type, invalid=True), cancel_keyboard(skip=True))
+                return wait_for_input(flow, process_update_activity_value, activity_id, activity_type, current_value, created_at)
         
         # Move to updating the datetime
-        keyboard = ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-        keyboard.add("Skip", "Cancel")
-        bot.reply_to(message, "Enter new date and time (YYYY-MM-DD HH:MM:SS), press 'Skip' to keep current, or 'Cancel' to abort:", reply_markup=keyboard)
-        bot.register_next_step_handler(message, process_update_activity_datetime, activity_id, activity_type, new_value, created_at)
+        flow.render(UPDATE_DATETIME_PROMPT, cancel_keyboard(skip=True))
+        wait_for_input(flow, process_update_activity_datetime, activity_id, activity_type, new_value, created_at)
 
-    def process_update_activity_datetime(message: Message, activity_id, activity_type, new_value, current_datetime):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-        
-        new_datetime_str = message.text.strip()
-        telegram_id = message.from_user.id
-        
-        if new_datetime_str.lower() == "cancel":
-            bot.reply_to(message, OPERATION_CANCELLED_MESSAGE, reply_markup=ReplyKeyboardRemove())
-            return
-        elif new_datetime_str.lower() == "skip":
+    def process_update_activity_datetime(flow: FlowMessage, telegram_id, new_datetime_str, activity_id, activity_type, new_value, current_datetime):
+        if new_datetime_str.lower() == SKIP:
             new_datetime = current_datetime  # Keep the original datetime            
         else:
             try:
                 new_datetime = datetime.strptime(new_datetime_str, '%Y-%m-%d %H:%M:%S')
             except ValueError:
                 log_error(f"Error parsing datetime: {new_datetime_str}")
-                bot.reply_to(message, "Invalid date format. Please use YYYY-MM-DD HH:MM:SS.")
-                return bot.register_next_step_handler(message, process_update_activity_datetime, activity_id, activity_type, new_value, current_datetime)
+                flow.render(f"Invalid date format. Please use YYYY-MM-DD HH:MM:SS.\n{UPDATE_DATETIME_PROMPT}", cancel_keyboard(skip=True))
+                return wait_for_input(flow, process_update_activity_datetime, activity_id, activity_type, new_value, current_datetime)
+            now = datetime.now()
+            if not now - timedelta(days=MAX_BACKDATE_DAYS) <= new_datetime <= now:
+                flow.render(f"{INVALID_ACTIVITY_DATE_MESSAGE}\n{UPDATE_DATETIME_PROMPT}", cancel_keyboard(skip=True))
+                return wait_for_input(flow, process_update_activity_datetime, activity_id, activity_type, new_value, current_datetime)
         
         try:
             user = db.get_user(telegram_id)
@@ -442,13 +535,13 @@ def register_handlers(bot: TeleBot):
                 date_str = localized_datetime.strftime('%Y-%m-%d %H:%M:%S')
                 update_message = f"Updated: Value: {value_str}, Date/Time: {date_str}"
                 log_info(f"Activity updated successfully: {update_message}")
-                bot.reply_to(message, update_message, reply_markup=ReplyKeyboardRemove())
+                flow.close(update_message)
             else:
                 log_error(f"Failed to update activity. activity_id: {activity_id}, user_id: {user[0]}, new_value: {new_value}, new_datetime: {new_datetime}")
-                bot.reply_to(message, FAILED_TO_UPDATE_ACTIVITY_MESSAGE, reply_markup=ReplyKeyboardRemove())
+                flow.close(FAILED_TO_UPDATE_ACTIVITY_MESSAGE)
         except Exception as e:
             log_error(f"Error in process_update_activity_datetime: {str(e)}")
-            bot.reply_to(message, GENERAL_ERROR_MESSAGE, reply_markup=ReplyKeyboardRemove())
+            flow.close(GENERAL_ERROR_MESSAGE)
 
     @bot.message_handler(commands=['delete'])
     def delete_activity(message: Message):
@@ -458,81 +551,49 @@ def register_handlers(bot: TeleBot):
         
         try:
             user = db.get_user(telegram_id)
-            activities = db.get_recent_activities(user[0], limit=10)  # Get last 5 activities
-            
-            if activities:
-                keyboard = ReplyKeyboardMarkup(row_width=1, one_time_keyboard=True, resize_keyboard=True)
-                for activity in activities:
-                    activity_id, activity_name, value, activity_type, created_at = activity
-                    value_str = format_activity_value(value, activity_type)
-                    nicosia_time = created_at.astimezone(NICOSIA_TIMEZONE)
-                    date_str = nicosia_time.strftime('%b %d %H:%M')
-                    keyboard.add(f"{activity_id}: {activity_name}: {value_str} | {date_str}")
-                keyboard.add("Cancel")
-                bot.reply_to(message, "Choose an activity to delete:", reply_markup=keyboard)
-                bot.register_next_step_handler(message, process_delete_activity_choice, activities)
-            else:
+            flow = FlowMessage.for_message(bot, message)
+            if not show_activity_menu(flow, user[0], DELETE_ACTIVITY_PROMPT, process_delete_activity_choice):
                 bot.reply_to(message, NO_ACTIVITIES_MESSAGE)
         except Exception as e:
             log_error(f"Error in delete_activity: {str(e)}")
             bot.reply_to(message, GENERAL_ERROR_MESSAGE)
 
-    def process_delete_activity_choice(message: Message, activities):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-        
-        choice = message.text.strip()
-        if choice == "Cancel":
-            bot.reply_to(message, OPERATION_CANCELLED_MESSAGE, reply_markup=ReplyKeyboardRemove())
-            return
+    def process_delete_activity_choice(flow: FlowMessage, telegram_id, choice, activities):
+        if choice in (OLDER, NEWER):
+            return page_activity_menu(flow, telegram_id, choice, activities, DELETE_ACTIVITY_PROMPT, process_delete_activity_choice)
         
         try:
-            activity_id = int(choice.split(":")[0])
-            chosen_activity = next((act for act in activities if act[0] == activity_id), None)
-            
+            chosen_activity = find_by_id(activities, choice)
             if not chosen_activity:
-                raise ValueError(INVALID_ACTIVITY_SELECTION_MESSAGE)
+                log_error(f"Error in process_delete_activity_choice: invalid choice {choice!r}")
+                return reshow_activity_menu(flow, telegram_id, DELETE_ACTIVITY_PROMPT, process_delete_activity_choice)
             
             activity_id, activity_name, value, activity_type, created_at = chosen_activity
             
             # Ask for confirmation
-            keyboard = ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-            keyboard.add("Yes", "No")
-            bot.reply_to(message, f"Are you sure you want to delete the activity '{activity_name}'?", reply_markup=keyboard)
-            bot.register_next_step_handler(message, confirm_delete_activity, activity_id, activity_name)
-        except ValueError as e:
-            log_error(f"Error in process_delete_activity_choice: {str(e)}")
-            bot.reply_to(message, INVALID_ACTIVITY_SELECTION_MESSAGE)
-            return delete_activity(message)
+            flow.render(f"Are you sure you want to delete the activity '{activity_name}'?", YES_NO_KEYBOARD)
+            wait_for_input(flow, confirm_delete_activity, activity_id, activity_name)
         except Exception as e:
             log_error(f"Error in process_delete_activity_choice: {str(e)}")
-            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
+            flow.close(GENERAL_ERROR_MESSAGE)
 
-    def confirm_delete_activity(message: Message, activity_id: int, activity_name: str):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-        
-        confirmation = message.text.strip().lower()
-        if confirmation == 'yes':
+    def confirm_delete_activity(flow: FlowMessage, telegram_id, confirmation, activity_id: int, activity_name: str):
+        if confirmation.lower() == 'yes':
             try:
-                log_info(f"Attempting to delete activity {activity_id} for user {message.from_user.id}")
-                user = db.get_user(message.from_user.id)
+                log_info(f"Attempting to delete activity {activity_id} for user {telegram_id}")
+                user = db.get_user(telegram_id)
                 success = db.delete_activity(activity_id, user[0])
                 if success:
-                    log_info(f"Successfully deleted activity {activity_id} for user {message.from_user.id}")
-                    bot.reply_to(message, f"Activity '{activity_name}' has been deleted successfully!", reply_markup=ReplyKeyboardRemove())
+                    log_info(f"Successfully deleted activity {activity_id} for user {telegram_id}")
+                    flow.close(f"Activity '{activity_name}' has been deleted successfully!")
                 else:
-                    log_error(f"Failed to delete activity {activity_id} for user {message.from_user.id}")
-                    bot.reply_to(message, FAILED_TO_DELETE_ACTIVITY_MESSAGE, reply_markup=ReplyKeyboardRemove())
+                    log_error(f"Failed to delete activity {activity_id} for user {telegram_id}")
+                    flow.close(FAILED_TO_DELETE_ACTIVITY_MESSAGE)
             except Exception as e:
                 log_error(f"Error in confirm_delete_activity: {str(e)}")
-                bot.reply_to(message, GENERAL_ERROR_MESSAGE, reply_markup=ReplyKeyboardRemove())
+                flow.close(GENERAL_ERROR_MESSAGE)
         else:
-            bot.reply_to(message, OPERATION_CANCELLED_MESSAGE, reply_markup=ReplyKeyboardRemove())
+            flow.close(OPERATION_CANCELLED_MESSAGE)
 
     @bot.message_handler(commands=['list'])
     def list_activities(message: Message):
@@ -542,33 +603,66 @@ def register_handlers(bot: TeleBot):
         
         try:
             user = db.get_user(telegram_id)
-            activities = db.get_recent_activities(user[0], limit=10)  # Get recent activities
-            
-            if activities:
-                table_data = []
-                headers = ["Activity", "Value", "Date"]
-                
-                for activity in activities:
-                    try:
-                        activity_id, activity_name, value, activity_type, created_at = activity
-                        value_str = format_activity_value(value, activity_type)
-                        nicosia_time = created_at.astimezone(NICOSIA_TIMEZONE)
-                        date_str = nicosia_time.strftime('%b %d %H:%M')
-                        
-                        table_data.append([activity_name, value_str, date_str])
-                    except Exception as e:
-                        log_error(f"Error formatting activity {activity[0]}: {str(e)}")
-                
-                table = tabulate(table_data, headers=headers, tablefmt="pipe")
-                response = "Recent activities:\n\n" + table
-            else:
-                response = "No activities logged yet."
-            
-            bot.reply_to(message, f"```\n{response}\n```", parse_mode='Markdown')
+            response, keyboard = render_activity_list(user[0])
+            bot.reply_to(message, response, parse_mode='Markdown', reply_markup=keyboard)
         except Exception as e:
             log_error(f"Error in list_activities: {str(e)}")
             bot.reply_to(message, GENERAL_ERROR_MESSAGE)
 
+    @bot.callback_query_handler(func=lambda call: call.data.startswith(LIST_CALLBACK_PREFIX))
+    def list_activities_page(call: CallbackQuery):
+        if check_maintenance_callback(call, bot):
+            return
+        try:
+            _, direction, cursor = call.data.split(":", 2)
+            user = db.get_user(call.from_user.id)
+            if direction == "older":
+                response, keyboard = render_activity_list(user[0], before=decode_cursor(cursor))
+            else:
+                response, keyboard = render_activity_list(user[0], after=decode_cursor(cursor))
+            bot.edit_message_text(response, call.message.chat.id, call.message.message_id,
+                                  parse_mode='Markdown', reply_markup=keyboard)
+            bot.answer_callback_query(call.id)
+        except Exception as e:
+            log_error(f"Error in list_activities_page: {str(e)}")
+            bot.answer_callback_query(call.id, GENERAL_ERROR_MESSAGE)
+
+    def render_activity_list(user_id, before=None, after=None):
+        activity_stream.wait_for_pending(user_id)
+        activities, has_older, has_newer = db.get_activities_page(user_id, LIST_PAGE_SIZE, before=before, after=after)
+
+        if not activities:
+            return "```\nNo activities logged yet.\n```", None
+
+        table_data = []
+        headers = ["Activity", "Value", "Date"]
+
+        for activity in activities:
+            try:
+                activity_id, activity_name, value, activity_type, created_at = activity
+                value_str = format_activity_value(value, activity_type)
+                nicosia_time = created_at.astimezone(NICOSIA_TIMEZONE)
+                date_str = nicosia_time.strftime('%b %d %H:%M')
+
+                table_data.append([activity_name, value_str, date_str])
+            except Exception as e:
+                log_error(f"Error formatting activity {activity[0]}: {str(e)}")
+
+        table = tabulate(table_data, headers=headers, tablefmt="pipe")
+        title = "Recent activities:" if not has_newer else "Older activities:"
+        response = f"```\n{title}\n\n{table}\n```"
+
+        buttons = []
+        if has_newer:
+            buttons.append(InlineKeyboardButton(NEWER_BUTTON, callback_data=f"{LIST_CALLBACK_PREFIX}newer:{encode_cursor(activities[0])}"))
+        if has_older:
+            buttons.append(InlineKeyboardButton(OLDER_BUTTON, callback_data=f"{LIST_CALLBACK_PREFIX}older:{encode_cursor(activities[-1])}"))
+        keyboard = None
+        if buttons:
+            keyboard = InlineKeyboardMarkup()
+            keyboard.row(*buttons)
+        return response, keyboard
+
     @bot.message_handler(commands=['stats'])
     def get_stats(message: Message):
         if check_maintenance(message, bot):
@@ -576,26 +670,11 @@ def register_handlers(bot: TeleBot):
         telegram_id = message.from_user.id
         try:
             user = db.get_user(telegram_id)
-            
-            total_activities = db.get_total_activities_count(user[0])
-            unique_activities = db.get_unique_activities_count(user[0])
-            activities = db.get_all_activities(user[0])
-            activity_streaks = db.get_activity_streaks(user[0])
-
-            log_info(f"Total activities: {total_activities}")
-            log_info(f"Unique activities: {unique_activities}")
-            log_info(f"All activities: {activities}")
-            log_info(f"Activity streaks: {activity_streaks}")
-
-            # Calculate totals
-            activity_totals, total_reps, total_duration = calculate_activity_totals(activities)
-
-            # Calculate days left until 100 for each activity
-            days_left = calculate_days_left(activity_streaks)
+            trends, challenge = load_trends(user[0])
+            log_info(f"Activity trends: {len(trends)} activities")
 
             # Format the response
-            stats_message = format_stats_message(total_activities, unique_activities, 
-                                                 total_reps, total_duration, activity_totals, activity_streaks, days_left)
+            stats_message = format_stats_message(trends, challenge)
 
             bot.reply_to(message, stats_message)
             log_info(f"Stats retrieved for user {telegram_id}")
@@ -603,119 +682,190 @@ def register_handlers(bot: TeleBot):
             log_error(f"Error in get_stats for user {telegram_id}: {str(e)}")
             bot.reply_to(message, GENERAL_ERROR_MESSAGE)
 
-    def calculate_activity_totals(activities):
-        activity_totals = {}
-        total_reps = 0
-        total_duration = 0
-        for activity in activities:
-            activity_id, activity_name, value, activity_type, created_at = activity
-            
-            if activity_type == 'reps':
-                total_reps += value
-            else:  # 'time'
-                total_duration += value
+    @bot.message_handler(commands=['trends'])
+    def get_trends(message: Message):
+        if check_maintenance(message, bot):
+            return
+        telegram_id = message.from_user.id
+        try:
+            user = db.get_user(telegram_id)
+            trends, challenge = load_trends(user[0])
+            if not trends:
+                bot.reply_to(message, NO_ACTIVITIES_MESSAGE)
+                return
+            bot.reply_to(message, format_trends_message(trends, challenge))
+            log_info(f"Trends retrieved for user {telegram_id}")
+        except Exception as e:
+            log_error(f"Error in get_trends for user {telegram_id}: {str(e)}")
+            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
 
-            if activity_name not in activity_totals:
-                activity_totals[activity_name] = {'reps': 0, 'time': 0}
-            activity_totals[activity_name][activity_type] += value
-        
-        return activity_totals, total_reps, total_duration
+    def load_trends(user_id):
+        """Trends of the user's current challenge (or of all their history) and that challenge."""
+        activity_stream.wait_for_pending(user_id)
+        challenge = db.get_current_challenge(user_id)
+        today = datetime.now(NICOSIA_TIMEZONE).date()
+        if challenge:
+            _, _, start_date, end_date, target_days, _ = challenge
+            history = analytics.ActivityHistory(db.get_reference_activities(user_id),
+                                                *db.get_activity_history(user_id, start_date, end_date))
+            trends = analytics.compute_trends(history, min(today, end_date), challenge_days=target_days,
+                                              start_date=start_date)
+            return trends, challenge
+        history = analytics.ActivityHistory(db.get_reference_activities(user_id), *db.get_activity_history(user_id))
+        return analytics.compute_trends(history, today), None
 
-    def calculate_days_left(activity_streaks):
-        days_left = {}
-        for streak in activity_streaks:
-            try:
-                activity_name = streak[3]
-                days_active = streak[4]  # This is the number of days active
-                days_left[activity_name] = max(0, 100 - days_active)
-            except IndexError as e:
-                log_error(f"Error processing streak data: {streak}. Error: {str(e)}")
-        return days_left
-
-    def format_stats_message(total_activities, unique_activities, total_reps, total_duration, activity_totals, activity_streaks, days_left):
+    def format_challenge_header(challenge):
+        _, name, start_date, end_date, target_days, _ = challenge
+        today = datetime.now(NICOSIA_TIMEZONE).date()
+        if today < start_date:
+            progress = f"starts {start_date:%b %d}"
+        elif today > end_date:
+            progress = "finished"
+        else:
+            progress = f"day {(today - start_date).days + 1} of {(end_date - start_date).days + 1}"
+        return f"🎯 {name} ({start_date:%b %d} - {end_date:%b %d}, {progress}, goal {target_days} active days)\n"
+
+    @bot.message_handler(commands=['chart'])
+    def send_chart(message: Message):
+        if check_maintenance(message, bot):
+            return
+        telegram_id = message.from_user.id
+        try:
+            user = db.get_user(telegram_id)
+            activity_stream.wait_for_pending(user[0])
+            first_day = charts.chart_first_day()
+            rows = db.get_daily_activity_totals(user[0], first_day)
+            if not rows:
+                bot.reply_to(message, NO_ACTIVITIES_MESSAGE)
+                return
+
+            # An unchanged chart is resent by file_id, without a worker round trip
+            key = charts.chart_key(rows, first_day)
+            file_id = charts.get_cached_file_id(key)
+            if file_id:
+                bot.send_photo(message.chat.id, file_id, reply_to_message_id=message.message_id)
+                return
+            if not charts.claim_render(key):
+                bot.reply_to(message, CHART_IN_PROGRESS_MESSAGE)
+                return
+            bot.send_chat_action(message.chat.id, 'upload_photo')
+            send_progress_chart.delay(message.chat.id, user[0], key, message.message_id)
+            log_info(f"Chart requested by user {telegram_id}")
+        except Exception as e:
+            log_error(f"Error in send_chart for user {telegram_id}: {str(e)}")
+            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
+
+    def format_trend_value(value, activity_type):
+        if activity_type == 'time':
+            return format_duration(value)
+        return f"{value:g}" if isinstance(value, float) else str(value)
+
+    def format_stats_message(trends, challenge=None):
+        total_reps, total_duration = analytics.totals_by_type(trends)
         stats_message = "📊 Your Fitness Challenge Statistics:\n\n"
+        if challenge:
+            stats_message += format_challenge_header(challenge) + "\n"
         
         # Overall statistics
-        stats_message += f"Total activities logged: {total_activities}\n"
-        stats_message += f"Unique activities: {unique_activities}\n"
+        stats_message += f"Total activities logged: {sum(trend['entries'] for trend in trends)}\n"
+        stats_message += f"Unique activities: {len(trends)}\n"
         stats_message += f"Total reps across all activities: {total_reps}\n"
         stats_message += f"Total duration across all activities: {format_duration(total_duration)}\n\n"
         
         stats_message += "Activity Statistics:\n"
-        for activity, totals in activity_totals.items():
-            stats_message += f"\n{activity}:\n"
-            if totals['reps'] > 0:
-                stats_message += f"  • Total reps: {totals['reps']}\n"
-            if totals['time'] > 0:
-                stats_message += f"  • Total duration: {format_duration(totals['time'])}\n"
-            
-            if activity in days_left:
-                stats_message += f"  • Days left in challenge: {days_left[activity]}\n"
-            
-            streak = next((s for s in activity_streaks if s[3] == activity), None)
-            if streak:
-                days_active = streak[4]
-                stats_message += f"  • Days active: {days_active}\n"
-            
-            last_activity = db.get_last_activity(activity)
-            if last_activity:
-                nicosia_time = last_activity[2].astimezone(NICOSIA_TIMEZONE)
-                formatted_time = nicosia_time.strftime('%b %d at %H:%M')
-                stats_message += f"  • Last performed: {formatted_time}\n"
+        for trend in trends:
+            activity_type = trend['type']
+            stats_message += f"\n{trend['name']}:\n"
+            if activity_type == 'reps':
+                stats_message += f"  • Total reps: {trend['total']}\n"
+            else:
+                stats_message += f"  • Total duration: {format_duration(trend['total'])}\n"
+            stats_message += f"  • Days left in challenge: {trend['days_left']}\n"
+            stats_message += f"  • Days active: {trend['days_active']}\n"
+            if trend['current_streak']:
+                stats_message += f"  • Current streak: {trend['current_streak']} days\n"
+            stats_message += f"  • 7-day average: {format_trend_value(round(trend['average_7'], 1), activity_type)}\n"
+            stats_message += f"  • Personal best: {format_trend_value(trend['best_entry'], activity_type)}\n"
+            formatted_time = trend['last_performed'].strftime('%b %d at %H:%M')
+            stats_message += f"  • Last performed: {formatted_time}\n"
         
         return stats_message
 
+    def format_trends_message(trends, challenge=None):
+        trends_message = f"📈 Your trends (last {analytics.TREND_WEEKS} weeks, oldest first):\n"
+        if challenge:
+            trends_message += format_challenge_header(challenge)
+        challenge_days = challenge[4] if challenge else analytics.CHALLENGE_DAYS
+        for trend in trends:
+            activity_type = trend['type']
+            weekly = " · ".join(format_trend_value(volume, activity_type) for volume in trend['weekly'])
+            this_week, last_week = trend['weekly'][-1], trend['weekly'][-2]
+            if last_week:
+                change = f"{(this_week - last_week) * 100 / last_week:+.0f}%"
+            else:
+                change = "new" if this_week else "-"
+            direction = "▲" if trend['average_7'] > trend['previous_average_7'] else "▼" if trend['average_7'] < trend['previous_average_7'] else "="
+
+            trends_message += f"\n{trend['name']} ({activity_type}):\n"
+            trends_message += f"  • Weekly volume: {weekly}\n"
+            trends_message += f"  • This week: {format_trend_value(this_week, activity_type)} ({change} vs last week)\n"
+            trends_message += (f"  • Daily average: {format_trend_value(round(trend['average_7'], 1), activity_type)} over 7 days {direction}, "
+                               f"{format_trend_value(round(trend['average_30'], 1), activity_type)} over 30 days\n")
+            trends_message += (f"  • Records: best entry {format_trend_value(trend['best_entry'], activity_type)}, "
+                               f"best day {format_trend_value(trend['best_day'], activity_type)}\n")
+            if trend['days_left'] == 0:
+                trends_message += f"  • Pace: {challenge_days} days done!\n"
+            elif trend['projected_finish']:
+                trends_message += (f"  • Pace: {trend['active_days_per_week']:.1f} days/week, "
+                                   f"{trend['days_left']} days left, on track for {trend['projected_finish'].strftime('%b %d')}\n")
+            else:
+                trends_message += f"  • Pace: no activity in the last {analytics.PACE_WINDOW} days, {trend['days_left']} days left\n"
+        return trends_message
+
+    ADD_REFERENCE_NAME_PROMPT = "Please enter the name of an activity:"
+    ADD_REFERENCE_TYPE_PROMPT = "Please select the type of the reference activity:"
+    TYPE_KEYBOARD = flow_keyboard([("Reps", "reps"), ("Time", "time")], [("Cancel", CANCEL)])
+
     @bot.message_handler(commands=['addref'])
     def add_reference_activity(message: Message):
         try:
             if check_maintenance(message, bot):
                 return
-            bot.reply_to(message, "Please enter the name of an activity:")
-            bot.register_next_step_handler(message, process_add_reference_activity_name)
+            flow = FlowMessage.for_message(bot, message)
+            flow.render(ADD_REFERENCE_NAME_PROMPT, cancel_keyboard())
+            wait_for_input(flow, process_add_reference_activity_name)
             log_info(f"Started add reference activity process for user {message.from_user.id}")
         except Exception as e:
             log_error(f"Error in add_reference_activity: {str(e)}")
             bot.reply_to(message, GENERAL_ERROR_MESSAGE)
 
-    def process_add_reference_activity_name(message: Message):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
+    def process_add_reference_activity_name(flow: FlowMessage, telegram_id, activity_name):
+        if not activity_name:
+            flow.render(ADD_REFERENCE_NAME_PROMPT, cancel_keyboard())
+            return wait_for_input(flow, process_add_reference_activity_name)
         
-        activity_name = message.text.strip()
-        
-        # Create a keyboard with two buttons: "Reps" and "Time"
-        keyboard = ReplyKeyboardMarkup(row_width=2, resize_keyboard=True)
-        keyboard.add(KeyboardButton("Reps"), KeyboardButton("Time"))
-        
-        bot.send_message(message.chat.id, "Please select the type of the reference activity:", reply_markup=keyboard)
-        bot.register_next_step_handler(message, process_add_reference_activity_type, activity_name)
+        flow.render(f"Activity: {activity_name}\n{ADD_REFERENCE_TYPE_PROMPT}", TYPE_KEYBOARD)
+        wait_for_input(flow, process_add_reference_activity_type, activity_name)
 
         # Log the action for debugging
-        log_info(f"Sent keyboard for activity type selection to user {message.from_user.id}")
+        log_info(f"Sent keyboard for activity type selection to user {telegram_id}")
 
-    def process_add_reference_activity_type(message: Message, activity_name):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-        
-        activity_type = message.text.strip().lower()
+    def process_add_reference_activity_type(flow: FlowMessage, telegram_id, activity_type, activity_name):
+        activity_type = activity_type.lower()
         if activity_type not in ['reps', 'time']:
-            bot.reply_to(message, "Invalid activity type. Please select either 'Reps' or 'Time'.")
-            log_error(f"Invalid activity type '{activity_type}' selected by user {message.from_user.id}")
-            return process_add_reference_activity_name(message)
+            log_error(f"Invalid activity type '{activity_type}' selected by user {telegram_id}")
+            flow.render(f"Invalid activity type. Please select either 'Reps' or 'Time'.\n{ADD_REFERENCE_TYPE_PROMPT}", TYPE_KEYBOARD)
+            return wait_for_input(flow, process_add_reference_activity_type, activity_name)
         
         try:
-            user = db.get_user(message.from_user.id)
+            user = db.get_user(telegram_id)
             db.add_reference_activity(user[0], activity_name, activity_type)
-            bot.reply_to(message, f"Reference activity '{activity_name}' ({activity_type}) added successfully!", reply_markup=ReplyKeyboardRemove())
-            log_info(f"Reference activity '{activity_name}' ({activity_type}) added successfully by user {message.from_user.id}")
+            flow.close(f"Reference activity '{activity_name}' ({activity_type}) added successfully!")
+            log_info(f"Reference activity '{activity_name}' ({activity_type}) added successfully by user {telegram_id}")
         except Exception as e:
-            error_message = f"Error in process_add_reference_activity_type for user {message.from_user.id}: {str(e)}"
+            error_message = f"Error in process_add_reference_activity_type for user {telegram_id}: {str(e)}"
             log_error(error_message)
-            bot.reply_to(message, GENERAL_ERROR_MESSAGE, reply_markup=ReplyKeyboardRemove())
+            flow.close(GENERAL_ERROR_MESSAGE)
 
     @bot.message_handler(commands=['listref'])
     def list_reference_activities(message: Message):
@@ -745,6 +895,10 @@ def register_handlers(bot: TeleBot):
             log_error(f"Error in list_reference_activities: {str(e)}")
             bot.reply_to(message, GENERAL_ERROR_MESSAGE)
 
+    UPDATE_REFERENCE_PROMPT = "Choose a reference activity to update or press 'Cancel' to exit:"
+    DELETE_REFERENCE_PROMPT = "Choose a reference activity to delete:"
+    UPDATE_TYPE_KEYBOARD = flow_keyboard([("Time", "time"), ("Reps", "reps")], [("Skip", SKIP), ("Cancel", CANCEL)])
+
     @bot.message_handler(commands=['updateref'])
     def update_reference_activity(message: Message):
         if check_maintenance(message, bot):
@@ -756,94 +910,61 @@ def register_handlers(bot: TeleBot):
             reference_activities = db.get_reference_activities_without_activities(user[0])  # Get all reference activities
             
             if reference_activities:
-                keyboard = ReplyKeyboardMarkup(row_width=1, one_time_keyboard=True, resize_keyboard=True)
-                for reference_activity in reference_activities:
-                    activity_id, activity_name, activity_type = reference_activity
-                    keyboard.add(f"{activity_id}: {activity_name} ({activity_type})")
-                keyboard.add("Cancel")
-                bot.reply_to(message, "Choose a reference activity to update or press 'Cancel' to exit:", reply_markup=keyboard)
-                bot.register_next_step_handler(message, process_update_reference_activity_choice, reference_activities)
+                keyboard = user_cache.get_or_set(user[0], 'unused_reference_activities:flow_keyboard',
+                                                 lambda: create_reference_activity_keyboard(reference_activities).to_json())
+                flow = FlowMessage.for_message(bot, message)
+                flow.render(UPDATE_REFERENCE_PROMPT, keyboard)
+                wait_for_input(flow, process_update_reference_activity_choice, reference_activities)
             else:
                 bot.reply_to(message, "You don't have any reference activities to update.")
         except Exception as e:
             log_error(f"Error in update_reference_activity: {str(e)}")
             bot.reply_to(message, GENERAL_ERROR_MESSAGE)
 
-    def process_update_reference_activity_choice(message: Message, reference_activities):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-        
-        choice = message.text.strip()
-        if choice.lower() == "cancel":
-            bot.reply_to(message, OPERATION_CANCELLED_MESSAGE, reply_markup=ReplyKeyboardRemove())
-            return
-        
+    def process_update_reference_activity_choice(flow: FlowMessage, telegram_id, choice, reference_activities):
         try:
-            activity_id = int(choice.split(":")[0])
-            reference_activity = next((act for act in reference_activities if act[0] == activity_id), None)
-            
+            reference_activity = find_by_id(reference_activities, choice)
             if not reference_activity:
-                raise ValueError(INVALID_ACTIVITY_SELECTION_MESSAGE)
+                flow.render(f"{INVALID_ACTIVITY_SELECTION_MESSAGE}\n\n{UPDATE_REFERENCE_PROMPT}",
+                            create_reference_activity_keyboard(reference_activities))
+                return wait_for_input(flow, process_update_reference_activity_choice, reference_activities)
             
             activity_id, current_name, current_type = reference_activity
             
-            keyboard = ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-            keyboard.add("Skip", "Cancel")
-            bot.reply_to(message, f"Updating reference activity: {current_name}\nCurrent type: {current_type}\nEnter new name, press 'Skip' to keep current, or 'Cancel' to exit:", reply_markup=keyboard)
-            bot.register_next_step_handler(message, process_update_reference_activity_name, activity_id, current_name, current_type)
+            flow.render(f"Updating reference activity: {current_name}\nCurrent type: {current_type}\nEnter new name, press 'Skip' to keep current, or 'Cancel' to exit:",
+                        cancel_keyboard(skip=True))
+            wait_for_input(flow, process_update_reference_activity_name, activity_id, current_name, current_type)
         except Exception as e:
             log_error(f"Error in process_update_reference_activity_choice: {str(e)}")
-            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
-            return update_reference_activity(message)
+            flow.close(GENERAL_ERROR_MESSAGE)
 
-    def process_update_reference_activity_name(message: Message, activity_id, current_name, current_type):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-        
-        new_name = message.text.strip()
-        if new_name.lower() == 'cancel':
-            bot.reply_to(message, OPERATION_CANCELLED_MESSAGE, reply_markup=ReplyKeyboardRemove())
-            return
-        if new_name.lower() == 'skip':
+    def process_update_reference_activity_name(flow: FlowMessage, telegram_id, new_name, activity_id, current_name, current_type):
+        if not new_name or new_name.lower() == SKIP:
             new_name = current_name
         
-        keyboard = ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-        keyboard.add("Time", "Reps", "Skip", "Cancel")
-        bot.reply_to(message, f"Current type: {current_type}\nSelect new type, press 'Skip' to keep current, or 'Cancel' to exit:", reply_markup=keyboard)
-        bot.register_next_step_handler(message, process_update_reference_activity_type, activity_id, new_name, current_type)
+        flow.render(f"Current type: {current_type}\nSelect new type, press 'Skip' to keep current, or 'Cancel' to exit:", UPDATE_TYPE_KEYBOARD)
+        wait_for_input(flow, process_update_reference_activity_type, activity_id, new_name, current_type)
 
-    def process_update_reference_activity_type(message: Message, activity_id, new_name, current_type):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-        
-        new_type = message.text.strip().lower()
-        if new_type == 'cancel':
-            bot.reply_to(message, OPERATION_CANCELLED_MESSAGE, reply_markup=ReplyKeyboardRemove())
-            return
-        if new_type not in ['time', 'reps', 'skip']:
-            bot.reply_to(message, "Invalid type. Please select either 'time', 'reps', 'Skip' to keep the current type, or 'Cancel' to exit.")
-            return process_update_reference_activity_name(message, activity_id, new_name, current_type)
+    def process_update_reference_activity_type(flow: FlowMessage, telegram_id, new_type, activity_id, new_name, current_type):
+        new_type = new_type.lower()
+        if new_type not in ['time', 'reps', SKIP]:
+            flow.render(f"Invalid type. Please select either 'time', 'reps', 'Skip' to keep the current type, or 'Cancel' to exit.\nCurrent type: {current_type}",
+                        UPDATE_TYPE_KEYBOARD)
+            return wait_for_input(flow, process_update_reference_activity_type, activity_id, new_name, current_type)
         
-        if new_type == 'skip':
+        if new_type == SKIP:
             new_type = current_type
         
-        telegram_id = message.from_user.id
         try:
             user = db.get_user(telegram_id)
             success = db.update_reference_activity(activity_id, user[0], new_name, new_type)
             if success:
-                bot.reply_to(message, f"Updated: {new_name}\nNew type: {new_type}", reply_markup=ReplyKeyboardRemove())
+                flow.close(f"Updated: {new_name}\nNew type: {new_type}")
             else:
-                bot.reply_to(message, FAILED_TO_UPDATE_ACTIVITY_MESSAGE, reply_markup=ReplyKeyboardRemove())
+                flow.close(FAILED_TO_UPDATE_ACTIVITY_MESSAGE)
         except Exception as e:
             log_error(f"Error in process_update_reference_activity_type: {str(e)}")
-            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
+            flow.close(GENERAL_ERROR_MESSAGE)
 
     @bot.message_handler(commands=['deleteref'])
     def delete_reference_activity(message: Message):
@@ -856,81 +977,208 @@ def register_handlers(bot: TeleBot):
             reference_activities = db.get_reference_activities_without_activities(user[0])  # Get all reference activities
             
             if reference_activities:
-                keyboard = ReplyKeyboardMarkup(row_width=1, one_time_keyboard=True, resize_keyboard=True)
-                for activity in reference_activities:
-                    activity_id, activity_name, activity_type = activity
-                    keyboard.add(f"{activity_name} ({activity_type})")
-                keyboard.add("Cancel")
-                bot.reply_to(message, "Choose a reference activity to delete:", reply_markup=keyboard)
-                bot.register_next_step_handler(message, process_delete_reference_activity_choice, reference_activities)
+                keyboard = user_cache.get_or_set(user[0], 'unused_reference_activities:flow_keyboard',
+                                                 lambda: create_reference_activity_keyboard(reference_activities).to_json())
+                flow = FlowMessage.for_message(bot, message)
+                flow.render(DELETE_REFERENCE_PROMPT, keyboard)
+                wait_for_input(flow, process_delete_reference_activity_choice, reference_activities)
             else:
                 bot.reply_to(message, "You don't have any recent reference activities to delete.")
         except Exception as e:
             log_error(f"Error in delete_reference_activity: {str(e)}")
             bot.reply_to(message, GENERAL_ERROR_MESSAGE)
 
-    def process_delete_reference_activity_choice(message: Message, reference_activities):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-        
-        choice = message.text.strip()
-        if choice.lower() == "cancel":
-            bot.reply_to(message, OPERATION_CANCELLED_MESSAGE, reply_markup=ReplyKeyboardRemove())
-            return
-        
+    def process_delete_reference_activity_choice(flow: FlowMessage, telegram_id, choice, reference_activities):
         try:
-            activity_name, activity_type = choice.split(" (")
-            activity_type = activity_type.rstrip(")")
-            reference_activity = next((act for act in reference_activities if act[1] == activity_name and act[2] == activity_type), None)
-            
+            reference_activity = find_by_id(reference_activities, choice)
             if not reference_activity:
-                raise ValueError(INVALID_ACTIVITY_SELECTION_MESSAGE)
+                flow.render(f"{INVALID_ACTIVITY_SELECTION_MESSAGE}\n\n{DELETE_REFERENCE_PROMPT}",
+                            create_reference_activity_keyboard(reference_activities))
+                return wait_for_input(flow, process_delete_reference_activity_choice, reference_activities)
             
             activity_id, activity_name, activity_type = reference_activity
             
-            activity_count = db.get_activity_count_for_reference(activity_id, message.from_user.id)
+            user = db.get_user(telegram_id)
+            activity_count = db.get_activity_count_for_reference(activity_id, user[0])
             
             if activity_count > 0:
-                keyboard = ReplyKeyboardMarkup(row_width=2, one_time_keyboard=True, resize_keyboard=True)
-                keyboard.add("Yes", "No")
-                bot.reply_to(message, 
-                             f"Warning: The reference activity '{activity_name}' has {activity_count} recorded activities. "
-                             f"Deleting this reference will also delete all associated activities. "
-                             f"Are you sure you want to proceed?",
-                             reply_markup=keyboard)
-                bot.register_next_step_handler(message, process_delete_reference_activity_confirm, activity_id)
+                flow.render(f"Warning: The reference activity '{activity_name}' has {activity_count} recorded activities. "
+                            f"Deleting this reference will also delete all associated activities. "
+                            f"Are you sure you want to proceed?",
+                            YES_NO_KEYBOARD)
+                wait_for_input(flow, process_delete_reference_activity_confirm, activity_id)
             else:
-                process_delete_reference_activity(message, activity_id)
+                process_delete_reference_activity(flow, telegram_id, activity_id)
         except Exception as e:
             log_error(f"Error in process_delete_reference_activity_choice: {str(e)}")
-            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
-            return delete_reference_activity(message)
+            flow.close(GENERAL_ERROR_MESSAGE)
 
-    def process_delete_reference_activity_confirm(message: Message, activity_id):
-        if check_maintenance(message, bot):
-            return
-        if check_exit(message, bot):
-            return
-        
-        confirmation = message.text.strip().lower()
-        if confirmation == 'yes':
-            process_delete_reference_activity(message, activity_id)
+    def process_delete_reference_activity_confirm(flow: FlowMessage, telegram_id, confirmation, activity_id):
+        if confirmation.lower() == 'yes':
+            process_delete_reference_activity(flow, telegram_id, activity_id)
         else:
-            bot.reply_to(message, OPERATION_CANCELLED_MESSAGE, reply_markup=ReplyKeyboardRemove())
+            flow.close(OPERATION_CANCELLED_MESSAGE)
 
-    def process_delete_reference_activity(message: Message, activity_id):
+    def process_delete_reference_activity(flow: FlowMessage, telegram_id, activity_id):
         try:
-            telegram_id = message.from_user.id
             user = db.get_user(telegram_id)
             success = db.delete_reference_activity(activity_id, user[0])
             if success:
-                bot.reply_to(message, f"Reference activity with ID {activity_id} has been deleted successfully!", reply_markup=ReplyKeyboardRemove())
+                # Its recorded activities are already hidden; remove them in the background
+                purge_reference_activity.delay(activity_id, user[0])
+                flow.close(f"Reference activity with ID {activity_id} has been deleted successfully!")
             else:
-                bot.reply_to(message, FAILED_TO_DELETE_ACTIVITY_MESSAGE, reply_markup=ReplyKeyboardRemove())
+                flow.close(FAILED_TO_DELETE_ACTIVITY_MESSAGE)
         except Exception as e:
             log_error(f"Error in process_delete_reference_activity: {str(e)}")
+            flow.close(GENERAL_ERROR_MESSAGE)
+
+    @bot.message_handler(commands=['log'])
+    def log_activities(message: Message):
+        if check_maintenance(message, bot):
+            return
+        text = message.text.split(maxsplit=1)[1] if len(message.text.split(maxsplit=1)) > 1 else ""
+        if not text.strip():
+            bot.reply_to(message, QUICK_LOG_USAGE_MESSAGE)
+            return
+        quick_log(message, text)
+
+    def get_activity_name_index(user_id):
+        # Rebuilt only when the user's reference activities change
+        return user_cache.get_or_set(
+            user_id, 'reference_activities:name_index',
+            lambda: ActivityNameIndex(db.get_reference_activities(user_id)))
+
+    def quick_log(message: Message, text):
+        """Record every "<name> <value>" entry of text with a single insert."""
+        telegram_id = message.from_user.id
+        parsed = parse_log_entries(text)
+        if not any(value_input for _, value_input in parsed):
+            bot.reply_to(message, QUICK_LOG_USAGE_MESSAGE)
+            return
+        try:
+            user = db.get_user(telegram_id)
+            if not user:
+                bot.reply_to(message, GENERAL_ERROR_MESSAGE)
+                return
+            index = get_activity_name_index(user[0])
+
+            entries, logged, problems = [], [], []
+            for name, value_input in parsed:
+                reference = index.match(name)
+                if value_input is None:
+                    problems.append(f"'{name}': expected a name and a value")
+                elif reference is None:
+                    problems.append(f"'{name}': no matching reference activity")
+                else:
+                    reference_activity_id, activity_name, activity_type = reference
+                    try:
+                        value = parse_activity_value(value_input, activity_type)
+                    except ValueError as e:
+                        problems.append(f"{activity_name}: {str(e)}")
+                        continue
+                    entries.append((reference_activity_id, value))
+                    logged.append(f"{activity_name} | {format_activity_value(value, activity_type)}")
+
+            if entries:
+                if ACTIVITY_WRITE_BEHIND:
+                    for reference_activity_id, value in entries:
+                        save_activity(user[0], reference_activity_id, value)
+                else:
+                    now = datetime.now(pytz.utc)
+                    db.add_activities([(user[0], reference_activity_id, value, now)
+                                       for reference_activity_id, value in entries])
+
+            response = ""
+            if logged:
+                response += "Added:\n" + "\n".join(logged)
+            if problems:
+                response += ("\n\n" if response else "") + "Not added:\n" + "\n".join(problems)
+                response += "\n\n" + QUICK_LOG_USAGE_MESSAGE
+            bot.reply_to(message, response)
+            log_info(f"Quick log: User {telegram_id} added {len(entries)} activities")
+        except Exception as e:
+            log_error(f"Error in quick_log for user {telegram_id}: {str(e)}")
+            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
+
+    # Admin commands. Changes go through control_plane and reach every bot
+    # and worker process without a restart.
+    @bot.message_handler(commands=['maintenance'])
+    def maintenance(message: Message):
+        if not check_admin(message, bot):
+            return
+        try:
+            args = message.text.split()[1:]
+            if not args:
+                state = "on" if control_plane.is_maintenance() else "off"
+                bot.reply_to(message, f"Maintenance mode is {state}. Use /maintenance on|off to change it.")
+                return
+            if args[0].lower() not in ("on", "off"):
+                bot.reply_to(message, INVALID_INPUT_MESSAGE)
+                return
+            control_plane.set_flag('maintenance_mode', args[0].lower() == "on")
+            bot.reply_to(message, f"Maintenance mode is now {args[0].lower()}.")
+            log_info(f"Admin {message.from_user.id} turned maintenance mode {args[0].lower()}")
+        except Exception as e:
+            log_error(f"Error in maintenance command: {str(e)}")
+            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
+
+    @bot.message_handler(commands=['admin'])
+    def admin_stats(message: Message):
+        if not check_admin(message, bot):
+            return
+        try:
+            args = message.text.split()[1:]
+            if args and not (args[0].isdigit() and 1 <= int(args[0]) <= metrics.MAX_HISTORY_DAYS):
+                bot.reply_to(message, f"Usage: /admin [days of history, 1-{metrics.MAX_HISTORY_DAYS}]")
+                return
+            days = int(args[0]) if args else metrics.HISTORY_DAYS
+            response = metrics.format_admin_stats(metrics.EngagementStats(db), days)
+            bot.reply_to(message, f"```\n{response}\n```", parse_mode='MarkdownV2')
+            log_info(f"Admin {message.from_user.id} viewed bot stats")
+        except Exception as e:
+            log_error(f"Error in admin_stats: {str(e)}")
+            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
+
+    @bot.message_handler(commands=['rebuildranking'])
+    def rebuild_ranking(message: Message):
+        if not check_admin(message, bot):
+            return
+        if not leaderboard.enabled():
+            bot.reply_to(message, "The ranking needs Redis, set REDIS_URL.")
+            return
+        rebuild_leaderboard.delay(message.chat.id)
+        bot.reply_to(message, "Rebuilding the ranking from the database...")
+        log_info(f"Admin {message.from_user.id} started a ranking rebuild")
+
+    @bot.message_handler(commands=['admins'])
+    def list_admins(message: Message):
+        if not check_admin(message, bot):
+            return
+        admins = control_plane.get_admins()
+        bot.reply_to(message, "Admins:\n" + "\n".join(str(telegram_id) for telegram_id in admins))
+
+    @bot.message_handler(commands=['addadmin', 'removeadmin'])
+    def change_admin(message: Message):
+        if not check_admin(message, bot):
+            return
+        try:
+            command, *args = message.text.split()
+            if len(args) != 1 or not args[0].isdigit():
+                bot.reply_to(message, f"Usage: {command} <telegram_id>")
+                return
+            telegram_id = int(args[0])
+            if command.lstrip('/').split('@')[0] == 'addadmin':
+                control_plane.add_admin(telegram_id)
+                db.set_admin(telegram_id, True)
+                bot.reply_to(message, f"{telegram_id} is now an admin.")
+            else:
+                control_plane.remove_admin(telegram_id)
+                db.set_admin(telegram_id, False)
+                bot.reply_to(message, f"{telegram_id} is no longer an admin.")
+            log_info(f"Admin {message.from_user.id} ran {command} {telegram_id}")
+        except Exception as e:
+            log_error(f"Error in change_admin: {str(e)}")
             bot.reply_to(message, GENERAL_ERROR_MESSAGE)
 
     @bot.message_handler(commands=['exit'])
@@ -943,12 +1191,117 @@ def register_handlers(bot: TeleBot):
             return True
         return False
     # Add this new command handler
+    @bot.message_handler(commands=['challenge'])
+    def challenge_command(message: Message):
+        if check_maintenance(message, bot):
+            return
+        telegram_id = message.from_user.id
+        try:
+            user = db.get_user(telegram_id)
+            args = message.text.split()[1:]
+            action = args[0].lower() if args else None
+            today = datetime.now(NICOSIA_TIMEZONE).date()
+
+            if action is None:
+                bot.reply_to(message, format_challenges(user[0], today))
+            elif action == 'start':
+                days = analytics.CHALLENGE_DAYS
+                if len(args) > 1 and args[1].isdigit():
+                    days = int(args[1])
+                    args = args[1:]
+                if not 1 <= days <= MAX_CHALLENGE_DAYS:
+                    bot.reply_to(message, f"A challenge can last 1 to {MAX_CHALLENGE_DAYS} days.")
+                    return
+                name = " ".join(args[1:])[:255] or f"{days}-day challenge"
+                end_date = today + timedelta(days=days - 1)
+                challenge_id = db.create_challenge(name, today, end_date, days, user[0])
+                db.select_challenge(challenge_id, user[0])
+                bot.reply_to(message, f"{name} (#{challenge_id}) runs until {end_date:%b %d}. "
+                                      f"Your stats and ranking now count from today. "
+                                      f"Friends can join with /challenge join {challenge_id}")
+                log_info(f"User {telegram_id} started challenge {challenge_id}")
+            elif action == 'join':
+                if len(args) != 2 or not args[1].isdigit():
+                    bot.reply_to(message, CHALLENGE_USAGE)
+                    return
+                challenge = db.get_challenge(int(args[1]))
+                if not challenge:
+                    bot.reply_to(message, CHALLENGE_NOT_FOUND_MESSAGE)
+                    return
+                joined = db.select_challenge(challenge[0], user[0])
+                verb = "joined" if joined else "switched to"
+                bot.reply_to(message, f"You {verb} {challenge[1]}.\n\n{format_challenge_header(challenge)}")
+                log_info(f"User {telegram_id} {verb} challenge {challenge[0]}")
+            elif action == 'leave':
+                challenge = db.get_current_challenge(user[0])
+                if not challenge:
+                    bot.reply_to(message, NO_CHALLENGE_MESSAGE)
+                    return
+                db.leave_challenge(challenge[0], user[0])
+                current = db.get_current_challenge(user[0])
+                response = f"You left {challenge[1]}. "
+                response += f"Your current challenge is {current[1]}." if current else "Your stats cover all your activities again."
+                bot.reply_to(message, response)
+                log_info(f"User {telegram_id} left challenge {challenge[0]}")
+            elif action == 'new':
+                create_shared_challenge(message, user, args[1:])
+            else:
+                bot.reply_to(message, CHALLENGE_USAGE)
+        except Exception as e:
+            log_error(f"Error in challenge_command for user {telegram_id}: {str(e)}")
+            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
+
+    def create_shared_challenge(message: Message, user, args):
+        # /challenge new <YYYY-MM-DD> <days> <name>, listed for everyone
+        if not check_admin(message, bot):
+            return
+        try:
+            start_date = datetime.strptime(args[0], '%Y-%m-%d').date()
+            days = int(args[1])
+            name = " ".join(args[2:])[:255]
+        except (IndexError, ValueError):
+            name = None
+        if not name or not 1 <= days <= MAX_CHALLENGE_DAYS:
+            bot.reply_to(message, f"Usage: /challenge new <YYYY-MM-DD> <days, 1-{MAX_CHALLENGE_DAYS}> <name>")
+            return
+        end_date = start_date + timedelta(days=days - 1)
+        challenge_id = db.create_challenge(name, start_date, end_date, days, user[0], shared=True)
+        bot.reply_to(message, f"Created {name} (#{challenge_id}), {start_date:%b %d} - {end_date:%b %d}.")
+        log_info(f"Admin {message.from_user.id} created shared challenge {challenge_id}")
+
+    def format_challenges(user_id, today):
+        challenges = db.get_user_challenges(user_id)
+        if challenges:
+            response = "Your current challenge:\n" + format_challenge_header(challenges[0])
+            others = challenges[1:]
+            if others:
+                response += "\nYour other challenges:\n"
+                response += "\n".join(f"#{c[0]} {c[1]} ({c[2]:%b %d} - {c[3]:%b %d})" for c in others) + "\n"
+        else:
+            response = "You're not in a challenge, so your stats cover all your activities.\n"
+        joined = {challenge[0] for challenge in challenges}
+        open_challenges = [c for c in db.get_open_challenges(today) if c[0] not in joined]
+        if open_challenges:
+            response += "\nOpen challenges:\n"
+            response += "\n".join(f"#{c[0]} {c[1]} ({c[2]:%b %d} - {c[3]:%b %d}, {c[5]} members)"
+                                   for c in open_challenges) + "\n"
+        return response + "\n" + CHALLENGE_USAGE
+
     @bot.message_handler(commands=['ranking'])
     def show_global_ranking(message: Message):
         if check_maintenance(message, bot):
             return
         
         try:
+            user = db.get_user(message.from_user.id)
+            # Members of a challenge are ranked within it, "/ranking global" ranks everyone
+            challenge = db.get_current_challenge(user[0]) if user else None
+            if challenge and message.text.split()[1:] != ['global']:
+                response = format_challenge_ranking(challenge, user[0])
+                bot.reply_to(message, f"```\n{response[:4000]}\n```", parse_mode='MarkdownV2')
+                log_info(f"Challenge {challenge[0]} ranking displayed for user {message.from_user.id}")
+                return
+
             ranking_data = db.get_global_ranking()
             
             if ranking_data:
@@ -973,6 +1326,9 @@ def register_handlers(bot: TeleBot):
                 response = "🏆 Global Ranking:\n\n" + table
             else:
                 response = "No ranking data available yet."
+
+            if user and leaderboard.enabled():
+                response += "\n\n" + format_user_rank(user[0], message.from_user.id)
             
             # Split the message if it's too long
             max_message_length = 4096
@@ -986,6 +1342,110 @@ def register_handlers(bot: TeleBot):
             log_error(f"Error in show_global_ranking: {str(e)}")
             bot.reply_to(message, GENERAL_ERROR_MESSAGE)
 
+    @bot.message_handler(commands=['top'])
+    def show_exercise_leaderboard(message: Message):
+        if check_maintenance(message, bot):
+            return
+        try:
+            user = db.get_user(message.from_user.id)
+            args = message.text.split()[1:]
+            period = catalog.parse_period(args[-1]) if args else None
+            if period:
+                args = args[:-1]
+            if not args:
+                entries = db.get_user_catalog_entries(user[0]) if user else []
+                response = "Usage: /top <exercise> [week|month], e.g. /top pushups week"
+                if entries:
+                    response += "\n\nYour exercises: " + ", ".join(entry[1] for entry in entries)
+                bot.reply_to(message, response)
+                return
+
+            entry = db.find_catalog_entry(" ".join(args))
+            if not entry:
+                bot.reply_to(message, f"Nobody has logged {' '.join(args)} yet.")
+                return
+            catalog_id, name, activity_type = entry
+            period = period or 'week'
+            period_start = catalog.period_start(period, datetime.now(pytz.utc).date())
+
+            def format_total(total):
+                return format_duration(total) if activity_type == 'time' else total
+
+            rows = db.get_exercise_leaderboard(catalog_id, period, period_start)
+            if not rows:
+                bot.reply_to(message, f"No {name} logged this {period} yet.")
+                return
+            table_data = []
+            for rank, (user_id, user_name, total, entries) in enumerate(rows, start=1):
+                if user and user_id == user[0]:
+                    user_name = f"> {user_name}"
+                table_data.append([rank, user_name[:10], format_total(total), entries])
+            table = tabulate(table_data, headers=["#", "Name", "Total", "Sets"], tablefmt="pipe", numalign="right")
+            response = f"🏅 {name} this {period} (since {period_start:%b %d}):\n\n{table}"
+
+            own = db.get_exercise_rank(catalog_id, period, period_start, user[0]) if user else None
+            if own and own[0] > len(rows):
+                response += f"\n\nYou: #{own[0]} with {format_total(own[1])}"
+            bot.reply_to(message, f"```\n{response}\n```", parse_mode='MarkdownV2')
+            log_info(f"{name} {period} leaderboard displayed for user {message.from_user.id}")
+        except Exception as e:
+            log_error(f"Error in show_exercise_leaderboard: {str(e)}")
+            bot.reply_to(message, GENERAL_ERROR_MESSAGE)
+
+    # Registered last so every command handler is tried first. Replies to a
+    # pending prompt never get here, next-step handlers consume them.
+    @bot.message_handler(func=lambda message: message.text and not message.text.startswith('/'))
+    def quick_log_text(message: Message):
+        if check_maintenance(message, bot):
+            return
+        quick_log(message, message.text)
+
+    def format_challenge_ranking(challenge, user_id):
+        challenge_id, name, start_date, end_date, _, _ = challenge
+        ranking = db.get_challenge_ranking(challenge_id, start_date, end_date)
+        if not ranking:
+            return f"No activities in {name} yet."
+        position = next((i for i, row in enumerate(ranking) if row[0] == user_id), None)
+        # The top 10, then the user and their neighbours
+        shown = set(range(min(10, len(ranking))))
+        if position is not None:
+            shown |= set(range(max(0, position - leaderboard.NEIGHBOURS),
+                               min(len(ranking), position + leaderboard.NEIGHBOURS + 1)))
+        table_data = []
+        previous = -1
+        for i in sorted(shown):
+            if i != previous + 1:
+                table_data.append([None, "...", None, None, None])
+            member_id, member_name, _, total_time, total_reps, days_active, _ = ranking[i]
+            label = f"> {member_name[:10]}" if member_id == user_id else member_name[:10]
+            table_data.append([i + 1, label, format_duration_short(total_time), total_reps, days_active])
+            previous = i
+        table = tabulate(table_data, headers=["#", "Name", "Time", "Reps", "Days"], tablefmt="pipe",
+                         numalign="right", missingval="")
+        response = f"🏆 {name} ({start_date:%b %d} - {end_date:%b %d}):\n\n{table}"
+        if position is not None:
+            response += f"\n\nYour rank: {position + 1} of {len(ranking)}"
+        return response
+
+    def format_user_rank(user_id, telegram_id):
+        if not leaderboard.is_built():
+            # Loaded from Postgres once, in the background
+            rebuild_leaderboard.delay()
+            return "Your rank will be available in a moment."
+        ranked = leaderboard.rank_with_neighbours(user_id)
+        if ranked is None:
+            if control_plane.is_admin(telegram_id):
+                return "Admins are not ranked."
+            return "Log an activity to get your rank."
+        rank, total, entries = ranked
+        names = db.get_user_names([entry_user_id for _, entry_user_id, _ in entries])
+        table_data = []
+        for entry_rank, entry_user_id, days_active in entries:
+            name = names.get(entry_user_id, 'N/A')[:10]
+            table_data.append([entry_rank, f"> {name}" if entry_user_id == user_id else name, days_active])
+        table = tabulate(table_data, headers=["#", "Name", "Days"], tablefmt="pipe", numalign="right")
+        return f"📍 Your rank: {rank} of {total}\n\n" + table
+
     # Add this new helper function at the appropriate place in your file
     def format_duration_short(seconds):
         hours, remainder = divmod(int(seconds), 3600)
@@ -0,0 +1,255 @@
+import json
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+from config import CACHE_TTL, CACHE_LOCAL_MAX_ENTRIES, CACHE_MAX_VALUE_BYTES
+from logger import log_error
+from redis_client import ensure_listener, get_redis, subscribe
+
+INVALIDATION_CHANNEL = 'cache:invalidate'
+
+_caches = {}
+
+# KEYS: user hash, generation key; ARGV: generation read before computing the
+# value, field, pickled value, ttl. Stores nothing if the user's data was
+# invalidated in the meantime.
+_SET_IF_CURRENT_SCRIPT = """
+if (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('HSET', KEYS[1], ARGV[2], ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return 1
+"""
+
+
+class UserCache:
+    """
+    Two-level cache of values computed from one user's data.
+
+    An in-process LRU sits in front of a Redis hash per user, shared by the
+    bot and every Celery worker. Entries are grouped per user so a write can
+    drop everything derived from that user's rows at once, or just the keys
+    sharing a prefix. Invalidations are published on INVALIDATION_CHANNEL so
+    every process drops its local copies as well.
+
+    Every invalidation also bumps a per-user generation, in Redis and in each
+    process. get_or_set reads it before computing a value and only stores the
+    value if it hasn't changed, so a read that raced a write can't cache what
+    it read before the write. Values larger than CACHE_MAX_VALUE_BYTES
+    pickled (e.g. a long history) are not cached at all.
+    """
+
+    def __init__(self, namespace, ttl=CACHE_TTL, max_entries=CACHE_LOCAL_MAX_ENTRIES):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._local = OrderedDict()
+        self._user_keys = {}
+        self._generations = {}
+        self._epoch = 0
+        # Invalidations that didn't reach Redis; the user's Redis entries
+        # aren't trusted until one is retried successfully
+        self._failed_invalidations = {}
+        self._set_script = None
+        self._lock = threading.Lock()
+        _caches[namespace] = self
+
+    def _redis_key(self, user_id):
+        return f"cache:{self.namespace}:{user_id}"
+
+    def _generation_key(self, user_id):
+        return f"cache:{self.namespace}:{user_id}:generation"
+
+    def generation(self, user_id):
+        """Token to pass to set() for a value computed from the user's data after this call."""
+        with self._lock:
+            local = (self._epoch, self._generations.get(user_id, 0))
+        client = get_redis()
+        if client is None or not self._retry_invalidations(client, user_id):
+            return local, None
+        try:
+            stored = client.get(self._generation_key(user_id))
+        except redis.RedisError as e:
+            log_error(f"Cache read failed for {self.namespace}:{user_id}: {str(e)}")
+            return local, None
+        return local, stored.decode() if stored else '0'
+
+    def get(self, user_id, key, default=None):
+        # Forked worker processes need their own invalidation listener
+        ensure_listener()
+        missing = object()
+        value = self._get_local(user_id, key, missing)
+        if value is not missing:
+            return value
+
+        client = get_redis()
+        if client is None or not self._retry_invalidations(client, user_id):
+            return default
+        try:
+            raw = client.hget(self._redis_key(user_id), key)
+        except redis.RedisError as e:
+            log_error(f"Cache read failed for {self.namespace}:{user_id}:{key}: {str(e)}")
+            return default
+        if raw is None:
+            return default
+        value = pickle.loads(raw)
+        self._set_local(user_id, key, value)
+        return value
+
+    def set(self, user_id, key, value, generation=None):
+        """
+        Cache a value. With a generation() token taken before the value was
+        computed, it is only stored where no invalidation happened since.
+        """
+        raw = pickle.dumps(value)
+        if len(raw) > CACHE_MAX_VALUE_BYTES:
+            return value
+        local_generation, redis_generation = generation or (None, None)
+        self._set_local(user_id, key, value, local_generation)
+        client = get_redis()
+        if client is None or (generation is not None and redis_generation is None):
+            return value
+        if not self._retry_invalidations(client, user_id):
+            return value
+        try:
+            if generation is None:
+                pipe = client.pipeline()
+                pipe.hset(self._redis_key(user_id), key, raw)
+                pipe.expire(self._redis_key(user_id), self.ttl)
+                pipe.execute()
+            else:
+                if self._set_script is None:
+                    self._set_script = client.register_script(_SET_IF_CURRENT_SCRIPT)
+                self._set_script(keys=[self._redis_key(user_id), self._generation_key(user_id)],
+                                 args=[redis_generation, key, raw, self.ttl])
+        except redis.RedisError as e:
+            log_error(f"Cache write failed for {self.namespace}:{user_id}:{key}: {str(e)}")
+        return value
+
+    def get_or_set(self, user_id, key, factory):
+        missing = object()
+        value = self.get(user_id, key, missing)
+        if value is missing:
+            generation = self.generation(user_id)
+            value = self.set(user_id, key, factory(), generation)
+        return value
+
+    def invalidate(self, user_id, prefix=None):
+        self.invalidate_local(user_id, prefix)
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            self._invalidate_redis(client, user_id, prefix)
+        except redis.RedisError as e:
+            log_error(f"Cache invalidation failed for {self.namespace}:{user_id}: {str(e)}")
+            with self._lock:
+                # Retried before the user's entries are read or written again
+                pending = self._failed_invalidations.get(user_id, ())
+                self._failed_invalidations[user_id] = None if prefix is None or pending is None else pending + (prefix,)
+
+    def _invalidate_redis(self, client, user_id, prefix):
+        redis_key = self._redis_key(user_id)
+        fields = None
+        if prefix is not None:
+            fields = [field for field in client.hkeys(redis_key) if field.decode().startswith(prefix)]
+        # The generation bump makes in-flight get_or_set calls drop their values
+        pipe = client.pipeline()
+        pipe.incr(self._generation_key(user_id))
+        pipe.expire(self._generation_key(user_id), self.ttl)
+        if prefix is None:
+            pipe.delete(redis_key)
+        elif fields:
+            pipe.hdel(redis_key, *fields)
+        pipe.execute()
+        client.publish(INVALIDATION_CHANNEL, json.dumps(
+            {'namespace': self.namespace, 'user_id': user_id, 'prefix': prefix}))
+
+    def _retry_invalidations(self, client, user_id):
+        """Whether the user's Redis entries can be trusted, retrying a failed invalidation first."""
+        if user_id not in self._failed_invalidations:
+            return True
+        with self._lock:
+            prefixes = self._failed_invalidations.get(user_id, ())
+        try:
+            for prefix in prefixes or (None,):
+                self._invalidate_redis(client, user_id, prefix)
+        except redis.RedisError as e:
+            log_error(f"Cache invalidation failed for {self.namespace}:{user_id}: {str(e)}")
+            return False
+        with self._lock:
+            if self._failed_invalidations.get(user_id, ()) == prefixes:
+                self._failed_invalidations.pop(user_id, None)
+        return True
+
+    def invalidate_local(self, user_id, prefix=None):
+        with self._lock:
+            if len(self._generations) >= self.max_entries:
+                # A new epoch still voids every generation handed out so far
+                self._epoch += 1
+                self._generations.clear()
+            self._generations[user_id] = self._generations.get(user_id, 0) + 1
+            keys = self._user_keys.get(user_id, set())
+            for key in [key for key in keys if prefix is None or key.startswith(prefix)]:
+                self._local.pop((user_id, key), None)
+                keys.discard(key)
+
+    def clear_local(self):
+        with self._lock:
+            self._epoch += 1
+            self._generations.clear()
+            self._local.clear()
+            self._user_keys.clear()
+
+    def _get_local(self, user_id, key, default):
+        with self._lock:
+            entry = self._local.get((user_id, key))
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                self._local.pop((user_id, key))
+                self._user_keys.get(user_id, set()).discard(key)
+                return default
+            self._local.move_to_end((user_id, key))
+            return value
+
+    def _set_local(self, user_id, key, value, generation=None):
+        with self._lock:
+            if generation is not None and generation != (self._epoch, self._generations.get(user_id, 0)):
+                return
+            self._local[(user_id, key)] = (time.monotonic() + self.ttl, value)
+            self._local.move_to_end((user_id, key))
+            self._user_keys.setdefault(user_id, set()).add(key)
+            while len(self._local) > self.max_entries:
+                (old_user_id, old_key), _ = self._local.popitem(last=False)
+                self._user_keys.get(old_user_id, set()).discard(old_key)
+
+
+def _on_invalidation(data):
+    message = json.loads(data)
+    cache = _caches.get(message['namespace'])
+    if cache:
+        cache.invalidate_local(message['user_id'], message['prefix'])
+
+
+def _clear_local_caches():
+    # Invalidations published while we were disconnected are lost
+    for cache in _caches.values():
+        cache.clear_local()
+
+
+subscribe(INVALIDATION_CHANNEL, _on_invalidation, on_reconnect=_clear_local_caches)
+
+# Reference activities, activity aggregates and the keyboards built from
+# them, keyed by user id
+user_cache = UserCache('user')
+
+# User rows keyed by telegram id. Rows can also change outside the bot (e.g.
+# is_admin), so they expire sooner.
+telegram_user_cache = UserCache('telegram_user', ttl=300)
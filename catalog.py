@@ -0,0 +1,74 @@
+"""
+The shared exercise catalog behind the per-exercise leaderboards (/top).
+
+Reference activities are free text, so each one is mapped to a catalog
+entry of the same activity type through activity_aliases, keyed by the
+normalized name: "Pushups", "push ups" and "Push-up" all resolve to
+Push-ups. Names the catalog doesn't know become new entries, so users who
+type the same new exercise still share a leaderboard.
+"""
+from datetime import timedelta
+
+from activity_names import normalize_name
+
+# (display name, activity type, aliases); every name is also an alias of itself
+SEED_CATALOG = [
+    ('Push-ups', 'reps', ['pushup', 'press ups', 'press up']),
+    ('Pull-ups', 'reps', ['pullup', 'chin ups', 'chinup']),
+    ('Squats', 'reps', ['squat', 'air squats', 'bodyweight squats']),
+    ('Sit-ups', 'reps', ['situp']),
+    ('Crunches', 'reps', ['crunch', 'abs']),
+    ('Burpees', 'reps', ['burpee']),
+    ('Lunges', 'reps', ['lunge']),
+    ('Dips', 'reps', ['dip']),
+    ('Jumping jacks', 'reps', ['jumping jack', 'star jumps']),
+    ('Plank', 'time', ['planks', 'plank hold']),
+    ('Wall sit', 'time', ['wall sits']),
+    ('Running', 'time', ['run', 'jogging', 'jog']),
+    ('Walking', 'time', ['walk']),
+    ('Cycling', 'time', ['bike', 'biking', 'cycle']),
+    ('Yoga', 'time', []),
+    ('Stretching', 'time', ['stretch']),
+]
+
+# Leaderboard periods, as date_trunc() fields
+PERIODS = ('week', 'month')
+LEADERBOARD_SIZE = 10
+
+
+def alias_keys(name):
+    """
+    Keys a name is looked up by: normalized, and without a plural "s"
+    ("pushups" also finds "pushup").
+    """
+    key = normalize_name(name)
+    keys = [key]
+    if len(key) > 3 and key.endswith('s') and not key.endswith('ss'):
+        keys.append(key[:-1])
+    return keys
+
+
+def seed_aliases():
+    """(alias key, activity type, display name) for every seeded alias."""
+    aliases = []
+    for display_name, activity_type, names in SEED_CATALOG:
+        for name in [display_name] + names:
+            for key in alias_keys(name):
+                aliases.append((key, activity_type, display_name))
+    return aliases
+
+
+def parse_period(word):
+    """'week' or 'month' for a /top argument, None if it isn't a period."""
+    word = word.lower()
+    for period in PERIODS:
+        if period.startswith(word) or word in (f"this{period}", f"{period}ly"):
+            return period
+    return None
+
+
+def period_start(period, today):
+    """First day of the week (Monday) or month containing today, as in date_trunc()."""
+    if period == 'week':
+        return today - timedelta(days=today.weekday())
+    return today.replace(day=1)
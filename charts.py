@@ -0,0 +1,148 @@
+"""
+/chart progress images: per-activity daily volume and a streak heatmap over
+the last CHART_DAYS days.
+
+Charts are rendered by a Celery worker (tasks.send_progress_chart) and
+cached by content: chart_key() hashes the data a chart is drawn from, and
+the Telegram file_id of the uploaded image is stored under that hash. An
+unchanged chart is sent again by file_id, without rendering or uploading.
+"""
+import hashlib
+import io
+import json
+from datetime import datetime, timedelta
+
+import numpy as np
+import pytz
+
+from config import CHART_CACHE_TTL, CHART_DAYS, CHART_MAX_ACTIVITIES, CHART_RENDER_TIMEOUT
+from redis_client import get_redis
+
+# Bump when the rendering changes so cached images are replaced
+CHART_VERSION = 1
+CHART_KEY_PREFIX = 'chart:'
+
+NICOSIA_TIMEZONE = pytz.timezone('Europe/Nicosia')
+
+
+def chart_first_day(today=None, days=CHART_DAYS):
+    today = today or datetime.now(NICOSIA_TIMEZONE).date()
+    return today - timedelta(days=days - 1)
+
+
+def chart_key(rows, first_day, days=CHART_DAYS):
+    """Hash of everything a chart is drawn from, see Database.get_daily_activity_totals."""
+    payload = json.dumps([
+        CHART_VERSION, first_day.isoformat(), days, CHART_MAX_ACTIVITIES,
+        [[ref_id, name, activity_type, day.isoformat(), str(total)]
+         for ref_id, name, activity_type, day, total in rows],
+    ])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def chart_data(rows, first_day, days=CHART_DAYS, max_activities=CHART_MAX_ACTIVITIES):
+    """
+    Daily totals as an (activities x days) array, with the activity names and
+    types. Keeps the max_activities activities with the most active days.
+    """
+    activities = {}
+    for ref_id, name, activity_type, day, total in rows:
+        activities.setdefault(ref_id, (name, activity_type))
+    ref_ids = list(activities)
+    values = np.zeros((len(ref_ids), days))
+    for ref_id, _, _, day, total in rows:
+        column = (day - first_day).days
+        if 0 <= column < days:
+            values[ref_ids.index(ref_id), column] += float(total)
+
+    # Most active first; a stable sort keeps the reference order for ties
+    order = np.argsort(-np.count_nonzero(values, axis=1), kind='stable')[:max_activities]
+    names = [activities[ref_ids[i]][0] for i in order]
+    types = [activities[ref_ids[i]][1] for i in order]
+    return names, types, values[order]
+
+
+def streak_lengths(active):
+    """For each day, the length of the run of active days ending on it (0 if inactive)."""
+    streaks = np.zeros(active.shape, dtype=int)
+    run = np.zeros(active.shape[0], dtype=int)
+    for day in range(active.shape[1]):
+        run = np.where(active[:, day], run + 1, 0)
+        streaks[:, day] = run
+    return streaks
+
+
+def render_progress_chart(rows, first_day, days=CHART_DAYS):
+    """PNG bytes of the chart for get_daily_activity_totals rows."""
+    # Only the workers render, so the bot process never loads matplotlib
+    from matplotlib.figure import Figure
+
+    names, types, values = chart_data(rows, first_day, days)
+    count = len(names)
+    streaks = streak_lengths(values > 0)
+    x = np.arange(days)
+
+    fig = Figure(figsize=(10, 1.3 * count + 0.35 * count + 1.6))
+    axes = fig.subplots(count + 1, 1, sharex=True, squeeze=False,
+                        gridspec_kw={'height_ratios': [1] * count + [max(1, 0.3 * count)]})[:, 0]
+    for row, ax in enumerate(axes[:count]):
+        # Durations are stored in seconds
+        volume = values[row] / 60 if types[row] == 'time' else values[row]
+        ax.bar(x, volume, width=0.8, color=f"C{row % 10}")
+        ax.set_title(names[row], loc='left', fontsize=9)
+        ax.set_ylabel('min' if types[row] == 'time' else 'reps', fontsize=8)
+        ax.tick_params(labelsize=7)
+        ax.spines[['top', 'right']].set_visible(False)
+
+    heatmap = axes[count]
+    heatmap.imshow(streaks, aspect='auto', cmap='YlGn', interpolation='nearest', vmin=0,
+                   extent=(-0.5, days - 0.5, count - 0.5, -0.5))
+    heatmap.set_title('Streaks (consecutive active days)', loc='left', fontsize=9)
+    heatmap.set_yticks(range(count))
+    heatmap.set_yticklabels([f"{name} ({streaks[row, -1]}d)" for row, name in enumerate(names)], fontsize=8)
+    ticks = list(range(0, days, 10))
+    heatmap.set_xticks(ticks)
+    heatmap.set_xticklabels([(first_day + timedelta(days=day)).strftime('%b %d') for day in ticks], fontsize=7)
+
+    last_day = first_day + timedelta(days=days - 1)
+    fig.suptitle(f"Progress {first_day:%b %d} - {last_day:%b %d}", fontsize=11)
+    fig.tight_layout()
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=100)
+    return buffer.getvalue()
+
+
+def _file_id_key(key):
+    return f"{CHART_KEY_PREFIX}file:{key}"
+
+
+def _render_lock_key(key):
+    return f"{CHART_KEY_PREFIX}rendering:{key}"
+
+
+def get_cached_file_id(key):
+    client = get_redis()
+    if client is None:
+        return None
+    file_id = client.get(_file_id_key(key))
+    return file_id.decode() if file_id else None
+
+
+def cache_file_id(key, file_id):
+    client = get_redis()
+    if client is not None:
+        client.set(_file_id_key(key), file_id, ex=CHART_CACHE_TTL)
+
+
+def claim_render(key):
+    """False if this chart is already being rendered."""
+    client = get_redis()
+    if client is None:
+        return True
+    return bool(client.set(_render_lock_key(key), 1, nx=True, ex=CHART_RENDER_TIMEOUT))
+
+
+def release_render(key):
+    client = get_redis()
+    if client is not None:
+        client.delete(_render_lock_key(key))
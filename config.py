@@ -2,6 +2,15 @@ import os
 
 # Telegram Bot Token
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
+# Override the Bot API endpoint, e.g. the fake server used by the load tests
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+# Shared HTTP session for Bot API calls (telegram_client.py)
+TELEGRAM_POOL_SIZE = int(os.environ.get("TELEGRAM_POOL_SIZE", 20))
+TELEGRAM_CONNECT_TIMEOUT = float(os.environ.get("TELEGRAM_CONNECT_TIMEOUT", 5))
+TELEGRAM_READ_TIMEOUT = float(os.environ.get("TELEGRAM_READ_TIMEOUT", 30))
+TELEGRAM_MAX_RETRIES = int(os.environ.get("TELEGRAM_MAX_RETRIES", 3))
+# Seconds between latency summaries in the logs, 0 to disable
+TELEGRAM_STATS_LOG_INTERVAL = int(os.environ.get("TELEGRAM_STATS_LOG_INTERVAL", 300))
 
 # Database configuration
 POSTGRES_DB=os.environ.get("POSTGRES_DB")
@@ -10,11 +19,90 @@ POSTGRES_PASSWORD=os.environ.get("POSTGRES_PASSWORD")
 POSTGRES_HOST=os.environ.get("POSTGRES_HOST", "db")
 POSTGRES_PORT=os.environ.get("POSTGRES_PORT", "5432")
 
+# Streaming replicas for heavy reads, as comma-separated libpq DSNs or URLs
+# (see replicas.py). Unset, everything runs on POSTGRES_HOST.
+POSTGRES_REPLICA_DSNS = [dsn.strip() for dsn in os.environ.get("POSTGRES_REPLICA_DSNS", "").split(",") if dsn.strip()]
+REPLICA_POOL_SIZE = int(os.environ.get("REPLICA_POOL_SIZE", 20))
+REPLICA_CONNECT_TIMEOUT = int(os.environ.get("REPLICA_CONNECT_TIMEOUT", 2))
+# A replica further behind than this is skipped; its lag is measured at most
+# every REPLICA_LAG_CHECK_INTERVAL seconds
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get("REPLICA_MAX_LAG_SECONDS", 5))
+REPLICA_LAG_CHECK_INTERVAL = float(os.environ.get("REPLICA_LAG_CHECK_INTERVAL", 5))
+# How long a user reads from the primary after writing (at least the two above combined)
+REPLICA_PIN_SECONDS = float(os.environ.get("REPLICA_PIN_SECONDS", 15))
+
 # Redis configuration
 REDIS_URL = os.environ.get("REDIS_URL")
 
+# Shared cache (in-process LRU in front of Redis)
+CACHE_TTL = int(os.environ.get("CACHE_TTL", 3600))
+CACHE_LOCAL_MAX_ENTRIES = int(os.environ.get("CACHE_LOCAL_MAX_ENTRIES", 10000))
+# Larger values (pickled), such as a long activity history, are not cached
+CACHE_MAX_VALUE_BYTES = int(os.environ.get("CACHE_MAX_VALUE_BYTES", 524288))
+
 # Other configurations
 MAINTENANCE_MODE = os.environ.get("MAINTENANCE_MODE", "false").lower() == "true"
 ADMIN_ID = os.environ.get("ADMIN_ID")
 
-ACTIVITY_LIMIT = os.environ.get("ACTIVITY_LIMIT", 5)
\ No newline at end of file
+# Queue /add through a Redis stream and insert in batches (python -m activity_stream)
+ACTIVITY_WRITE_BEHIND = os.environ.get("ACTIVITY_WRITE_BEHIND", "false").lower() == "true"
+ACTIVITY_STREAM_BATCH_SIZE = int(os.environ.get("ACTIVITY_STREAM_BATCH_SIZE", 500))
+ACTIVITY_STREAM_BLOCK_MS = int(os.environ.get("ACTIVITY_STREAM_BLOCK_MS", 200))
+# How long /list and /stats wait for the user's queued activities to be written
+ACTIVITY_STREAM_READ_TIMEOUT = float(os.environ.get("ACTIVITY_STREAM_READ_TIMEOUT", 2))
+
+# Consecutive sends refused by the chat (other than blocked/deleted chats)
+# before a user is skipped by broadcasts; rate limits and Telegram server
+# errors don't count
+DELIVERY_MAX_FAILURES = int(os.environ.get("DELIVERY_MAX_FAILURES", 5))
+
+# How long a reminder stays marked as sent for its slot, and the upper bound
+# on one send_encouragement fan-out holding its lock
+REMINDER_DEDUPE_TTL = int(os.environ.get("REMINDER_DEDUPE_TTL", 172800))
+REMINDER_LOCK_TIMEOUT = int(os.environ.get("REMINDER_LOCK_TIMEOUT", 600))
+
+# Users per send_encouragement_batch task (0 sends one task per user), the
+# sends each batch keeps in flight, and the messages per second all broadcast
+# worker processes may send together (Telegram allows about 30/s per bot; 0
+# disables the limit). Each process is limited on its own, so it gets an
+# equal share unless BROADCAST_SEND_RATE sets the per-process rate directly.
+BROADCAST_BATCH_SIZE = int(os.environ.get("BROADCAST_BATCH_SIZE", 200))
+BROADCAST_SEND_CONCURRENCY = int(os.environ.get("BROADCAST_SEND_CONCURRENCY", 16))
+CELERY_BROADCAST_CONCURRENCY = int(os.environ.get("CELERY_BROADCAST_CONCURRENCY", 4))
+BROADCAST_TOTAL_SEND_RATE = float(os.environ.get("BROADCAST_TOTAL_SEND_RATE", 25))
+BROADCAST_SEND_RATE = float(os.environ.get("BROADCAST_SEND_RATE")
+                            or BROADCAST_TOTAL_SEND_RATE / max(1, CELERY_BROADCAST_CONCURRENCY))
+
+# Rows fetched per round trip by the weekly digest's server-side cursor
+DIGEST_CURSOR_ITERSIZE = int(os.environ.get("DIGEST_CURSOR_ITERSIZE", 5000))
+
+# Rows fetched per round trip when the /ranking leaderboard is rebuilt from
+# Postgres, and the upper bound on one rebuild holding its lock
+LEADERBOARD_CURSOR_ITERSIZE = int(os.environ.get("LEADERBOARD_CURSOR_ITERSIZE", 5000))
+LEADERBOARD_REBUILD_TIMEOUT = int(os.environ.get("LEADERBOARD_REBUILD_TIMEOUT", 3600))
+
+# Days the /admin engagement counters are kept in Redis, and how long the
+# users total seeded from Postgres is trusted before it is counted again
+METRICS_RETENTION_DAYS = int(os.environ.get("METRICS_RETENTION_DAYS", 35))
+METRICS_TOTAL_USERS_TTL = int(os.environ.get("METRICS_TOTAL_USERS_TTL", 86400))
+
+# Monthly activities partitions to create ahead of time
+ACTIVITY_PARTITION_MONTHS_AHEAD = int(os.environ.get("ACTIVITY_PARTITION_MONTHS_AHEAD", 3))
+
+# Activities removed per transaction when a reference activity is deleted,
+# and the pause between batches
+REFERENCE_PURGE_BATCH_SIZE = int(os.environ.get("REFERENCE_PURGE_BATCH_SIZE", 1000))
+REFERENCE_PURGE_BATCH_DELAY = float(os.environ.get("REFERENCE_PURGE_BATCH_DELAY", 0.1))
+REFERENCE_PURGE_LOCK_TIMEOUT = int(os.environ.get("REFERENCE_PURGE_LOCK_TIMEOUT", 3600))
+
+# Days covered by /chart, the activities it plots at most, how long a
+# rendered chart's Telegram file_id is reused, and the upper bound on one
+# render holding its lock
+CHART_DAYS = int(os.environ.get("CHART_DAYS", 100))
+CHART_MAX_ACTIVITIES = int(os.environ.get("CHART_MAX_ACTIVITIES", 8))
+CHART_CACHE_TTL = int(os.environ.get("CHART_CACHE_TTL", 2592000))
+CHART_RENDER_TIMEOUT = int(os.environ.get("CHART_RENDER_TIMEOUT", 60))
+
+# Page sizes for the activity menus (/update, /delete) and /list
+ACTIVITY_LIMIT = int(os.environ.get("ACTIVITY_LIMIT", 5))
+LIST_PAGE_SIZE = int(os.environ.get("LIST_PAGE_SIZE", 10))
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""
+Runtime flags and the admin set, shared by the bot and the Celery workers.
+
+Both live in Redis (the control:flags hash and the control:admins set) and
+are mirrored in each process's memory, so checks such as is_maintenance()
+and is_admin() never leave the process. Changes are published on
+CONTROL_CHANNEL and every process reloads its copy. Without Redis the
+flags fall back to their config.py values and admins to the seeded set.
+
+The admin set is seeded from users.is_admin only once (SEEDED_KEY), so an
+admin removed at runtime stays removed when processes restart.
+"""
+import json
+import threading
+
+import redis
+
+from config import ADMIN_ID, MAINTENANCE_MODE
+from logger import log_error, log_info
+from redis_client import ensure_listener, get_redis, subscribe
+
+FLAGS_KEY = 'control:flags'
+ADMINS_KEY = 'control:admins'
+SEEDED_KEY = 'control:admins:seeded'
+CONTROL_CHANNEL = 'control:changed'
+
+# Flags and their values when not set in Redis
+DEFAULT_FLAGS = {
+    'maintenance_mode': MAINTENANCE_MODE,
+    # When set, broadcasts only go to this user (for testing reminders)
+    'admin_id': ADMIN_ID or None,
+}
+
+_flags = dict(DEFAULT_FLAGS)
+_admins = frozenset()
+_seed_admins = frozenset()
+_loaded = False
+_lock = threading.Lock()
+
+# KEYS: admin set, seeded marker; ARGV: telegram ids
+_SEED_SCRIPT = """
+if redis.call('SET', KEYS[2], 1, 'NX') then
+    if #ARGV > 0 then
+        redis.call('SADD', KEYS[1], unpack(ARGV))
+    end
+    return 1
+end
+return 0
+"""
+
+
+def load():
+    """Replace the in-memory flags and admin set with the ones in Redis."""
+    global _flags, _admins, _loaded
+    client = get_redis()
+    flags = dict(DEFAULT_FLAGS)
+    admins = set(_seed_admins)
+    if client is not None:
+        try:
+            pipe = client.pipeline()
+            pipe.hgetall(FLAGS_KEY)
+            pipe.smembers(ADMINS_KEY)
+            raw_flags, raw_admins = pipe.execute()
+            flags.update({name.decode(): json.loads(value) for name, value in raw_flags.items()})
+            admins = {int(telegram_id) for telegram_id in raw_admins}
+        except redis.RedisError as e:
+            log_error(f"Failed to load control flags: {str(e)}")
+            if _loaded:
+                return
+    with _lock:
+        _flags = flags
+        _admins = frozenset(admins)
+        _loaded = True
+
+
+def _ensure_loaded():
+    # Forked worker processes need their own listener
+    ensure_listener()
+    if not _loaded:
+        load()
+
+
+def get_flag(name, default=None):
+    _ensure_loaded()
+    return _flags.get(name, default)
+
+
+def is_maintenance():
+    return bool(get_flag('maintenance_mode'))
+
+
+def is_admin(telegram_id):
+    _ensure_loaded()
+    return telegram_id in _admins
+
+
+def get_admins():
+    _ensure_loaded()
+    return sorted(_admins)
+
+
+def _publish(change):
+    client = get_redis()
+    client.publish(CONTROL_CHANNEL, json.dumps(change))
+
+
+def _require_redis():
+    client = get_redis()
+    if client is None:
+        raise RuntimeError("REDIS_URL is not configured, runtime flags can't be changed")
+    return client
+
+
+def set_flag(name, value):
+    client = _require_redis()
+    if value is None:
+        client.hdel(FLAGS_KEY, name)
+    else:
+        client.hset(FLAGS_KEY, name, json.dumps(value))
+    _publish({'flag': name})
+    load()
+    log_info(f"Control flag {name} set to {value}")
+
+
+def add_admin(telegram_id):
+    _require_redis().sadd(ADMINS_KEY, telegram_id)
+    _publish({'admins': True})
+    load()
+
+
+def remove_admin(telegram_id):
+    _require_redis().srem(ADMINS_KEY, telegram_id)
+    _publish({'admins': True})
+    load()
+
+
+def seed_admins(telegram_ids):
+    """
+    Add admins known elsewhere (users.is_admin) to the shared set the first
+    time any process starts; later changes go through add_admin and
+    remove_admin. Also the admin set while Redis is unavailable.
+    """
+    global _seed_admins
+    _seed_admins = frozenset(telegram_ids)
+    client = get_redis()
+    if client is not None:
+        try:
+            client.eval(_SEED_SCRIPT, 2, ADMINS_KEY, SEEDED_KEY, *_seed_admins)
+        except redis.RedisError as e:
+            log_error(f"Failed to seed admins: {str(e)}")
+    load()
+
+
+def _on_change(data):
+    load()
+
+
+subscribe(CONTROL_CHANNEL, _on_change, on_reconnect=load)
@@ -0,0 +1,91 @@
+"""
+One bot message per multi-step flow.
+
+The /add, /update, /delete and *ref flows send a single message and then
+edit its text and inline keyboard as the user moves through the steps, so a
+flow costs one sendMessage however many steps or retries it takes. Buttons
+carry FLOW_CALLBACK_PREFIX plus the value a user could also type.
+"""
+from telebot.apihelper import ApiTelegramException
+from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+FLOW_CALLBACK_PREFIX = "flow:"
+CANCEL = "cancel"
+SKIP = "skip"
+
+# Telegram errors meaning the flow message is gone or too old to edit
+_UNEDITABLE_ERRORS = ("message to edit not found", "message can't be edited")
+
+
+def flow_button(text, value):
+    return InlineKeyboardButton(text, callback_data=f"{FLOW_CALLBACK_PREFIX}{value}")
+
+
+def flow_keyboard(*rows):
+    """Inline keyboard with one row per (text, value) list."""
+    keyboard = InlineKeyboardMarkup()
+    for row in rows:
+        if row:
+            keyboard.row(*[flow_button(text, value) for text, value in row])
+    return keyboard
+
+
+def cancel_keyboard(skip=False):
+    if skip:
+        return flow_keyboard([("Skip", SKIP), ("Cancel", CANCEL)])
+    return flow_keyboard([("Cancel", CANCEL)])
+
+
+class FlowMessage:
+    """The message a flow keeps editing, identified by chat and message id."""
+
+    def __init__(self, bot, chat_id, message_id=None, text=None, reply_to=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        # Message the first render replies to, usually the flow's command
+        self.reply_to = reply_to
+
+    @classmethod
+    def for_message(cls, bot, message):
+        return cls(bot, message.chat.id, reply_to=message)
+
+    @classmethod
+    def from_callback(cls, bot, call):
+        return cls(bot, call.message.chat.id, call.message.message_id, call.message.text)
+
+    def render(self, text, keyboard=None):
+        """
+        Show text and keyboard: sent on the first render, edited in place
+        afterwards (only the keyboard if the text is unchanged).
+        """
+        if self.message_id is None:
+            self._send(text, keyboard)
+            return
+        try:
+            if text == self.text:
+                self.bot.edit_message_reply_markup(self.chat_id, self.message_id, reply_markup=keyboard)
+            else:
+                self.bot.edit_message_text(text, self.chat_id, self.message_id, reply_markup=keyboard)
+            self.text = text
+        except ApiTelegramException as e:
+            description = (e.description or "").lower()
+            if "message is not modified" in description:
+                return
+            if any(error in description for error in _UNEDITABLE_ERRORS):
+                self._send(text, keyboard)
+                return
+            raise
+
+    def close(self, text):
+        """Show the flow's outcome and remove its buttons."""
+        self.render(text)
+
+    def _send(self, text, keyboard):
+        if self.reply_to is not None:
+            sent = self.bot.reply_to(self.reply_to, text, reply_markup=keyboard)
+        else:
+            sent = self.bot.send_message(self.chat_id, text, reply_markup=keyboard)
+        self.message_id = sent.message_id
+        self.text = text
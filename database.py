@@ -1,25 +1,71 @@
+from datetime import date, datetime, timezone
 from psycopg2 import pool
+from psycopg2.extras import execute_values
 from config import *
-from logger import log_error
+from logger import log_error, log_info
+from cache import user_cache, telegram_user_cache
+import catalog
+import leaderboard
+import metrics
+from replicas import ReplicaRouter
+
+# Upper bound for a single page of activities, whatever the caller asks for
+MAX_PAGE_SIZE = 50
+
+
+def activity_partition_name(month_start):
+    return f"activities_y{month_start.year}m{month_start.month:02d}"
+
+
+def add_months(month_start, months):
+    month_index = month_start.year * 12 + month_start.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def month_start_utc(month_start):
+    return datetime(month_start.year, month_start.month, 1, tzinfo=timezone.utc)
 
 
 class Database:
     def __init__(self):
-        self.connection_pool = pool.SimpleConnectionPool(
+        self.connection_pool = self.create_pool()
+        self.replicas = ReplicaRouter(POSTGRES_REPLICA_DSNS)
+        self.init_db()
+
+    def create_pool(self):
+        # Threaded: the bot's handler threads and the broadcast send threads
+        # share it
+        return pool.ThreadedConnectionPool(
             1, 20,
             host=POSTGRES_HOST,
             dbname=POSTGRES_DB,
             user=POSTGRES_USER,
             password=POSTGRES_PASSWORD,
-            port=5432
+            port=POSTGRES_PORT
         )
-        self.init_db()
 
-    def get_connection(self):
+    def reset_pool(self):
+        # Used after fork: connections inherited from the parent process must
+        # not be shared, so start a fresh pool without closing them.
+        self.connection_pool = self.create_pool()
+        self.replicas.reset()
+
+    def get_connection(self, replica=False, user_id=None):
+        """
+        A pooled connection to the primary or, for a read-only query with
+        replica=True, to a replica that is caught up (see replicas). Reads of
+        a user's own data pass user_id, so they stay on the primary right
+        after the user wrote.
+        """
+        if replica:
+            conn = self.replicas.getconn(user_id)
+            if conn is not None:
+                return conn
         return self.connection_pool.getconn()
 
     def release_connection(self, conn):
-        self.connection_pool.putconn(conn)
+        if not self.replicas.putconn(conn):
+            self.connection_pool.putconn(conn)
 
     def init_db(self):
         conn = self.get_connection()
@@ -36,6 +82,14 @@ class Database:
                         created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
+                # Whether broadcasts still reach the user; see mark_delivery_failed
+                cur.execute("""
+                    ALTER TABLE users
+                    ADD COLUMN IF NOT EXISTS delivery_status VARCHAR(20) NOT NULL DEFAULT 'active',
+                    ADD COLUMN IF NOT EXISTS delivery_failures INTEGER NOT NULL DEFAULT 0,
+                    ADD COLUMN IF NOT EXISTS last_delivery_error TEXT,
+                    ADD COLUMN IF NOT EXISTS last_delivery_error_at TIMESTAMP WITH TIME ZONE
+                """)
                 cur.execute("""
                     CREATE TABLE IF NOT EXISTS reference_activities (
                         id SERIAL PRIMARY KEY,
@@ -45,16 +99,321 @@ class Database:
                         created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
                     )
                 """)
+                # Set when a reference activity is deleted; its activities are
+                # removed in the background by tasks.purge_reference_activity
+                cur.execute("ALTER TABLE reference_activities ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP WITH TIME ZONE")
+                self.create_catalog_tables(cur)
+                self.create_challenge_tables(cur)
+                cur.execute("SELECT to_regclass('activities') IS NOT NULL")
+                activities_exists = cur.fetchone()[0]
+                if not activities_exists:
+                    self.create_activities_table(cur)
+                elif not self._is_partitioned(cur, 'activities'):
+                    log_info("activities is not partitioned yet, run: python -m migrations.partition_activities")
+                # Backs keyset pagination and the per-user date range queries
                 cur.execute("""
-                    CREATE TABLE IF NOT EXISTS activities (
-                        id SERIAL PRIMARY KEY,
-                        user_id INTEGER REFERENCES users(id),
-                        reference_activity_id INTEGER REFERENCES reference_activities(id),
-                        value INTEGER NOT NULL,
-                        created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-                    )
+                    CREATE INDEX IF NOT EXISTS idx_activities_user_created
+                    ON activities (user_id, created_at, id)
+                """)
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_activities_reference
+                    ON activities (reference_activity_id)
                 """)
+                # The Redis stream entry a write-behind activity came from, so
+                # a redelivered entry isn't inserted twice (see add_activities)
+                cur.execute("ALTER TABLE activities ADD COLUMN IF NOT EXISTS stream_entry_id VARCHAR(32)")
+                cur.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS idx_activities_stream_entry
+                    ON activities (stream_entry_id, created_at)
+                    WHERE stream_entry_id IS NOT NULL
+                """)
+                conn.commit()
+        finally:
+            self.release_connection(conn)
+        try:
+            self.ensure_activity_partitions()
+        except Exception as e:
+            # The nightly task retries; missing months only fall back to activities_default
+            log_error(f"Error creating activity partitions: {str(e)}")
+
+    def create_catalog_tables(self, cur):
+        # The shared exercise catalog and its alias index, see catalog
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS activity_catalog (
+                id SERIAL PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                activity_type VARCHAR(50) NOT NULL,
+                UNIQUE (name, activity_type)
+            )
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS activity_aliases (
+                alias VARCHAR(255) NOT NULL,
+                activity_type VARCHAR(50) NOT NULL,
+                catalog_id INTEGER NOT NULL REFERENCES activity_catalog(id),
+                PRIMARY KEY (alias, activity_type)
+            )
+        """)
+        cur.execute("""
+            ALTER TABLE reference_activities
+            ADD COLUMN IF NOT EXISTS catalog_id INTEGER REFERENCES activity_catalog(id)
+        """)
+        # Per user totals of each catalog exercise per week and month (UTC),
+        # kept up to date by every activity write
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS activity_rollups (
+                catalog_id INTEGER NOT NULL REFERENCES activity_catalog(id),
+                period VARCHAR(5) NOT NULL,
+                period_start DATE NOT NULL,
+                user_id INTEGER NOT NULL REFERENCES users(id),
+                total BIGINT NOT NULL DEFAULT 0,
+                entries INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (catalog_id, period, period_start, user_id)
+            )
+        """)
+        # Leaderboards are index-only scans in total order
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_activity_rollups_leaderboard
+            ON activity_rollups (catalog_id, period, period_start, total DESC)
+            INCLUDE (user_id, entries)
+        """)
+        execute_values(cur, """
+            INSERT INTO activity_catalog (name, activity_type) VALUES %s
+            ON CONFLICT DO NOTHING
+        """, [(name, activity_type) for name, activity_type, _ in catalog.SEED_CATALOG])
+        execute_values(cur, """
+            INSERT INTO activity_aliases (alias, activity_type, catalog_id)
+            SELECT v.alias, v.activity_type, c.id
+            FROM (VALUES %s) AS v(alias, activity_type, name)
+            JOIN activity_catalog c ON c.name = v.name AND c.activity_type = v.activity_type
+            ON CONFLICT DO NOTHING
+        """, catalog.seed_aliases(), page_size=1000)
+
+    def create_challenge_tables(self, cur):
+        # Challenge windows (end_date inclusive) and who takes part. Shared
+        # challenges are listed for everyone, personal ones only joined by id.
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS challenges (
+                id SERIAL PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                start_date DATE NOT NULL,
+                end_date DATE NOT NULL,
+                target_days INTEGER NOT NULL,
+                shared BOOLEAN NOT NULL DEFAULT FALSE,
+                created_by INTEGER REFERENCES users(id),
+                created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                CHECK (end_date >= start_date)
+            )
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_challenges_shared_end
+            ON challenges (end_date) WHERE shared
+        """)
+        # A user's current challenge is the one they selected last
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS challenge_members (
+                challenge_id INTEGER NOT NULL REFERENCES challenges(id),
+                user_id INTEGER NOT NULL REFERENCES users(id),
+                joined_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                selected_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (challenge_id, user_id)
+            )
+        """)
+        cur.execute("""
+            CREATE INDEX IF NOT EXISTS idx_challenge_members_user_selected
+            ON challenge_members (user_id, selected_at DESC)
+        """)
+
+    def resolve_catalog_id(self, cur, activity_name, activity_type):
+        """Catalog entry of a reference activity name, added if the catalog doesn't know it."""
+        keys = catalog.alias_keys(activity_name)
+        query = """
+            SELECT catalog_id FROM activity_aliases
+            WHERE alias = ANY(%s) AND activity_type = %s
+            ORDER BY alias = %s DESC
+            LIMIT 1
+        """
+        cur.execute(query, (keys, activity_type, keys[0]))
+        row = cur.fetchone()
+        if row:
+            return row[0]
+        cur.execute("""
+            INSERT INTO activity_catalog (name, activity_type) VALUES (%s, %s)
+            ON CONFLICT (name, activity_type) DO UPDATE SET name = EXCLUDED.name
+            RETURNING id
+        """, (activity_name.strip(), activity_type))
+        catalog_id = cur.fetchone()[0]
+        execute_values(cur, """
+            INSERT INTO activity_aliases (alias, activity_type, catalog_id) VALUES %s
+            ON CONFLICT DO NOTHING
+        """, [(key, activity_type, catalog_id) for key in keys])
+        # Another user may have added the same name meanwhile
+        cur.execute(query, (keys, activity_type, keys[0]))
+        return cur.fetchone()[0]
+
+    def rollup_activities(self, cur, activities):
+        """
+        Apply (user_id, reference_activity_id, value, created_at, +1 or -1)
+        changes to activity_rollups, in the caller's transaction.
+        """
+        if not activities:
+            return
+        execute_values(cur, """
+            INSERT INTO activity_rollups (catalog_id, period, period_start, user_id, total, entries)
+            SELECT r.catalog_id, p.period, date_trunc(p.period, v.created_at AT TIME ZONE 'UTC')::date,
+                   v.user_id, SUM(v.value * v.sign), SUM(v.sign)
+            FROM (VALUES %s) AS v(user_id, reference_activity_id, value, created_at, sign)
+            JOIN reference_activities r ON r.id = v.reference_activity_id
+                AND r.catalog_id IS NOT NULL AND r.deleted_at IS NULL
+            CROSS JOIN (VALUES ('week'), ('month')) AS p(period)
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (catalog_id, period, period_start, user_id) DO UPDATE
+            SET total = activity_rollups.total + EXCLUDED.total,
+                entries = activity_rollups.entries + EXCLUDED.entries
+        """, activities, template="(%s::integer, %s::integer, %s::bigint, %s::timestamptz, %s::integer)",
+            page_size=len(activities))
+
+    def rollup_reference_activity(self, cur, reference_activity_id, sign):
+        """Add (sign 1) or remove (sign -1) every activity of a reference activity from the rollups."""
+        cur.execute("""
+            INSERT INTO activity_rollups (catalog_id, period, period_start, user_id, total, entries)
+            SELECT r.catalog_id, p.period, date_trunc(p.period, a.created_at AT TIME ZONE 'UTC')::date,
+                   a.user_id, SUM(a.value) * %s, COUNT(*) * %s
+            FROM activities a
+            JOIN reference_activities r ON r.id = a.reference_activity_id AND r.catalog_id IS NOT NULL
+            CROSS JOIN (VALUES ('week'), ('month')) AS p(period)
+            WHERE a.reference_activity_id = %s
+            GROUP BY 1, 2, 3, 4
+            ON CONFLICT (catalog_id, period, period_start, user_id) DO UPDATE
+            SET total = activity_rollups.total + EXCLUDED.total,
+                entries = activity_rollups.entries + EXCLUDED.entries
+        """, (sign, sign, reference_activity_id))
+
+    def create_activities_table(self, cur):
+        # Monthly range partitions on created_at, see ensure_activity_partitions.
+        # Rows outside every monthly partition land in activities_default.
+        cur.execute("""
+            CREATE TABLE activities (
+                id SERIAL,
+                user_id INTEGER REFERENCES users(id),
+                reference_activity_id INTEGER REFERENCES reference_activities(id),
+                value INTEGER NOT NULL,
+                created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                stream_entry_id VARCHAR(32),
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at)
+        """)
+        cur.execute("CREATE TABLE activities_default PARTITION OF activities DEFAULT")
+
+    def _is_partitioned(self, cur, table_name):
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM pg_partitioned_table p
+                JOIN pg_class c ON c.oid = p.partrelid
+                WHERE c.relname = %s AND pg_table_is_visible(c.oid)
+            )
+        """, (table_name,))
+        return cur.fetchone()[0]
+
+    def create_activity_partitions(self, cur, first_month, last_month):
+        """
+        Create the monthly partitions from first_month to last_month
+        (inclusive, both first days of a month in UTC). Returns the names of
+        the partitions that were created.
+        """
+        cur.execute("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'activities'::regclass
+        """)
+        existing = {row[0] for row in cur.fetchall()}
+        created = []
+        month_start = first_month
+        while month_start <= last_month:
+            name = activity_partition_name(month_start)
+            if name not in existing:
+                bounds = (month_start_utc(month_start), month_start_utc(add_months(month_start, 1)))
+                if 'activities_default' in existing:
+                    self._create_partition_from_default(cur, name, bounds)
+                else:
+                    cur.execute(f"""
+                        CREATE TABLE {name} PARTITION OF activities
+                        FOR VALUES FROM (%s) TO (%s)
+                    """, bounds)
+                created.append(name)
+            month_start = add_months(month_start, 1)
+        return created
+
+    def _create_partition_from_default(self, cur, name, bounds):
+        """
+        Postgres refuses a new partition while activities_default holds rows
+        in its range (e.g. an activity moved to a later month by /update), so
+        such rows are moved into it with the default partition detached.
+        """
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT 1 FROM activities_default WHERE created_at >= %s AND created_at < %s
+            )
+        """, bounds)
+        if not cur.fetchone()[0]:
+            cur.execute(f"""
+                CREATE TABLE {name} PARTITION OF activities
+                FOR VALUES FROM (%s) TO (%s)
+            """, bounds)
+            return
+        cur.execute("ALTER TABLE activities DETACH PARTITION activities_default")
+        cur.execute(f"""
+            CREATE TABLE {name} PARTITION OF activities
+            FOR VALUES FROM (%s) TO (%s)
+        """, bounds)
+        cur.execute("SELECT * FROM activities LIMIT 0")
+        columns = ", ".join(column[0] for column in cur.description)
+        cur.execute(f"""
+            WITH moved AS (
+                DELETE FROM activities_default WHERE created_at >= %s AND created_at < %s
+                RETURNING {columns}
+            )
+            INSERT INTO {name} ({columns}) SELECT {columns} FROM moved
+        """, bounds)
+        log_info(f"Moved {cur.rowcount} activities from activities_default to {name}")
+        cur.execute("ALTER TABLE activities ATTACH PARTITION activities_default DEFAULT")
+
+    def ensure_activity_partitions(self, months_ahead=ACTIVITY_PARTITION_MONTHS_AHEAD, months_back=0):
+        """
+        Make sure monthly partitions exist from months_back months ago up to
+        months_ahead months from now. No-op until activities is partitioned.
+        """
+        current_month = datetime.now(timezone.utc).date().replace(day=1)
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                if not self._is_partitioned(cur, 'activities'):
+                    return []
+                created = self.create_activity_partitions(
+                    cur, add_months(current_month, -months_back), add_months(current_month, months_ahead))
                 conn.commit()
+                return created
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.release_connection(conn)
+
+    def detach_activity_partition(self, month_start):
+        """
+        Detach one month of activities from the table. The partition stays
+        around as a standalone table to archive or drop.
+        """
+        name = activity_partition_name(month_start)
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"ALTER TABLE activities DETACH PARTITION {name}")
+                conn.commit()
+                return name
+        except Exception:
+            conn.rollback()
+            raise
         finally:
             self.release_connection(conn)
 
@@ -69,23 +428,36 @@ class Database:
                     SET username = EXCLUDED.username,
                         first_name = EXCLUDED.first_name,
                         last_name = EXCLUDED.last_name
-                    RETURNING id
+                    RETURNING id, xmax = 0
                 """, (telegram_id, username, first_name, last_name))
-                user_id = cur.fetchone()[0]
+                # xmax is 0 only for a freshly inserted row
+                user_id, inserted = cur.fetchone()
                 conn.commit()
+                telegram_user_cache.invalidate(telegram_id)
+                if inserted:
+                    metrics.record_signup()
                 return user_id
         finally:
             self.release_connection(conn)
 
     def get_user(self, telegram_id):
+        user = telegram_user_cache.get(telegram_id, 'user')
+        if user is not None:
+            return user
+
+        generation = telegram_user_cache.generation(telegram_id)
         conn = self.get_connection()
         try:
             with conn.cursor() as cur:
                 cur.execute("SELECT * FROM users WHERE telegram_id = %s", (telegram_id,))
-                return cur.fetchone()
+                user = cur.fetchone()
         finally:
             self.release_connection(conn)
 
+        if user is not None:
+            telegram_user_cache.set(telegram_id, 'user', user, generation)
+        return user
+
     def get_user_by_id(self, user_id):
         conn = self.get_connection()
         try:
@@ -95,38 +467,55 @@ class Database:
         finally:
             self.release_connection(conn)
 
+    def get_delivery_recipients(self, user_ids):
+        """(id, telegram_id, delivery_status, delivery_failures) of the users in user_ids."""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, telegram_id, delivery_status, delivery_failures
+                    FROM users
+                    WHERE id = ANY(%s)
+                    ORDER BY id
+                """, (list(user_ids),))
+                return cur.fetchall()
+        finally:
+            self.release_connection(conn)
+
     def add_reference_activity(self, user_id, activity_name, activity_type):
         conn = self.get_connection()
         try:
             with conn.cursor() as cur:
+                catalog_id = self.resolve_catalog_id(cur, activity_name, activity_type)
                 cur.execute("""
-                    INSERT INTO reference_activities (user_id, activity_name, activity_type)
-                    VALUES (%s, %s, %s)
+                    INSERT INTO reference_activities (user_id, activity_name, activity_type, catalog_id)
+                    VALUES (%s, %s, %s, %s)
                     RETURNING id
-                """, (user_id, activity_name, activity_type))
+                """, (user_id, activity_name, activity_type, catalog_id))
                 activity_id = cur.fetchone()[0]
                 conn.commit()
+                self.replicas.pin_user(user_id)
+                user_cache.invalidate(user_id)
                 return activity_id
         finally:
             self.release_connection(conn)
 
     def get_reference_activities(self, user_id, limit=None):
+        reference_activities = user_cache.get_or_set(
+            user_id, 'reference_activities', lambda: self._fetch_reference_activities(user_id))
+        return reference_activities[:limit] if limit else reference_activities
+
+    def _fetch_reference_activities(self, user_id):
         query = """
         SELECT id, activity_name, activity_type 
         FROM reference_activities 
-        WHERE user_id = %s 
+        WHERE user_id = %s AND deleted_at IS NULL
         ORDER BY id ASC
         """
-        if limit:
-            query += " LIMIT %s"
-            params = (user_id, limit)
-        else:
-            params = (user_id,)
-        
         conn = self.get_connection()
         try:
             with conn.cursor() as cur:
-                cur.execute(query, params)
+                cur.execute(query, (user_id,))
                 return cur.fetchall()
         finally:
             self.release_connection(conn)
@@ -138,14 +527,59 @@ class Database:
                 cur.execute("""
                     INSERT INTO activities (user_id, reference_activity_id, value)
                     VALUES (%s, %s, %s)
-                    RETURNING id
+                    RETURNING id, created_at
                 """, (user_id, reference_activity_id, value))
-                activity_id = cur.fetchone()[0]
+                activity_id, created_at = cur.fetchone()
+                self.rollup_activities(cur, [(user_id, reference_activity_id, value, created_at, 1)])
                 conn.commit()
+                self.replicas.pin_user(user_id)
+                metrics.record_activities([(user_id, created_at)])
+                leaderboard.record_added([(user_id, created_at)])
+                # The reference activity is no longer unused
+                unused = user_cache.get(user_id, 'unused_reference_activities')
+                if unused and any(reference[0] == reference_activity_id for reference in unused):
+                    user_cache.invalidate(user_id, prefix='unused_reference_activities')
+                user_cache.invalidate(user_id, prefix='activities')
                 return activity_id
         finally:
             self.release_connection(conn)
 
+    def add_activities(self, activities, stream_entry_ids=None):
+        """
+        Insert (user_id, reference_activity_id, value, created_at) rows in a
+        single statement and commit. The write-behind activity writer passes
+        the stream entry id of each row; rows whose entry was already
+        inserted are skipped. Returns the ids of the inserted rows.
+        """
+        if not activities:
+            return []
+        rows = [activity + (entry_id,)
+                for activity, entry_id in zip(activities, stream_entry_ids or [None] * len(activities))]
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                inserted = execute_values(cur, """
+                    INSERT INTO activities (user_id, reference_activity_id, value, created_at, stream_entry_id)
+                    VALUES %s
+                    ON CONFLICT (stream_entry_id, created_at) WHERE stream_entry_id IS NOT NULL DO NOTHING
+                    RETURNING id, user_id, reference_activity_id, value, created_at
+                """, rows, page_size=len(rows), fetch=True)
+                activities = [tuple(row[1:]) for row in inserted]
+                self.rollup_activities(cur, [activity + (1,) for activity in activities])
+                conn.commit()
+                metrics.record_activities([(activity[0], activity[3]) for activity in activities])
+                leaderboard.record_added([(activity[0], activity[3]) for activity in activities])
+                for user_id in {activity[0] for activity in activities}:
+                    self.replicas.pin_user(user_id)
+                    user_cache.invalidate(user_id, prefix='unused_reference_activities')
+                    user_cache.invalidate(user_id, prefix='activities')
+                return [row[0] for row in inserted]
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            self.release_connection(conn)
+
     def get_activities(self, user_id):
         conn = self.get_connection()
         try:
@@ -154,7 +588,7 @@ class Database:
                     SELECT a.id, r.activity_name, a.value, r.activity_type, a.created_at
                     FROM activities a
                     JOIN reference_activities r ON a.reference_activity_id = r.id
-                    WHERE a.user_id = %s
+                    WHERE a.user_id = %s AND r.deleted_at IS NULL
                     ORDER BY a.created_at DESC
                 """, (user_id,))
                 return cur.fetchall()
@@ -195,9 +629,29 @@ class Database:
                 
                 # Execute the query only if there are parameters to update
                 if update_params:
+                    # The rollups and the leaderboard move the activity from its old values
+                    cur.execute("""
+                        SELECT reference_activity_id, value, created_at FROM activities
+                        WHERE id = %s AND user_id = %s
+                        FOR UPDATE
+                    """, (activity_id, user_id))
+                    previous = cur.fetchone()
                     cur.execute(update_query, update_params)
+                    updated = cur.rowcount > 0
+                    if updated:
+                        reference_activity_id, previous_value, previous_created_at = previous
+                        self.rollup_activities(cur, [
+                            (user_id, reference_activity_id, previous_value, previous_created_at, -1),
+                            (user_id, reference_activity_id, previous_value if value is None else value,
+                             previous_created_at if created_at is None else created_at, 1),
+                        ])
                     conn.commit()
-                    return cur.rowcount > 0
+                    if updated:
+                        self.replicas.pin_user(user_id)
+                    user_cache.invalidate(user_id, prefix='activities')
+                    if updated and created_at is not None:
+                        leaderboard.record_changes([(user_id, previous_created_at, -1), (user_id, created_at, 1)])
+                    return updated
                 else:
                     return False  # No updates were made
         except Exception as e:
@@ -213,10 +667,19 @@ class Database:
                 cur.execute("""
                     DELETE FROM activities
                     WHERE id = %s AND user_id = %s
+                    RETURNING created_at, reference_activity_id, value
                 """, (activity_id, user_id))
-                deleted = cur.rowcount > 0
+                row = cur.fetchone()
+                if row:
+                    self.rollup_activities(cur, [(user_id, row[1], row[2], row[0], -1)])
                 conn.commit()
-                return deleted
+                if row:
+                    self.replicas.pin_user(user_id)
+                    # Its reference activity may have become unused
+                    user_cache.invalidate(user_id, prefix='unused_reference_activities')
+                    user_cache.invalidate(user_id, prefix='activities')
+                    leaderboard.record_removed([(user_id, row[0])])
+                return row is not None
         except Exception as e:
             log_error(f"Error deleting activity: {str(e)}")
             return False
@@ -228,11 +691,11 @@ class Database:
         SELECT a.id, ra.activity_name, a.value, ra.activity_type, a.created_at
         FROM activities a
         JOIN reference_activities ra ON a.reference_activity_id = ra.id
-        WHERE a.user_id = %s
-        ORDER BY a.created_at DESC
+        WHERE a.user_id = %s AND ra.deleted_at IS NULL
+        ORDER BY a.created_at DESC, a.id DESC
         LIMIT %s
         """
-        conn = self.get_connection()
+        conn = self.get_connection(replica=True, user_id=user_id)
         try:
             with conn.cursor() as cur:
                 cur.execute(query, (user_id, limit))
@@ -240,33 +703,91 @@ class Database:
         finally:
             self.release_connection(conn)
 
+    def get_activities_page(self, user_id, limit, before=None, after=None):
+        """
+        Keyset pagination over a user's activities, newest first.
+
+        `before` and `after` are (created_at, id) cursors taken from the last
+        and first row of the current page. Returns (activities, has_older,
+        has_newer); each page is a bounded range scan of
+        idx_activities_user_created however far back it is.
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        query = """
+        SELECT a.id, ra.activity_name, a.value, ra.activity_type, a.created_at
+        FROM activities a
+        JOIN reference_activities ra ON a.reference_activity_id = ra.id
+        WHERE a.user_id = %s AND ra.deleted_at IS NULL
+        """
+        if after is not None:
+            query += " AND (a.created_at, a.id) > (%s, %s) ORDER BY a.created_at ASC, a.id ASC LIMIT %s"
+            params = (user_id, after[0], after[1], limit + 1)
+        elif before is not None:
+            query += " AND (a.created_at, a.id) < (%s, %s) ORDER BY a.created_at DESC, a.id DESC LIMIT %s"
+            params = (user_id, before[0], before[1], limit + 1)
+        else:
+            query += " ORDER BY a.created_at DESC, a.id DESC LIMIT %s"
+            params = (user_id, limit + 1)
+
+        conn = self.get_connection(replica=True, user_id=user_id)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, params)
+                rows = cur.fetchall()
+        finally:
+            self.release_connection(conn)
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if after is not None:
+            return list(reversed(rows)), True, has_more
+        return rows, has_more, before is not None
+
     def get_total_activities_count(self, user_id):
-        conn = self.get_connection()
+        return user_cache.get_or_set(user_id, 'activities:total_count',
+                                     lambda: self._fetch_total_activities_count(user_id))
+
+    def _fetch_total_activities_count(self, user_id):
+        conn = self.get_connection(replica=True, user_id=user_id)
         try:
             with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(*) FROM activities WHERE user_id = %s", (user_id,))
+                cur.execute("""
+                    SELECT COUNT(*)
+                    FROM activities a
+                    JOIN reference_activities r ON a.reference_activity_id = r.id
+                    WHERE a.user_id = %s AND r.deleted_at IS NULL
+                """, (user_id,))
                 return cur.fetchone()[0]
         finally:
             self.release_connection(conn)
 
     def get_unique_activities_count(self, user_id):
-        conn = self.get_connection()
+        return user_cache.get_or_set(user_id, 'activities:unique_count',
+                                     lambda: self._fetch_unique_activities_count(user_id))
+
+    def _fetch_unique_activities_count(self, user_id):
+        conn = self.get_connection(replica=True, user_id=user_id)
         try:
             with conn.cursor() as cur:
-                cur.execute("SELECT COUNT(DISTINCT reference_activity_id) FROM activities WHERE user_id = %s", (user_id,))
+                cur.execute("""
+                    SELECT COUNT(DISTINCT a.reference_activity_id)
+                    FROM activities a
+                    JOIN reference_activities r ON a.reference_activity_id = r.id
+                    WHERE a.user_id = %s AND r.deleted_at IS NULL
+                """, (user_id,))
                 return cur.fetchone()[0]
         finally:
             self.release_connection(conn)
 
     def get_most_frequent_activity(self, user_id):
-        conn = self.get_connection()
+        conn = self.get_connection(replica=True, user_id=user_id)
         try:
             with conn.cursor() as cur:
                 cur.execute("""
                     SELECT r.activity_name, COUNT(*) as count
                     FROM activities a
                     JOIN reference_activities r ON a.reference_activity_id = r.id
-                    WHERE a.user_id = %s
+                    WHERE a.user_id = %s AND r.deleted_at IS NULL
                     GROUP BY r.activity_name
                     ORDER BY count DESC
                 """, (user_id,))
@@ -275,20 +796,102 @@ class Database:
             self.release_connection(conn)
 
     def get_all_activities(self, user_id):
-        conn = self.get_connection()
+        return user_cache.get_or_set(user_id, 'activities:all',
+                                     lambda: self._fetch_all_activities(user_id))
+
+    def _fetch_all_activities(self, user_id):
+        conn = self.get_connection(replica=True, user_id=user_id)
         try:
             with conn.cursor() as cur:
                 cur.execute("""
                     SELECT a.id, r.activity_name, a.value, r.activity_type, a.created_at
                     FROM activities a
                     JOIN reference_activities r ON a.reference_activity_id = r.id
-                    WHERE a.user_id = %s
+                    WHERE a.user_id = %s AND r.deleted_at IS NULL
                     ORDER BY a.created_at DESC
                 """, (user_id,))
                 return cur.fetchall()
         finally:
             self.release_connection(conn)
 
+    def get_activity_history(self, user_id, start_date=None, end_date=None):
+        """
+        Every activity of the user as parallel lists, oldest first: reference
+        activity ids, values, days (since 1970-01-01) and Unix timestamps.
+        One row of arrays instead of a tuple per activity. With a challenge
+        window (both dates inclusive) only its days are read.
+        """
+        key = f'activities:history:{start_date}:{end_date}' if start_date else 'activities:history'
+        return user_cache.get_or_set(user_id, key,
+                                     lambda: self._fetch_activity_history(user_id, start_date, end_date))
+
+    def _fetch_activity_history(self, user_id, start_date=None, end_date=None):
+        window, params = self._challenge_window('a', start_date, end_date)
+        conn = self.get_connection(replica=True, user_id=user_id)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f"""
+                    SELECT COALESCE(array_agg(a.reference_activity_id ORDER BY a.created_at), '{{}}'),
+                           COALESCE(array_agg(a.value ORDER BY a.created_at), '{{}}'),
+                           COALESCE(array_agg(DATE(a.created_at) - DATE '1970-01-01' ORDER BY a.created_at), '{{}}'),
+                           COALESCE(array_agg(EXTRACT(EPOCH FROM a.created_at)::bigint ORDER BY a.created_at), '{{}}')
+                    FROM activities a
+                    JOIN reference_activities r ON a.reference_activity_id = r.id
+                    WHERE a.user_id = %s AND r.deleted_at IS NULL {window}
+                """, (user_id, *params))
+                return cur.fetchone()
+        finally:
+            self.release_connection(conn)
+
+    def get_daily_activity_totals(self, user_id, since):
+        """(reference id, name, type, day, total value) for every day with activities since `since`."""
+        return user_cache.get_or_set(user_id, f'activities:daily:{since.isoformat()}',
+                                     lambda: self._fetch_daily_activity_totals(user_id, since))
+
+    def _fetch_daily_activity_totals(self, user_id, since):
+        conn = self.get_connection(replica=True, user_id=user_id)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT r.id, r.activity_name, r.activity_type, DATE(a.created_at) AS day, SUM(a.value)
+                    FROM activities a
+                    JOIN reference_activities r ON a.reference_activity_id = r.id
+                    WHERE a.user_id = %s AND r.deleted_at IS NULL AND a.created_at >= %s::date
+                    GROUP BY r.id, r.activity_name, r.activity_type, DATE(a.created_at)
+                    ORDER BY r.id, day
+                """, (user_id, since))
+                return cur.fetchall()
+        finally:
+            self.release_connection(conn)
+
+    def stream_digest_rows(self, since, until, itersize=DIGEST_CURSOR_ITERSIZE):
+        """
+        Yield (user_id, telegram_id, activity name, activity type, day, value)
+        for every activity between since and until of every reachable user,
+        ordered by user_id. Users without activities come as one row of
+        NULLs. Rows are read through a server-side cursor, itersize at a time.
+        """
+        query = """
+        SELECT u.id, u.telegram_id, r.activity_name, r.activity_type, DATE(a.created_at), a.value
+        FROM users u
+        LEFT JOIN (activities a
+                   JOIN reference_activities r ON a.reference_activity_id = r.id AND r.deleted_at IS NULL)
+            ON a.user_id = u.id AND a.created_at >= %s::date AND a.created_at < %s::date
+        WHERE u.delivery_status = 'active'
+        ORDER BY u.id
+        """
+        # Stays on the primary: the cursor is open for the whole fan-out, long
+        # enough for a standby to cancel it over a recovery conflict, and
+        # delivery_status must be current so unreachable users are skipped
+        conn = self.get_connection()
+        try:
+            with conn.cursor(name='digest_rows') as cur:
+                cur.itersize = itersize
+                cur.execute(query, (since, until))
+                yield from cur
+        finally:
+            self.release_connection(conn)
+
     def get_last_activity(self, activity_name):
         conn = self.get_connection()
         try:
@@ -297,7 +900,7 @@ class Database:
                     SELECT a.id, a.value, a.created_at
                     FROM activities a
                     JOIN reference_activities r ON a.reference_activity_id = r.id
-                    WHERE r.activity_name = %s
+                    WHERE r.activity_name = %s AND r.deleted_at IS NULL
                     ORDER BY a.created_at DESC
                 """, (activity_name,))
                 return cur.fetchone()
@@ -312,7 +915,7 @@ class Database:
                     SELECT COUNT(*) as count
                     FROM activities a
                     JOIN reference_activities r ON a.reference_activity_id = r.id
-                    WHERE a.user_id = %s AND a.created_at >= CURRENT_DATE
+                    WHERE a.user_id = %s AND a.created_at >= CURRENT_DATE AND r.deleted_at IS NULL
                 """, (user_id,))
                 return cur.fetchone()[0]
         finally:
@@ -330,12 +933,13 @@ class Database:
                 """, (username, first_name, last_name, telegram_id))
                 user_id = cur.fetchone()[0]
                 conn.commit()
+                telegram_user_cache.invalidate(telegram_id)
                 return user_id
         finally:
             self.release_connection(conn)
 
-    def execute_query(self, query, params=None):
-        conn = self.get_connection()
+    def execute_query(self, query, params=None, replica=False, user_id=None):
+        conn = self.get_connection(replica=replica, user_id=user_id)
         try:
             with conn.cursor() as cur:
                 cur.execute(query, params)
@@ -344,13 +948,18 @@ class Database:
             self.release_connection(conn)
 
     def get_reference_activity(self, activity_id, user_id):
+        cached = user_cache.get(user_id, 'reference_activities')
+        if cached is not None:
+            reference = next((ref for ref in cached if ref[0] == activity_id), None)
+            return (reference[1], reference[2]) if reference else None
+
         conn = self.get_connection()
         try:
             with conn.cursor() as cur:
                 cur.execute("""
                     SELECT activity_name, activity_type
                     FROM reference_activities
-                    WHERE id = %s AND user_id = %s
+                    WHERE id = %s AND user_id = %s AND deleted_at IS NULL
                 """, (activity_id, user_id))
                 return cur.fetchone()
         finally:
@@ -360,37 +969,109 @@ class Database:
         conn = self.get_connection()
         try:
             with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT catalog_id FROM reference_activities
+                    WHERE id = %s AND user_id = %s AND deleted_at IS NULL
+                    FOR UPDATE
+                """, (activity_id, user_id))
+                previous = cur.fetchone()
+                catalog_id = self.resolve_catalog_id(cur, new_name, new_type)
+                # A renamed exercise takes its totals to its new catalog entry
+                moved = previous is not None and previous[0] != catalog_id
+                if moved:
+                    self.rollup_reference_activity(cur, activity_id, -1)
                 cur.execute("""
                     UPDATE reference_activities
-                    SET activity_name = %s, activity_type = %s
-                    WHERE id = %s AND user_id = %s
+                    SET activity_name = %s, activity_type = %s, catalog_id = %s
+                    WHERE id = %s AND user_id = %s AND deleted_at IS NULL
                     RETURNING id
-                """, (new_name, new_type, activity_id, user_id))
+                """, (new_name, new_type, catalog_id, activity_id, user_id))
                 updated_id = cur.fetchone()
+                if moved:
+                    self.rollup_reference_activity(cur, activity_id, 1)
                 conn.commit()
+                self.replicas.pin_user(user_id)
+                user_cache.invalidate(user_id)
                 return updated_id is not None
         finally:
             self.release_connection(conn)
 
     def delete_reference_activity(self, activity_id, user_id):
+        """
+        Mark a reference activity as deleted, which hides it and its
+        activities from every query. The activities themselves are removed
+        in batches by tasks.purge_reference_activity.
+        """
         conn = self.get_connection()
         try:
             with conn.cursor() as cur:
-                # First, delete all activities associated with this reference activity
-                cur.execute("""
-                    DELETE FROM activities
-                    WHERE reference_activity_id = %s AND user_id = %s
-                """, (activity_id, user_id))
-                
-                # Then, delete the reference activity itself
                 cur.execute("""
-                    DELETE FROM reference_activities
-                    WHERE id = %s AND user_id = %s
+                    UPDATE reference_activities
+                    SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE id = %s AND user_id = %s AND deleted_at IS NULL
                     RETURNING id
                 """, (activity_id, user_id))
                 deleted_id = cur.fetchone()
+                if deleted_id is not None:
+                    self.rollup_reference_activity(cur, activity_id, -1)
                 conn.commit()
-                return deleted_id is not None
+                self.replicas.pin_user(user_id)
+                user_cache.invalidate(user_id)
+        finally:
+            self.release_connection(conn)
+        if deleted_id is not None:
+            # Its activities no longer count, however many days they span
+            leaderboard.replace_user(user_id, self.get_leaderboard_days(user_id))
+        return deleted_id is not None
+
+    def delete_activities_for_reference_batch(self, reference_activity_id, user_id, batch_size):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                # Bounded by batch_size so each transaction holds its row
+                # locks briefly; the subquery is served by idx_activities_reference
+                cur.execute("""
+                    DELETE FROM activities
+                    WHERE (id, created_at) IN (
+                        SELECT id, created_at
+                        FROM activities
+                        WHERE reference_activity_id = %s AND user_id = %s
+                        LIMIT %s
+                    )
+                """, (reference_activity_id, user_id, batch_size))
+                deleted = cur.rowcount
+                conn.commit()
+                return deleted
+        finally:
+            self.release_connection(conn)
+
+    def purge_reference_activity(self, activity_id, user_id):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM reference_activities r
+                    WHERE r.id = %s AND r.user_id = %s AND r.deleted_at IS NOT NULL
+                    AND NOT EXISTS (SELECT 1 FROM activities a WHERE a.reference_activity_id = r.id)
+                    RETURNING r.id
+                """, (activity_id, user_id))
+                purged_id = cur.fetchone()
+                conn.commit()
+                return purged_id is not None
+        finally:
+            self.release_connection(conn)
+
+    def get_pending_reference_deletions(self):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, user_id
+                    FROM reference_activities
+                    WHERE deleted_at IS NOT NULL
+                    ORDER BY deleted_at ASC
+                """)
+                return cur.fetchall()
         finally:
             self.release_connection(conn)
 
@@ -416,14 +1097,122 @@ class Database:
         finally:
             self.release_connection(conn)
 
+    def get_admin_telegram_ids(self):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT telegram_id FROM users WHERE is_admin = TRUE")
+                return [row[0] for row in cur.fetchall()]
+        finally:
+            self.release_connection(conn)
+
+    def set_admin(self, telegram_id, is_admin):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE users
+                    SET is_admin = %s
+                    WHERE telegram_id = %s
+                    RETURNING id
+                """, (is_admin, telegram_id))
+                row = cur.fetchone()
+                conn.commit()
+                telegram_user_cache.invalidate(telegram_id)
+                if row:
+                    # Admins are left out of the ranking
+                    leaderboard.set_excluded(row[0], is_admin)
+                return row is not None
+        finally:
+            self.release_connection(conn)
+
+    def get_reachable_users(self):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT id, telegram_id FROM users WHERE delivery_status = 'active' ORDER BY id")
+                return cur.fetchall()
+        finally:
+            self.release_connection(conn)
+
+    def mark_delivery_succeeded(self, user_id):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                # Only writes when there are failures to clear
+                cur.execute("""
+                    UPDATE users
+                    SET delivery_failures = 0
+                    WHERE id = %s AND delivery_failures > 0
+                    RETURNING telegram_id
+                """, (user_id,))
+                row = cur.fetchone()
+                conn.commit()
+                if row:
+                    telegram_user_cache.invalidate(row[0])
+        finally:
+            self.release_connection(conn)
+
+    def mark_delivery_failed(self, user_id, error, permanent=False):
+        """
+        Record a send the chat refused. Permanent failures (bot blocked, chat
+        gone) make the user unreachable at once, other chat errors after
+        DELIVERY_MAX_FAILURES in a row. Rate limits and Telegram server errors
+        aren't recorded (see tasks.is_chat_delivery_error). Returns the
+        resulting delivery status.
+        """
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE users
+                    SET delivery_failures = delivery_failures + 1,
+                        last_delivery_error = %s,
+                        last_delivery_error_at = CURRENT_TIMESTAMP,
+                        delivery_status = CASE
+                            WHEN %s THEN 'blocked'
+                            WHEN delivery_failures + 1 >= %s THEN 'unreachable'
+                            ELSE delivery_status
+                        END
+                    WHERE id = %s
+                    RETURNING telegram_id, delivery_status
+                """, (error[:1000], permanent, DELIVERY_MAX_FAILURES, user_id))
+                row = cur.fetchone()
+                conn.commit()
+                if row is None:
+                    return None
+                telegram_user_cache.invalidate(row[0])
+                return row[1]
+        finally:
+            self.release_connection(conn)
+
+    def reactivate_user(self, telegram_id):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    UPDATE users
+                    SET delivery_status = 'active', delivery_failures = 0
+                    WHERE telegram_id = %s AND delivery_status <> 'active'
+                    RETURNING id
+                """, (telegram_id,))
+                reactivated = cur.fetchone() is not None
+                conn.commit()
+                if reactivated:
+                    telegram_user_cache.invalidate(telegram_id)
+                return reactivated
+        finally:
+            self.release_connection(conn)
+
     def get_activities_count_last_24h(self, start_time, end_time):
         conn = self.get_connection()
         try:
             with conn.cursor() as cur:
                 query = """
                 SELECT COUNT(*) 
-                FROM activities 
-                WHERE created_at BETWEEN %s AND %s
+                FROM activities a
+                JOIN reference_activities r ON a.reference_activity_id = r.id
+                WHERE a.created_at BETWEEN %s AND %s AND r.deleted_at IS NULL
                 """
                 cur.execute(query, (start_time, end_time))
                 return cur.fetchone()[0]
@@ -439,21 +1228,123 @@ class Database:
         finally:
             self.release_connection(conn)
 
+    # SQL fallbacks for the /admin counters (see metrics). Like the counters,
+    # they include activities of deleted reference activities until purged.
+    def get_hourly_activity_counts(self, start_time, end_time):
+        """{UTC hour start: activities} for hours with activities."""
+        conn = self.get_connection(replica=True)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT date_trunc('hour', created_at AT TIME ZONE 'UTC'), COUNT(*)
+                    FROM activities
+                    WHERE created_at >= %s AND created_at < %s
+                    GROUP BY 1
+                """, (start_time, end_time))
+                return {hour.replace(tzinfo=timezone.utc): count for hour, count in cur.fetchall()}
+        finally:
+            self.release_connection(conn)
+
+    def get_active_users_count(self, start_time, end_time):
+        conn = self.get_connection(replica=True)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT COUNT(DISTINCT user_id)
+                    FROM activities
+                    WHERE created_at >= %s AND created_at < %s
+                """, (start_time, end_time))
+                return cur.fetchone()[0]
+        finally:
+            self.release_connection(conn)
+
+    def get_signups_count(self, start_time, end_time):
+        conn = self.get_connection(replica=True)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT COUNT(*) FROM users
+                    WHERE created_at >= %s AND created_at < %s
+                """, (start_time, end_time))
+                return cur.fetchone()[0]
+        finally:
+            self.release_connection(conn)
+
+    def get_daily_engagement(self, start_time, end_time):
+        """{UTC day: (activities, active users, signups)} for days with any of them."""
+        conn = self.get_connection(replica=True)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT COALESCE(a.day, s.day), COALESCE(a.activities, 0),
+                           COALESCE(a.active_users, 0), COALESCE(s.signups, 0)
+                    FROM (
+                        SELECT (created_at AT TIME ZONE 'UTC')::date AS day,
+                               COUNT(*) AS activities, COUNT(DISTINCT user_id) AS active_users
+                        FROM activities
+                        WHERE created_at >= %(start)s AND created_at < %(end)s
+                        GROUP BY 1
+                    ) a
+                    FULL JOIN (
+                        SELECT (created_at AT TIME ZONE 'UTC')::date AS day, COUNT(*) AS signups
+                        FROM users
+                        WHERE created_at >= %(start)s AND created_at < %(end)s
+                        GROUP BY 1
+                    ) s ON s.day = a.day
+                """, {'start': start_time, 'end': end_time})
+                return {day: (activities, active_users, signups)
+                        for day, activities, active_users, signups in cur.fetchall()}
+        finally:
+            self.release_connection(conn)
+
     def was_user_active_today(self, user_id, date):
+        # A range on created_at (rather than DATE(created_at)) lets Postgres
+        # prune partitions and use idx_activities_user_created
         query = """
-        SELECT COUNT(*) FROM activities 
-        JOIN users ON users.id = activities.user_id
-        WHERE users.id = %s AND DATE(activities.created_at) = %s
+        SELECT EXISTS (
+            SELECT 1 FROM activities a
+            JOIN reference_activities r ON a.reference_activity_id = r.id
+            WHERE a.user_id = %s AND r.deleted_at IS NULL
+            AND a.created_at >= %s::date AND a.created_at < %s::date + 1
+        )
         """
         conn = self.get_connection()
         try:
             with conn.cursor() as cur:
-                cur.execute(query, (user_id, date))
-                count = cur.fetchone()[0]
-                return count > 0
+                cur.execute(query, (user_id, date, date))
+                return cur.fetchone()[0]
         finally:
             self.release_connection(conn)
 
+    def get_users_active_on(self, user_ids, date):
+        """Batch version of was_user_active_today: the subset of user_ids active on date."""
+        query = """
+        SELECT DISTINCT a.user_id
+        FROM activities a
+        JOIN reference_activities r ON a.reference_activity_id = r.id
+        WHERE a.user_id = ANY(%s) AND r.deleted_at IS NULL
+        AND a.created_at >= %s::date AND a.created_at < %s::date + 1
+        """
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, (list(user_ids), date, date))
+                return {row[0] for row in cur.fetchall()}
+        finally:
+            self.release_connection(conn)
+
+    @staticmethod
+    def _challenge_window(alias, start_date, end_date):
+        """
+        SQL condition and parameters limiting activities to a challenge
+        window: a range on created_at, so Postgres prunes partitions and
+        walks idx_activities_user_created instead of reading all history.
+        """
+        if start_date is None:
+            return "", ()
+        column = f"{alias}.created_at" if alias else "created_at"
+        return (f"AND {column} >= %s::date AND {column} < %s::date + 1", (start_date, end_date))
+
     def get_activity_streaks(self, user_id):
         query = """
         WITH daily_activity AS (
@@ -471,10 +1362,12 @@ class Database:
         FROM users u
         JOIN reference_activities ra ON ra.user_id = u.id
         LEFT JOIN activity_counts ac ON u.id = ac.user_id AND ra.id = ac.reference_activity_id
-        WHERE u.id = %s
+        WHERE u.id = %s AND ra.deleted_at IS NULL
         ORDER BY ra.activity_name;
         """
-        return self.execute_query(query, (user_id, user_id))
+        return user_cache.get_or_set(user_id, 'activities:streaks',
+                                     lambda: self.execute_query(query, (user_id, user_id),
+                                                                replica=True, user_id=user_id))
 
     def update_activity_datetime(self, activity_id, user_id, new_datetime):
         try:
@@ -504,6 +1397,11 @@ class Database:
             self.release_connection(conn)
 
     def get_reference_activities_without_activities(self, user_id):
+        return user_cache.get_or_set(
+            user_id, 'unused_reference_activities',
+            lambda: self._fetch_reference_activities_without_activities(user_id))
+
+    def _fetch_reference_activities_without_activities(self, user_id):
         conn = self.get_connection()
         try:
             with conn.cursor() as cur:
@@ -511,7 +1409,7 @@ class Database:
                     SELECT r.id, r.activity_name, r.activity_type
                     FROM reference_activities r
                     LEFT JOIN activities a ON r.id = a.reference_activity_id
-                    WHERE r.user_id = %s
+                    WHERE r.user_id = %s AND r.deleted_at IS NULL
                     GROUP BY r.id
                     HAVING COUNT(a.id) = 0
                     ORDER BY r.id ASC
@@ -523,13 +1421,14 @@ class Database:
     # Add this new method to the Database class
 
     def get_global_ranking(self):
+        # Days are UTC days, like the leaderboard's "your rank" shown below it
         query = """
         SELECT 
             COALESCE(u.first_name, 'N/A') AS name,
             COUNT(DISTINCT ra.id) AS total_activities,
             COALESCE(SUM(CASE WHEN ra.activity_type = 'time' THEN a.value ELSE 0 END), 0) AS total_time,
             COALESCE(SUM(CASE WHEN ra.activity_type = 'reps' THEN a.value ELSE 0 END), 0) AS total_reps,
-            COUNT(DISTINCT DATE(a.created_at)) AS days_active,
+            COUNT(DISTINCT (a.created_at AT TIME ZONE 'UTC')::date) AS days_active,
             MAX(a.created_at) AS last_active
         FROM 
             users u
@@ -538,7 +1437,7 @@ class Database:
         INNER JOIN 
             reference_activities ra ON a.reference_activity_id = ra.id
         WHERE 
-            u.is_admin = FALSE
+            u.is_admin = FALSE AND ra.deleted_at IS NULL
         GROUP BY 
             u.id, u.first_name
         HAVING
@@ -547,12 +1446,275 @@ class Database:
             days_active DESC, last_active DESC, total_time DESC, total_reps DESC
         LIMIT 10
         """
+        conn = self.get_connection(replica=True)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query)
+                return cur.fetchall()
+        finally:
+            self.release_connection(conn)
+
+    def create_challenge(self, name, start_date, end_date, target_days, created_by, shared=False):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO challenges (name, start_date, end_date, target_days, shared, created_by)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    RETURNING id
+                """, (name, start_date, end_date, target_days, shared, created_by))
+                challenge_id = cur.fetchone()[0]
+                conn.commit()
+                return challenge_id
+        finally:
+            self.release_connection(conn)
+
+    def get_challenge(self, challenge_id):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, name, start_date, end_date, target_days, shared
+                    FROM challenges WHERE id = %s
+                """, (challenge_id,))
+                return cur.fetchone()
+        finally:
+            self.release_connection(conn)
+
+    def select_challenge(self, challenge_id, user_id):
+        """Join a challenge, or switch back to one already joined, making it the user's current one."""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    INSERT INTO challenge_members (challenge_id, user_id)
+                    VALUES (%s, %s)
+                    ON CONFLICT (challenge_id, user_id) DO UPDATE
+                    SET selected_at = CURRENT_TIMESTAMP
+                    RETURNING joined_at = selected_at
+                """, (challenge_id, user_id))
+                joined = cur.fetchone()[0]
+                conn.commit()
+                user_cache.invalidate(user_id, prefix='challenges')
+                return joined
+        finally:
+            self.release_connection(conn)
+
+    def leave_challenge(self, challenge_id, user_id):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    DELETE FROM challenge_members
+                    WHERE challenge_id = %s AND user_id = %s
+                """, (challenge_id, user_id))
+                left = cur.rowcount > 0
+                conn.commit()
+                user_cache.invalidate(user_id, prefix='challenges')
+                return left
+        finally:
+            self.release_connection(conn)
+
+    def get_current_challenge(self, user_id):
+        """(id, name, start date, end date, target days, shared) of the user's current challenge, or None."""
+        challenges = self.get_user_challenges(user_id)
+        return challenges[0] if challenges else None
+
+    def get_user_challenges(self, user_id):
+        """The user's challenges, the current one first."""
+        return user_cache.get_or_set(user_id, 'challenges', lambda: self._fetch_user_challenges(user_id))
+
+    def _fetch_user_challenges(self, user_id):
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT c.id, c.name, c.start_date, c.end_date, c.target_days, c.shared
+                    FROM challenge_members m
+                    JOIN challenges c ON c.id = m.challenge_id
+                    WHERE m.user_id = %s
+                    ORDER BY m.selected_at DESC
+                """, (user_id,))
+                return cur.fetchall()
+        finally:
+            self.release_connection(conn)
+
+    def get_open_challenges(self, today, limit=10):
+        """Shared challenges that haven't ended, with their member counts."""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT c.id, c.name, c.start_date, c.end_date, c.target_days,
+                           (SELECT COUNT(*) FROM challenge_members m WHERE m.challenge_id = c.id)
+                    FROM challenges c
+                    WHERE c.shared AND c.end_date >= %s
+                    ORDER BY c.start_date, c.id
+                    LIMIT %s
+                """, (today, limit))
+                return cur.fetchall()
+        finally:
+            self.release_connection(conn)
+
+    def get_challenge_ranking(self, challenge_id, start_date, end_date):
+        """
+        (user id, name, reference activities, total time, total reps, days
+        active, last active) of every member with activities in the window,
+        ranked like get_global_ranking.
+        """
+        query = """
+        SELECT
+            u.id,
+            COALESCE(u.first_name, 'N/A') AS name,
+            COUNT(DISTINCT ra.id) AS total_activities,
+            COALESCE(SUM(CASE WHEN ra.activity_type = 'time' THEN a.value ELSE 0 END), 0) AS total_time,
+            COALESCE(SUM(CASE WHEN ra.activity_type = 'reps' THEN a.value ELSE 0 END), 0) AS total_reps,
+            COUNT(DISTINCT DATE(a.created_at)) AS days_active,
+            MAX(a.created_at) AS last_active
+        FROM challenge_members m
+        JOIN users u ON u.id = m.user_id
+        JOIN activities a ON a.user_id = m.user_id
+            AND a.created_at >= %s::date AND a.created_at < %s::date + 1
+        JOIN reference_activities ra ON a.reference_activity_id = ra.id
+        WHERE m.challenge_id = %s AND u.is_admin = FALSE AND ra.deleted_at IS NULL
+        GROUP BY u.id, u.first_name
+        ORDER BY days_active DESC, last_active DESC, total_time DESC, total_reps DESC
+        """
+        conn = self.get_connection(replica=True)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, (start_date, end_date, challenge_id))
+                return cur.fetchall()
+        finally:
+            self.release_connection(conn)
+
+    def get_leaderboard_days(self, user_id):
+        """(UTC day, activities) for each day the user was active, see leaderboard."""
         conn = self.get_connection()
         try:
             with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT (a.created_at AT TIME ZONE 'UTC')::date, COUNT(*)
+                    FROM activities a
+                    JOIN reference_activities r ON a.reference_activity_id = r.id
+                    WHERE a.user_id = %s AND r.deleted_at IS NULL
+                    GROUP BY 1
+                """, (user_id,))
+                return cur.fetchall()
+        finally:
+            self.release_connection(conn)
+
+    def stream_leaderboard_rows(self, itersize=LEADERBOARD_CURSOR_ITERSIZE):
+        """
+        Yield (user_id, is_admin, UTC day, activities) for every user and day
+        with activities, ordered by user_id, through a server-side cursor.
+        """
+        query = """
+        SELECT a.user_id, u.is_admin, (a.created_at AT TIME ZONE 'UTC')::date, COUNT(*)
+        FROM activities a
+        JOIN reference_activities r ON a.reference_activity_id = r.id
+        JOIN users u ON u.id = a.user_id
+        WHERE r.deleted_at IS NULL
+        GROUP BY a.user_id, u.is_admin, 3
+        ORDER BY a.user_id
+        """
+        conn = self.get_connection()
+        try:
+            with conn.cursor(name='leaderboard_rows') as cur:
+                cur.itersize = itersize
                 cur.execute(query)
+                yield from cur
+        finally:
+            self.release_connection(conn)
+
+    def find_catalog_entry(self, name):
+        """(id, name, activity type) of the catalog exercise a typed name refers to."""
+        keys = catalog.alias_keys(name)
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT c.id, c.name, c.activity_type
+                    FROM activity_aliases a
+                    JOIN activity_catalog c ON c.id = a.catalog_id
+                    WHERE a.alias = ANY(%s)
+                    ORDER BY a.alias = %s DESC, c.id
+                    LIMIT 1
+                """, (keys, keys[0]))
+                return cur.fetchone()
+        finally:
+            self.release_connection(conn)
+
+    def get_user_catalog_entries(self, user_id):
+        """Catalog exercises the user's reference activities map to."""
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT DISTINCT c.id, c.name, c.activity_type
+                    FROM reference_activities r
+                    JOIN activity_catalog c ON c.id = r.catalog_id
+                    WHERE r.user_id = %s AND r.deleted_at IS NULL
+                    ORDER BY c.name
+                """, (user_id,))
                 return cur.fetchall()
         finally:
             self.release_connection(conn)
 
+    def get_exercise_leaderboard(self, catalog_id, period, period_start, limit=catalog.LEADERBOARD_SIZE):
+        """(user id, name, total, entries) of the top users of a catalog exercise in one period."""
+        conn = self.get_connection(replica=True)
+        try:
+            with conn.cursor() as cur:
+                # Walks idx_activity_rollups_leaderboard in total order and
+                # stops after limit users
+                cur.execute("""
+                    SELECT ro.user_id, COALESCE(u.first_name, 'N/A'), ro.total, ro.entries
+                    FROM activity_rollups ro
+                    JOIN users u ON u.id = ro.user_id
+                    WHERE ro.catalog_id = %s AND ro.period = %s AND ro.period_start = %s
+                    AND ro.entries > 0 AND u.is_admin = FALSE
+                    ORDER BY ro.total DESC
+                    LIMIT %s
+                """, (catalog_id, period, period_start, limit))
+                return cur.fetchall()
+        finally:
+            self.release_connection(conn)
+
+    def get_exercise_rank(self, catalog_id, period, period_start, user_id):
+        """(rank, total) of a user on a catalog exercise leaderboard, None if they have no entries."""
+        conn = self.get_connection(replica=True)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT 1 + (
+                        SELECT COUNT(*)
+                        FROM activity_rollups ro
+                        JOIN users u ON u.id = ro.user_id
+                        WHERE ro.catalog_id = me.catalog_id AND ro.period = me.period
+                        AND ro.period_start = me.period_start AND ro.total > me.total
+                        AND ro.entries > 0 AND u.is_admin = FALSE
+                    ), me.total
+                    FROM activity_rollups me
+                    WHERE me.catalog_id = %s AND me.period = %s AND me.period_start = %s
+                    AND me.user_id = %s AND me.entries > 0
+                """, (catalog_id, period, period_start, user_id))
+                return cur.fetchone()
+        finally:
+            self.release_connection(conn)
+
+    def get_user_names(self, user_ids):
+        """{user id: first name} for the given users."""
+        if not user_ids:
+            return {}
+        conn = self.get_connection()
+        try:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, COALESCE(first_name, 'N/A') FROM users WHERE id = ANY(%s)
+                """, (list(user_ids),))
+                return dict(cur.fetchall())
+        finally:
+            self.release_connection(conn)
+
 db = Database()
\ No newline at end of file
@@ -0,0 +1,110 @@
+"""
+Weekly digests: workouts, volume and active days for the week against the
+week before.
+
+Database.stream_digest_rows reads both weeks for every user through one
+server-side cursor ordered by user id. user_digests folds that stream one
+user at a time, so memory stays bounded by the largest single user however
+many users there are.
+"""
+from datetime import timedelta
+from itertools import groupby
+
+# Days before week_start read for the comparison
+PREVIOUS_WEEK_DAYS = 7
+
+
+def new_digest(user_id, telegram_id, week_start):
+    return {
+        'user_id': user_id,
+        'telegram_id': telegram_id,
+        'week_start': week_start,
+        'workouts': 0,
+        'previous_workouts': 0,
+        'days': set(),
+        'previous_days': set(),
+        # name -> {'type', 'volume', 'previous_volume'}
+        'activities': {},
+    }
+
+
+def add_entry(digest, activity_name, activity_type, day, value):
+    this_week = day >= digest['week_start']
+    activity = digest['activities'].setdefault(
+        activity_name, {'type': activity_type, 'volume': 0, 'previous_volume': 0})
+    if this_week:
+        digest['workouts'] += 1
+        digest['days'].add(day)
+        activity['volume'] += value
+    else:
+        digest['previous_workouts'] += 1
+        digest['previous_days'].add(day)
+        activity['previous_volume'] += value
+
+
+def current_streak(digest):
+    """Consecutive active days ending on the week's last day (or the day before)."""
+    active = digest['days'] | digest['previous_days']
+    day = digest['week_start'] + timedelta(days=6)
+    if day not in active:
+        day -= timedelta(days=1)
+    streak = 0
+    while day in active:
+        streak += 1
+        day -= timedelta(days=1)
+    return streak
+
+
+def user_digests(rows, week_start):
+    """
+    Fold (user_id, telegram_id, activity name, activity type, day, value)
+    rows, ordered by user_id, into one digest per user. Users without
+    activities in either week come as a single row with a None name.
+    """
+    for user_id, user_rows in groupby(rows, key=lambda row: row[0]):
+        digest = None
+        for _, telegram_id, activity_name, activity_type, day, value in user_rows:
+            if digest is None:
+                digest = new_digest(user_id, telegram_id, week_start)
+            if activity_name is not None:
+                add_entry(digest, activity_name, activity_type, day, value)
+        yield digest
+
+
+def format_volume(value, activity_type):
+    if activity_type == 'time':
+        hours, remainder = divmod(int(value), 3600)
+        minutes, seconds = divmod(remainder, 60)
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+    return f"{value} reps"
+
+
+def format_digest(digest):
+    week_start = digest['week_start']
+    week_end = week_start + timedelta(days=6)
+    text = f"🗓 Your week ({week_start:%b %d} - {week_end:%b %d})\n\n"
+    if not digest['workouts']:
+        text += "No workouts logged this week. A new week starts tomorrow, let's make it count!"
+        if digest['previous_workouts']:
+            text += f"\n(Last week: {digest['previous_workouts']} workouts)"
+        return text
+
+    text += f"Workouts: {digest['workouts']} (last week {digest['previous_workouts']})\n"
+    text += f"Active days: {len(digest['days'])}/7 (last week {len(digest['previous_days'])})\n"
+    streak = current_streak(digest)
+    if streak >= PREVIOUS_WEEK_DAYS + 7:
+        text += f"Current streak: {streak}+ days\n"
+    elif streak:
+        text += f"Current streak: {streak} days\n"
+
+    text += "\n"
+    for name, activity in sorted(digest['activities'].items()):
+        if not activity['volume']:
+            continue
+        change = activity['volume'] - activity['previous_volume']
+        arrow = "▲" if change > 0 else "▼" if change < 0 else "="
+        text += f"{name}: {format_volume(activity['volume'], activity['type'])}"
+        if change:
+            text += f" ({arrow} {format_volume(abs(change), activity['type'])})"
+        text += "\n"
+    return text.rstrip("\n")
@@ -0,0 +1,21 @@
+#!/bin/bash
+# Hot standby of the db service. The first start clones the primary with
+# pg_basebackup; -R makes the copy stream WAL from it from then on.
+set -e
+
+export PGDATA=${PGDATA:-/var/lib/postgresql/data}
+
+if [ ! -s "$PGDATA/PG_VERSION" ]; then
+    until pg_isready -h db -U "$POSTGRES_USER" -d "$POSTGRES_DB"; do
+        sleep 1
+    done
+    mkdir -p "$PGDATA"
+    chown postgres:postgres "$PGDATA"
+    chmod 700 "$PGDATA"
+    gosu postgres env PGPASSWORD="$POSTGRES_PASSWORD" \
+        pg_basebackup -h db -U "$POSTGRES_USER" -D "$PGDATA" -X stream -R -P
+fi
+
+# hot_standby_feedback keeps long reads (history, rankings) from being
+# cancelled by vacuum on the primary
+exec gosu postgres postgres -c hot_standby=on -c hot_standby_feedback=on
@@ -1,12 +1,19 @@
 # Standard error messages
 MAINTENANCE_MODE_MESSAGE = "The bot is currently under maintenance. Please try again later."
+ADMIN_ONLY_MESSAGE = "This command is only available to admins."
 GENERAL_ERROR_MESSAGE = "An error occurred. Please try again later."
 INVALID_INPUT_MESSAGE = "Invalid input. Please try again."
 OPERATION_CANCELLED_MESSAGE = "Operation cancelled."
+FLOW_EXPIRED_MESSAGE = "This menu has expired. Please start again."
 NO_ACTIVITIES_MESSAGE = "You don't have any activities yet."
+CHART_IN_PROGRESS_MESSAGE = "Your chart is on its way."
 NO_REFERENCE_ACTIVITIES_MESSAGE = "You don't have any reference activities. Please add one first using /addref"
 INVALID_ACTIVITY_SELECTION_MESSAGE = "Invalid activity selection. Please choose an activity from the list."
-INVALID_TIME_FORMAT_MESSAGE = "Invalid time format. Please use HH:MM:SS."
+INVALID_TIME_FORMAT_MESSAGE = "Invalid time format. Please use HH:MM:SS or MM:SS."
 INVALID_REPS_FORMAT_MESSAGE = "Invalid input. Please enter a positive integer for reps."
+QUICK_LOG_USAGE_MESSAGE = "Log activities in one message, e.g. \"pushups 50, plank 1:30\", or use /add."
 FAILED_TO_DELETE_ACTIVITY_MESSAGE = "Failed to delete the activity. It may not exist or you don't have permission to delete it."
-FAILED_TO_UPDATE_ACTIVITY_MESSAGE = "Failed to update the activity. It may not exist or you don't have permission to update it."
\ No newline at end of file
+INVALID_ACTIVITY_DATE_MESSAGE = "The date can't be in the future or more than a year ago."
+FAILED_TO_UPDATE_ACTIVITY_MESSAGE = "Failed to update the activity. It may not exist or you don't have permission to update it."
+CHALLENGE_NOT_FOUND_MESSAGE = "There is no challenge with that number."
+NO_CHALLENGE_MESSAGE = "You're not in a challenge. Start one with /challenge start."
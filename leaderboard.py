@@ -0,0 +1,234 @@
+"""
+The /ranking leaderboard kept in Redis, so a user's rank and neighbours are
+a ZREVRANK and a ZREVRANGE instead of aggregating every user.
+
+- leaderboard:days        sorted set of user ids scored by active days, then
+                          by the last active day (see score)
+- leaderboard:user:{id}   activities per UTC day (day number -> count) for one user
+- leaderboard:excluded    admins' user ids, kept out of the sorted set
+- leaderboard:built       set once rebuild() has loaded Postgres
+
+Database updates the counts as activities are inserted, moved or deleted;
+each change is one script call that adjusts the user's day counts and
+rescores them. rebuild() reloads everything from Postgres, once after
+deploying and whenever the counts are in doubt.
+"""
+from datetime import date, datetime, timezone
+from itertools import groupby
+
+import redis
+
+from logger import log_error, log_info
+from redis_client import get_redis
+
+KEY_PREFIX = 'leaderboard:'
+BOARD_KEY = f'{KEY_PREFIX}days'
+EXCLUDED_KEY = f'{KEY_PREFIX}excluded'
+BUILT_KEY = f'{KEY_PREFIX}built'
+REBUILD_LOCK_KEY = f'{KEY_PREFIX}rebuilding'
+EPOCH_DATE = date(1970, 1, 1)
+
+# Scores are days active * DAY_SCALE + the last active day number, so ties on
+# days go to whoever was active most recently. Day numbers stay below
+# DAY_SCALE until the year 2243 and scores stay exact in a double.
+DAY_SCALE = 100000
+
+# Users shown above and below the user in the "your rank" view
+NEIGHBOURS = 5
+# Users written per pipeline during a rebuild
+REBUILD_PIPELINE_USERS = 500
+
+# KEYS: board, user days hash, excluded set
+# ARGV: user id, DAY_SCALE, then (day number, change) pairs
+_APPLY_SCRIPT = """
+for i = 3, #ARGV, 2 do
+    if redis.call('HINCRBY', KEYS[2], ARGV[i], ARGV[i + 1]) <= 0 then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+    end
+end
+local days = redis.call('HKEYS', KEYS[2])
+if #days == 0 or redis.call('SISMEMBER', KEYS[3], ARGV[1]) == 1 then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+    return 0
+end
+local last = 0
+for _, day in ipairs(days) do
+    last = math.max(last, tonumber(day))
+end
+local score = #days * tonumber(ARGV[2]) + last
+redis.call('ZADD', KEYS[1], score, ARGV[1])
+return score
+"""
+
+_apply_script = None
+
+
+def user_key(user_id):
+    return f"{KEY_PREFIX}user:{user_id}"
+
+
+def day_number(moment):
+    """UTC day number of a timestamp (or of a date)."""
+    if isinstance(moment, datetime):
+        moment = (moment.astimezone(timezone.utc) if moment.tzinfo else moment).date()
+    return (moment - EPOCH_DATE).days
+
+
+def score(day_numbers):
+    return len(day_numbers) * DAY_SCALE + max(day_numbers)
+
+
+def days_active(board_score):
+    return int(board_score) // DAY_SCALE
+
+
+def _apply(client, user_id, changes):
+    global _apply_script
+    if _apply_script is None:
+        _apply_script = client.register_script(_APPLY_SCRIPT)
+    args = [user_id, DAY_SCALE]
+    for day, change in changes.items():
+        args += [day, change]
+    _apply_script(keys=[BOARD_KEY, user_key(user_id), EXCLUDED_KEY], args=args)
+
+
+def record_changes(activities):
+    """
+    Apply (user_id, created_at, +1 or -1) changes of committed activities.
+    """
+    client = get_redis()
+    if client is None or not activities:
+        return
+    per_user = {}
+    for user_id, created_at, change in activities:
+        changes = per_user.setdefault(user_id, {})
+        day = day_number(created_at)
+        changes[day] = changes.get(day, 0) + change
+    try:
+        for user_id, changes in per_user.items():
+            _apply(client, user_id, {day: change for day, change in changes.items() if change})
+    except redis.RedisError as e:
+        log_error(f"Failed to update the leaderboard: {str(e)}")
+
+
+def record_added(activities):
+    """Count (user_id, created_at) pairs of inserted activities."""
+    record_changes([(user_id, created_at, 1) for user_id, created_at in activities])
+
+
+def record_removed(activities):
+    record_changes([(user_id, created_at, -1) for user_id, created_at in activities])
+
+
+def replace_user(user_id, day_counts):
+    """Reset a user's counts to [(day, count)] read from Postgres."""
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.delete(user_key(user_id))
+        _apply(client, user_id, {day_number(day): count for day, count in day_counts})
+    except redis.RedisError as e:
+        log_error(f"Failed to update the leaderboard for user {user_id}: {str(e)}")
+
+
+def set_excluded(user_id, excluded):
+    """Keep an admin out of the ranking, or bring them back."""
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        if excluded:
+            client.sadd(EXCLUDED_KEY, user_id)
+        else:
+            client.srem(EXCLUDED_KEY, user_id)
+        _apply(client, user_id, {})
+    except redis.RedisError as e:
+        log_error(f"Failed to update the leaderboard for user {user_id}: {str(e)}")
+
+
+def enabled():
+    return get_redis() is not None
+
+
+def is_built():
+    client = get_redis()
+    if client is None:
+        return False
+    try:
+        return bool(client.exists(BUILT_KEY))
+    except redis.RedisError as e:
+        log_error(f"Failed to read the leaderboard: {str(e)}")
+        return False
+
+
+def rank_with_neighbours(user_id, neighbours=NEIGHBOURS):
+    """
+    (rank, users ranked, [(rank, user_id, days active)]) for the user and up
+    to `neighbours` users on either side, or None if they aren't ranked.
+    """
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        rank = client.zrevrank(BOARD_KEY, user_id)
+        if rank is None:
+            return None
+        start = max(0, rank - neighbours)
+        pipe = client.pipeline(transaction=False)
+        pipe.zrevrange(BOARD_KEY, start, rank + neighbours, withscores=True)
+        pipe.zcard(BOARD_KEY)
+        entries, total = pipe.execute()
+    except redis.RedisError as e:
+        log_error(f"Failed to read the leaderboard: {str(e)}")
+        return None
+    return rank + 1, total, [(start + i + 1, int(member), days_active(board_score))
+                             for i, (member, board_score) in enumerate(entries)]
+
+
+def rebuild(rows):
+    """
+    Replace the leaderboard with (user_id, is_admin, day, count) rows ordered
+    by user_id (Database.stream_leaderboard_rows). The new sorted set is
+    built under a temporary key and swapped in at the end. Activities
+    written during a rebuild may be counted twice or missed until the next one.
+    """
+    client = get_redis()
+    if client is None:
+        return 0
+    new_board = f'{BOARD_KEY}:rebuild'
+    new_excluded = f'{EXCLUDED_KEY}:rebuild'
+    client.delete(new_board, new_excluded)
+    seen = set()
+    pipe = client.pipeline(transaction=False)
+    for user_id, user_rows in groupby(rows, key=lambda row: row[0]):
+        user_rows = list(user_rows)
+        day_counts = {day_number(day): count for _, _, day, count in user_rows}
+        seen.add(user_id)
+        pipe.delete(user_key(user_id))
+        pipe.hset(user_key(user_id), mapping=day_counts)
+        if user_rows[0][1]:
+            pipe.sadd(new_excluded, user_id)
+        else:
+            pipe.zadd(new_board, {user_id: score(list(day_counts))})
+        if len(seen) % REBUILD_PIPELINE_USERS == 0:
+            pipe.execute()
+    pipe.execute()
+
+    board_built, excluded_built = client.exists(new_board), client.exists(new_excluded)
+    swap = client.pipeline()
+    swap.delete(BOARD_KEY, EXCLUDED_KEY)
+    if board_built:
+        swap.rename(new_board, BOARD_KEY)
+    if excluded_built:
+        swap.rename(new_excluded, EXCLUDED_KEY)
+    swap.set(BUILT_KEY, 1)
+    swap.execute()
+
+    # Day counts of users who no longer have any activities
+    stale = [key for key in client.scan_iter(match=user_key('*'), count=1000)
+             if int(key.decode().rsplit(':', 1)[1]) not in seen]
+    if stale:
+        client.delete(*stale)
+    log_info(f"Rebuilt the leaderboard for {len(seen)} users")
+    return len(seen)
@@ -0,0 +1,253 @@
+"""
+Live engagement numbers for /admin, kept in Redis and updated on every write
+so reading them costs no Postgres queries:
+
+- metrics:activities:YYYYMMDDHH  activities inserted for that UTC hour
+- metrics:dau:YYYYMMDD           HyperLogLog of the users who logged activities that UTC day
+- metrics:signups:YYYYMMDD       users registered that UTC day
+- metrics:users:total            all users, seeded from Postgres and incremented on signup
+- metrics:since                  Unix time the counters were first written
+
+Counters expire after METRICS_RETENTION_DAYS. Any window that starts before
+metrics:since, or every window while Redis is unavailable, is answered from
+Postgres instead. Counters count inserts, so activities of reference
+activities deleted later are still included.
+"""
+from collections import Counter, defaultdict
+from datetime import datetime, time, timedelta, timezone
+
+import redis
+from tabulate import tabulate
+
+from config import METRICS_RETENTION_DAYS, METRICS_TOTAL_USERS_TTL
+from logger import log_error
+from redis_client import get_redis
+
+KEY_PREFIX = 'metrics:'
+SINCE_KEY = f'{KEY_PREFIX}since'
+TOTAL_USERS_KEY = f'{KEY_PREFIX}users:total'
+
+# Days in the /admin history table by default and at most
+HISTORY_DAYS = 7
+MAX_HISTORY_DAYS = 90
+
+SPARKLINE = "▁▂▃▄▅▆▇█"
+
+
+def hour_key(moment):
+    return f"{KEY_PREFIX}activities:{as_utc(moment):%Y%m%d%H}"
+
+
+def dau_key(day):
+    return f"{KEY_PREFIX}dau:{day:%Y%m%d}"
+
+
+def signups_key(day):
+    return f"{KEY_PREFIX}signups:{day:%Y%m%d}"
+
+
+def as_utc(moment):
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+
+def day_start(day):
+    return datetime.combine(day, time.min, tzinfo=timezone.utc)
+
+
+def _retention():
+    return METRICS_RETENTION_DAYS * 86400
+
+
+def record_activities(activities):
+    """Count (user_id, created_at) pairs of activities that were just committed."""
+    client = get_redis()
+    if client is None or not activities:
+        return
+    per_hour = Counter()
+    users_per_day = defaultdict(set)
+    for user_id, created_at in activities:
+        created_at = as_utc(created_at)
+        per_hour[hour_key(created_at)] += 1
+        users_per_day[created_at.date()].add(user_id)
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.set(SINCE_KEY, int(datetime.now(timezone.utc).timestamp()), nx=True)
+        for key, count in per_hour.items():
+            pipe.incrby(key, count)
+            pipe.expire(key, _retention())
+        for day, user_ids in users_per_day.items():
+            pipe.pfadd(dau_key(day), *user_ids)
+            pipe.expire(dau_key(day), _retention())
+        pipe.execute()
+    except redis.RedisError as e:
+        log_error(f"Failed to record activity metrics: {str(e)}")
+
+
+def record_signup(now=None):
+    client = get_redis()
+    if client is None:
+        return
+    now = as_utc(now or datetime.now(timezone.utc))
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.set(SINCE_KEY, int(now.timestamp()), nx=True)
+        pipe.incr(signups_key(now.date()))
+        pipe.expire(signups_key(now.date()), _retention())
+        pipe.exists(TOTAL_USERS_KEY)
+        seeded = pipe.execute()[-1]
+        # Until it is seeded by total_users() the total comes from Postgres
+        if seeded:
+            client.incr(TOTAL_USERS_KEY)
+    except redis.RedisError as e:
+        log_error(f"Failed to record signup metrics: {str(e)}")
+
+
+class EngagementStats:
+    """
+    Reads the counters for one /admin report. Every window falls back to
+    the matching Database query when the counters don't cover it.
+    """
+
+    def __init__(self, db, now=None):
+        self.db = db
+        self.now = as_utc(now or datetime.now(timezone.utc))
+        self.today = self.now.date()
+        self.client = get_redis()
+        self.since = None
+        if self.client is not None:
+            try:
+                since = self.client.get(SINCE_KEY)
+                self.since = datetime.fromtimestamp(int(since), timezone.utc) if since else None
+            except redis.RedisError as e:
+                log_error(f"Failed to read metrics: {str(e)}")
+                self.client = None
+        self.sql_windows = 0
+
+    def covers(self, start):
+        """Whether the counters hold everything from start on."""
+        if self.client is None or self.since is None:
+            return False
+        return start >= self.since and start >= self.now - timedelta(days=METRICS_RETENTION_DAYS)
+
+    def _read(self, read, fallback, start):
+        if self.covers(start):
+            try:
+                return read()
+            except redis.RedisError as e:
+                log_error(f"Failed to read metrics: {str(e)}")
+        self.sql_windows += 1
+        return fallback()
+
+    def hourly_activities(self, hours=24):
+        """Activities in each of the last `hours` clock hours, oldest first (the current one is partial)."""
+        current_hour = self.now.replace(minute=0, second=0, microsecond=0)
+        starts = [current_hour - timedelta(hours=hours - 1 - i) for i in range(hours)]
+
+        def read():
+            return [int(count or 0) for count in self.client.mget([hour_key(start) for start in starts])]
+
+        def fallback():
+            counts = self.db.get_hourly_activity_counts(starts[0], current_hour + timedelta(hours=1))
+            return [counts.get(start, 0) for start in starts]
+
+        # The first hour started before the window; covering it means the counters
+        # were already running then
+        return self._read(read, fallback, starts[0])
+
+    def active_users(self, first_day, last_day):
+        """Distinct users who logged activities between two UTC days, inclusive."""
+        days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+        return self._read(
+            lambda: self.client.pfcount(*[dau_key(day) for day in days]),
+            lambda: self.db.get_active_users_count(day_start(first_day), day_start(last_day + timedelta(days=1))),
+            day_start(first_day))
+
+    def signups(self, first_day, last_day):
+        days = [first_day + timedelta(days=i) for i in range((last_day - first_day).days + 1)]
+        return self._read(
+            lambda: sum(int(count or 0) for count in self.client.mget([signups_key(day) for day in days])),
+            lambda: self.db.get_signups_count(day_start(first_day), day_start(last_day + timedelta(days=1))),
+            day_start(first_day))
+
+    def total_users(self):
+        if self.client is not None:
+            try:
+                total = self.client.get(TOTAL_USERS_KEY)
+                if total is not None:
+                    return int(total)
+            except redis.RedisError as e:
+                log_error(f"Failed to read metrics: {str(e)}")
+        self.sql_windows += 1
+        total = self.db.get_total_users_count()
+        if self.client is not None:
+            try:
+                # Expiring makes any drift from concurrent signups short-lived
+                self.client.set(TOTAL_USERS_KEY, total, nx=True, ex=METRICS_TOTAL_USERS_TTL)
+            except redis.RedisError as e:
+                log_error(f"Failed to seed the users total: {str(e)}")
+        return total
+
+    def history(self, days=HISTORY_DAYS):
+        """
+        (day, activities, active users, signups) for the last `days` UTC days,
+        newest first. Days the counters cover are read from Redis, the rest
+        with one grouped query.
+        """
+        first_day = self.today - timedelta(days=days - 1)
+        all_days = [self.today - timedelta(days=i) for i in range(days)]
+        counted = [day for day in all_days if self.covers(day_start(day))]
+        rows = {}
+        if counted:
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                for day in counted:
+                    pipe.mget([hour_key(day_start(day) + timedelta(hours=hour)) for hour in range(24)])
+                    pipe.pfcount(dau_key(day))
+                    pipe.get(signups_key(day))
+                results = pipe.execute()
+                for i, day in enumerate(counted):
+                    hours, active, signups = results[i * 3:i * 3 + 3]
+                    rows[day] = (sum(int(count or 0) for count in hours), active, int(signups or 0))
+            except redis.RedisError as e:
+                log_error(f"Failed to read metrics: {str(e)}")
+                rows = {}
+
+        missing = [day for day in all_days if day not in rows]
+        if missing:
+            self.sql_windows += 1
+            end = day_start(max(missing) + timedelta(days=1))
+            stored = self.db.get_daily_engagement(day_start(first_day), end)
+            for day in missing:
+                rows[day] = stored.get(day, (0, 0, 0))
+        return [(day,) + rows[day] for day in all_days]
+
+
+def sparkline(values):
+    top = max(values, default=0)
+    if not top:
+        return SPARKLINE[0] * len(values)
+    return "".join(SPARKLINE[round(value / top * (len(SPARKLINE) - 1))] for value in values)
+
+
+def format_admin_stats(stats, history_days=HISTORY_DAYS):
+    today = stats.today
+    hourly = stats.hourly_activities()
+    week_ago = today - timedelta(days=6)
+    text = "📈 Bot stats (UTC)\n\n"
+    text += f"Activities: {hourly[-1]} this hour, {sum(hourly)} in the last 24 hours\n"
+    text += f"Per hour: {sparkline(hourly)}\n"
+    text += (f"Active users: {stats.active_users(today, today)} today, "
+             f"{stats.active_users(today - timedelta(days=1), today - timedelta(days=1))} yesterday, "
+             f"{stats.active_users(week_ago, today)} in 7 days\n")
+    text += (f"Signups: {stats.signups(today, today)} today, "
+             f"{stats.signups(week_ago, today)} in 7 days\n")
+    text += f"Total users: {stats.total_users()}\n\n"
+
+    table_data = [[f"{day:%b %d}", activities, active, signups]
+                  for day, activities, active, signups in stats.history(history_days)]
+    text += tabulate(table_data, headers=["Day", "Acts", "Users", "New"], tablefmt="pipe", numalign="right") + "\n"
+    if stats.sql_windows:
+        text += "\nSome figures predate the Redis counters and were read from the database."
+    return text.rstrip("\n")
@@ -0,0 +1,92 @@
+"""
+Map existing reference activities onto the exercise catalog and fill
+activity_rollups from the activities already logged.
+
+    python -m migrations.activity_catalog map
+    python -m migrations.activity_catalog rollup
+
+map resolves every reference activity without a catalog entry, in batches
+of BATCH_SIZE per transaction; new and renamed reference activities are
+mapped as they are saved. rollup recomputes activity_rollups from scratch
+in one transaction. It locks activity_rollups, so activity writes wait
+until it finishes, but the bot doesn't have to be stopped. Run map first.
+"""
+import argparse
+
+from database import db
+
+BATCH_SIZE = 1000
+
+
+def map_reference_activities():
+    mapped = 0
+    conn = db.get_connection()
+    try:
+        while True:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT id, activity_name, activity_type
+                    FROM reference_activities
+                    WHERE catalog_id IS NULL
+                    ORDER BY id
+                    LIMIT %s
+                """, (BATCH_SIZE,))
+                references = cur.fetchall()
+                if not references:
+                    break
+                for reference_id, activity_name, activity_type in references:
+                    catalog_id = db.resolve_catalog_id(cur, activity_name, activity_type)
+                    cur.execute("UPDATE reference_activities SET catalog_id = %s WHERE id = %s",
+                                (catalog_id, reference_id))
+            conn.commit()
+            mapped += len(references)
+            print(f"Mapped {mapped} reference activities")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db.release_connection(conn)
+
+
+def rebuild_rollups():
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cur:
+            # Writers that commit after this wait for the lock and then add
+            # their activities on top of the rebuilt totals
+            cur.execute("LOCK TABLE activity_rollups IN EXCLUSIVE MODE")
+            cur.execute("DELETE FROM activity_rollups")
+            cur.execute("""
+                INSERT INTO activity_rollups (catalog_id, period, period_start, user_id, total, entries)
+                SELECT r.catalog_id, p.period, date_trunc(p.period, a.created_at AT TIME ZONE 'UTC')::date,
+                       a.user_id, SUM(a.value), COUNT(*)
+                FROM activities a
+                JOIN reference_activities r ON r.id = a.reference_activity_id
+                CROSS JOIN (VALUES ('week'), ('month')) AS p(period)
+                WHERE r.catalog_id IS NOT NULL AND r.deleted_at IS NULL
+                GROUP BY 1, 2, 3, 4
+            """)
+            print(f"Wrote {cur.rowcount} rollup rows")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db.release_connection(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('map', help="Map reference activities onto the catalog")
+    subparsers.add_parser('rollup', help="Recompute activity_rollups from activities")
+    args = parser.parse_args()
+
+    if args.command == 'map':
+        map_reference_activities()
+    else:
+        rebuild_rollups()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Move an existing activities table to monthly range partitions on created_at.
+
+    python -m migrations.partition_activities migrate [--drop-legacy]
+    python -m migrations.partition_activities detach 2023-01
+
+migrate renames the current table to activities_legacy, creates the
+partitioned table with one partition per month of existing data (plus
+ACTIVITY_PARTITION_MONTHS_AHEAD future months), copies every row and moves
+the id sequence past the highest id. It runs in a single transaction holding
+an exclusive lock on activities, so stop the bot and the Celery workers
+first.
+
+detach removes one month from activities and leaves it as a standalone
+table (activities_yYYYYmMM) to archive or drop.
+"""
+import argparse
+from datetime import datetime, timezone
+
+from config import ACTIVITY_PARTITION_MONTHS_AHEAD
+from database import add_months, db
+
+
+def migrate(drop_legacy=False):
+    conn = db.get_connection()
+    try:
+        with conn.cursor() as cur:
+            if db._is_partitioned(cur, 'activities'):
+                print("activities is already partitioned")
+                return
+
+            cur.execute("LOCK TABLE activities IN ACCESS EXCLUSIVE MODE")
+            cur.execute("ALTER TABLE activities RENAME TO activities_legacy")
+            cur.execute("ALTER TABLE activities_legacy RENAME CONSTRAINT activities_pkey TO activities_legacy_pkey")
+            cur.execute("ALTER INDEX IF EXISTS idx_activities_user_created RENAME TO idx_activities_legacy_user_created")
+            db.create_activities_table(cur)
+            cur.execute("""
+                CREATE INDEX idx_activities_user_created
+                ON activities (user_id, created_at, id)
+            """)
+
+            current_month = datetime.now(timezone.utc).date().replace(day=1)
+            cur.execute("""
+                SELECT MIN(created_at AT TIME ZONE 'UTC')::date, COUNT(*)
+                FROM activities_legacy
+            """)
+            oldest, row_count = cur.fetchone()
+            first_month = oldest.replace(day=1) if oldest else current_month
+            created = db.create_activity_partitions(
+                cur, min(first_month, current_month), add_months(current_month, ACTIVITY_PARTITION_MONTHS_AHEAD))
+            print(f"Created {len(created)} partitions")
+
+            cur.execute("""
+                INSERT INTO activities (id, user_id, reference_activity_id, value, created_at)
+                SELECT id, user_id, reference_activity_id, value, COALESCE(created_at, CURRENT_TIMESTAMP)
+                FROM activities_legacy
+            """)
+            print(f"Copied {cur.rowcount} of {row_count} activities")
+            cur.execute("""
+                SELECT setval(pg_get_serial_sequence('activities', 'id'), COALESCE(MAX(id), 0) + 1, false)
+                FROM activities
+            """)
+
+            if drop_legacy:
+                cur.execute("DROP TABLE activities_legacy")
+                print("Dropped activities_legacy")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        db.release_connection(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help="Partition the existing activities table")
+    migrate_parser.add_argument('--drop-legacy', action='store_true', help="Drop activities_legacy once copied")
+    detach_parser = subparsers.add_parser('detach', help="Detach one month of activities")
+    detach_parser.add_argument('month', help="Month to detach, as YYYY-MM")
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        migrate(args.drop_legacy)
+    else:
+        month_start = datetime.strptime(args.month, '%Y-%m').date()
+        print(f"Detached {db.detach_activity_partition(month_start)}")
+
+
+if __name__ == '__main__':
+    main()
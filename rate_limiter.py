@@ -0,0 +1,51 @@
+import threading
+import time
+
+# Absorbs float rounding in the refill arithmetic
+EPSILON = 1e-9
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: up to `rate` acquisitions per second on
+    average, with bursts of up to `capacity`.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self._clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self):
+        with self._lock:
+            self._refill()
+            if self._tokens >= 1 - EPSILON:
+                self._tokens -= 1
+                return True
+            return False
+
+    def acquire(self):
+        """Block until a token is available."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1 - EPSILON:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self._sleep(wait)
+
+    def pause(self, seconds):
+        """Take every token away for `seconds`, e.g. after a 429 with retry_after."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0) - seconds * self.rate
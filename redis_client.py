@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+
+import redis
+
+from config import REDIS_URL
+from logger import log_error, log_info
+
+_client = None
+_subscriptions = {}
+_reconnect_callbacks = []
+_listener_pid = None
+_lock = threading.Lock()
+
+
+def get_redis():
+    """
+    Shared Redis client for the current process, or None when REDIS_URL is
+    not configured. redis-py re-creates its connections after a fork.
+    """
+    global _client
+    if _client is None and REDIS_URL:
+        _client = redis.Redis.from_url(REDIS_URL, health_check_interval=30)
+    return _client
+
+
+def subscribe(channel, callback, on_reconnect=None):
+    """
+    Call callback(data) for every message published on channel.
+
+    The listener runs in a daemon thread that is started lazily in every
+    process (including forked Celery workers) by ensure_listener().
+    on_reconnect is called whenever the subscription is (re)established,
+    since messages published while disconnected are lost.
+    """
+    with _lock:
+        _subscriptions.setdefault(channel, []).append(callback)
+        if on_reconnect:
+            _reconnect_callbacks.append(on_reconnect)
+    ensure_listener()
+
+
+def ensure_listener():
+    global _listener_pid
+    if _listener_pid == os.getpid() or not _subscriptions or get_redis() is None:
+        return
+    with _lock:
+        if _listener_pid == os.getpid():
+            return
+        _listener_pid = os.getpid()
+    threading.Thread(target=_listen, name='redis-pubsub', daemon=True).start()
+
+
+def _listen():
+    while True:
+        try:
+            pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+            subscribed = set(_subscriptions)
+            pubsub.subscribe(*subscribed)
+            log_info(f"Subscribed to Redis channels: {', '.join(sorted(subscribed))}")
+            for callback in list(_reconnect_callbacks):
+                callback()
+
+            while True:
+                # Pick up channels registered after the listener started
+                new_channels = set(_subscriptions) - subscribed
+                if new_channels:
+                    pubsub.subscribe(*new_channels)
+                    subscribed |= new_channels
+
+                message = pubsub.get_message(timeout=1.0)
+                if not message:
+                    continue
+                channel = message['channel'].decode()
+                for callback in list(_subscriptions.get(channel, [])):
+                    try:
+                        callback(message['data'])
+                    except Exception as e:
+                        log_error(f"Error in Redis subscriber for {channel}: {str(e)}")
+        except redis.RedisError as e:
+            log_error(f"Redis pub/sub listener error: {str(e)}")
+            time.sleep(1)
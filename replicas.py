@@ -0,0 +1,193 @@
+"""
+Routing of read-only Database queries to Postgres streaming replicas
+(POSTGRES_REPLICA_DSNS). Without replicas everything runs on the primary.
+
+Heavy reads ask Database.get_connection for a replica; writes and every
+other read stay on the primary. A replica is only used while its replay lag
+is at most REPLICA_MAX_LAG_SECONDS, measured at most every
+REPLICA_LAG_CHECK_INTERVAL seconds, and never while it is unreachable.
+
+A write pins its user to the primary (pin_user) for long enough that any
+replica in use has replayed it, so users always see their own changes.
+Pins are kept in Redis as well, so a write by the activity writer or a
+Celery worker pins the user for the bot too.
+"""
+import itertools
+import threading
+import time
+
+import psycopg2
+import redis
+from psycopg2 import pool
+from psycopg2.extensions import parse_dsn
+
+from config import (REPLICA_CONNECT_TIMEOUT, REPLICA_LAG_CHECK_INTERVAL, REPLICA_MAX_LAG_SECONDS,
+                    REPLICA_PIN_SECONDS, REPLICA_POOL_SIZE)
+from logger import log_error, log_info
+from redis_client import get_redis
+
+PIN_KEY_PREFIX = 'replica:pin:'
+# Local pins kept before expired ones are dropped
+MAX_LOCAL_PINS = 10000
+
+# Seconds the replica is behind the primary: 0 when it has replayed all the
+# WAL it received, NULL when it isn't streaming. A primary (e.g. a promoted
+# replica) is never behind.
+LAG_QUERY = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() THEN 0
+    WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status = 'streaming') THEN NULL
+    WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+
+class Replica:
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.name = parse_dsn(dsn).get('host', 'replica')
+        self.pool = None
+        # Seconds behind the primary as last measured, None while unusable
+        self.lag = None
+        self.checked_at = None
+        self.check_lock = threading.Lock()
+        self._pool_lock = threading.Lock()
+
+    def create_pool(self):
+        return pool.ThreadedConnectionPool(0, REPLICA_POOL_SIZE, self.dsn,
+                                           connect_timeout=REPLICA_CONNECT_TIMEOUT)
+
+    def getconn(self):
+        with self._pool_lock:
+            if self.pool is None:
+                self.pool = self.create_pool()
+        return self.pool.getconn()
+
+    def measure_lag(self):
+        conn = self.getconn()
+        try:
+            with conn.cursor() as cur:
+                cur.execute(LAG_QUERY)
+                lag = cur.fetchone()[0]
+                return None if lag is None else float(lag)
+        finally:
+            self.pool.putconn(conn)
+
+
+class ReplicaRouter:
+    def __init__(self, dsns, max_lag=REPLICA_MAX_LAG_SECONDS, check_interval=REPLICA_LAG_CHECK_INTERVAL,
+                 pin_seconds=REPLICA_PIN_SECONDS, clock=time.monotonic):
+        self.replicas = [Replica(dsn) for dsn in dsns]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        # A replica may have been max_lag behind when last checked and fallen
+        # further behind since, so the pin has to outlast both
+        self.pin_seconds = max(pin_seconds, max_lag + check_interval)
+        self.clock = clock
+        self._turn = itertools.count()
+        self._borrowed = {}
+        self._pins = {}
+        self._lock = threading.Lock()
+
+    def reset(self):
+        # After fork, like Database.reset_pool: leave inherited connections alone
+        for replica in self.replicas:
+            replica.pool = None
+            replica.checked_at = None
+        with self._lock:
+            self._borrowed.clear()
+
+    def pin_user(self, user_id):
+        """Read the user's data from the primary until replicas have caught up with a write."""
+        if not self.replicas or user_id is None:
+            return
+        now = self.clock()
+        with self._lock:
+            if len(self._pins) >= MAX_LOCAL_PINS:
+                self._pins = {pinned: until for pinned, until in self._pins.items() if until > now}
+            self._pins[user_id] = now + self.pin_seconds
+        client = get_redis()
+        if client is not None:
+            try:
+                client.set(f"{PIN_KEY_PREFIX}{user_id}", 1, px=int(self.pin_seconds * 1000))
+            except redis.RedisError as e:
+                log_error(f"Failed to pin user {user_id} to the primary: {str(e)}")
+
+    def is_pinned(self, user_id):
+        if self._pins.get(user_id, 0) > self.clock():
+            return True
+        client = get_redis()
+        if client is None:
+            return False
+        try:
+            return bool(client.exists(f"{PIN_KEY_PREFIX}{user_id}"))
+        except redis.RedisError as e:
+            # Can't tell, so don't risk reading stale data
+            log_error(f"Failed to read the primary pin of user {user_id}: {str(e)}")
+            return True
+
+    def _usable(self, replica):
+        now = self.clock()
+        if replica.checked_at is None or now - replica.checked_at >= self.check_interval:
+            # One thread measures; the others go by the last measurement
+            if replica.check_lock.acquire(blocking=replica.checked_at is None):
+                try:
+                    if replica.checked_at is None or now - replica.checked_at >= self.check_interval:
+                        self._check(replica)
+                finally:
+                    replica.check_lock.release()
+        return replica.lag is not None and replica.lag <= self.max_lag
+
+    def _check(self, replica):
+        was_usable = replica.lag is not None and replica.lag <= self.max_lag
+        try:
+            replica.lag = replica.measure_lag()
+        except psycopg2.Error as e:
+            if was_usable or replica.checked_at is None:
+                log_error(f"Replica {replica.name} is unreachable: {str(e).strip()}")
+            replica.lag = None
+        replica.checked_at = self.clock()
+        usable = replica.lag is not None and replica.lag <= self.max_lag
+        if usable != was_usable:
+            state = "in use" if usable else "skipped"
+            lag = "not streaming" if replica.lag is None else f"{replica.lag:.1f}s behind"
+            log_info(f"Replica {replica.name} is {state} ({lag})")
+
+    def choose(self, user_id=None):
+        """A replica that is caught up, taking turns between them, or None for the primary."""
+        if not self.replicas or (user_id is not None and self.is_pinned(user_id)):
+            return None
+        start = next(self._turn)
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if self._usable(replica):
+                return replica
+        return None
+
+    def getconn(self, user_id=None):
+        """A connection to a replica for a read-only query, or None to use the primary."""
+        replica = self.choose(user_id)
+        if replica is None:
+            return None
+        try:
+            conn = replica.getconn()
+        except (psycopg2.Error, pool.PoolError) as e:
+            log_error(f"Falling back to the primary, replica {replica.name} failed: {str(e).strip()}")
+            replica.lag = None
+            replica.checked_at = self.clock()
+            return None
+        with self._lock:
+            self._borrowed[id(conn)] = replica
+        return conn
+
+    def putconn(self, conn):
+        """Return a replica connection to its pool; False if it came from the primary."""
+        if not self._borrowed:
+            return False
+        with self._lock:
+            replica = self._borrowed.pop(id(conn), None)
+        if replica is None:
+            return False
+        replica.pool.putconn(conn)
+        return True
@@ -1,30 +1,92 @@
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import worker_process_init
+from kombu import Queue
 from telebot import TeleBot
 from database import Database  # Import the Database class
 import random
+from concurrent.futures import ThreadPoolExecutor
 from logger import log_error, log_info
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 import pytz
 from datetime import datetime, timedelta
+import time
 from config import *
 from quotes import QUOTES, ENCOURAGEMENTS
 from telebot.apihelper import ApiTelegramException
+from redis.exceptions import LockError
+from redis_client import get_redis
+from rate_limiter import TokenBucket
+import telegram_client
+import control_plane
+import charts
+import digest
+import leaderboard
+from error_messages import GENERAL_ERROR_MESSAGE
 
-app = Celery('tasks', broker=REDIS_URL)
+app = Celery('tasks', broker=REDIS_URL, backend=REDIS_URL)
+
+# Each queue has its own workers (see docker-compose.yml), so a broadcast to
+# every user can't hold up tasks a user is waiting on. Unrouted tasks are
+# interactive.
+TASK_QUEUES = (
+    Queue('interactive', routing_key='interactive'),
+    Queue('broadcast', routing_key='broadcast'),
+    Queue('maintenance', routing_key='maintenance'),
+)
+
+# With the Redis broker 0 is the highest priority; priorities order tasks
+# within a queue
+TASK_ROUTES = {
+    'tasks.send_encouragement': {'queue': 'broadcast', 'priority': 3},
+    'tasks.check_activity_and_send_encouragement': {'queue': 'broadcast', 'priority': 6},
+    # Sends run ahead of the remaining checks so the first users hear back early
+    'tasks.send_encouragement_and_quote': {'queue': 'broadcast', 'priority': 3},
+    'tasks.send_encouragement_batch': {'queue': 'broadcast', 'priority': 3},
+    'tasks.send_weekly_digest': {'queue': 'broadcast', 'priority': 3},
+    'tasks.send_digest_batch': {'queue': 'broadcast', 'priority': 3},
+    'tasks.create_activity_partitions': {'queue': 'maintenance', 'priority': 3},
+    'tasks.purge_reference_activity': {'queue': 'maintenance', 'priority': 3},
+    'tasks.purge_deleted_reference_activities': {'queue': 'maintenance', 'priority': 6},
+    'tasks.rebuild_leaderboard': {'queue': 'maintenance', 'priority': 3},
+    # A user is waiting for the image
+    'tasks.send_progress_chart': {'queue': 'interactive', 'priority': 1},
+}
 
 # Update the Celery configuration
 app.conf.update(
     broker_connection_retry_on_startup=True,
     timezone='Europe/Nicosia',
-    enable_utc=False
+    enable_utc=False,
+    # Only tasks that report progress (purge_reference_activity) keep state
+    task_ignore_result=True,
+    result_expires=timedelta(days=1),
+    task_queues=TASK_QUEUES,
+    task_default_queue='interactive',
+    task_routes=TASK_ROUTES,
+    task_default_priority=5,
+    broker_transport_options={
+        'priority_steps': list(range(10)),
+        'sep': ':',
+        'queue_order_strategy': 'priority',
+    }
 )
 
+telegram_client.configure()
 bot = TeleBot(BOT_TOKEN)
+# Shared by the send threads of every broadcast batch in this worker process
+send_rate_limiter = TokenBucket(BROADCAST_SEND_RATE) if BROADCAST_SEND_RATE > 0 else None
 
 # Create a Database instance
 db = Database()
 
+@worker_process_init.connect
+def reset_db_pool(**kwargs):
+    # The pool is opened on import, before the prefork worker forks its children
+    db.reset_pool()
+    # Likewise the pooled Telegram connections
+    telegram_client.configure(reset=True)
+
 @app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
     # Schedule the encouragement task to run every minute
@@ -45,41 +107,124 @@ def setup_periodic_tasks(sender, **kwargs):
         name='send_encouragement_at_20'
     )
 
+    sender.add_periodic_task(
+        crontab(day_of_week='sun', hour=19, minute=0),
+        send_weekly_digest.s(),
+        name='send_weekly_digest'
+    )
+
+    # Daily, so a missed run is caught up long before the month runs out
+    sender.add_periodic_task(
+        crontab(hour=3, minute=30),
+        create_activity_partitions.s(),
+        name='create_activity_partitions'
+    )
+
+    # Picks up deletions whose purge task was lost or failed for good
+    sender.add_periodic_task(
+        crontab(minute=15),
+        purge_deleted_reference_activities.s(),
+        name='purge_deleted_reference_activities'
+    )
+
+# Reminders are delivered at least once by Celery; these keys make a
+# duplicate trigger or a redelivered task a Redis lookup instead of a send
+REMINDER_KEY_PREFIX = 'reminder:'
+
+def reminder_slot(now):
+    # One slot per scheduled run (12:00 and 20:00)
+    return f"{now.date().isoformat()}:{now.hour:02d}"
+
+def reminder_sent_key(user_id, slot):
+    return f"{REMINDER_KEY_PREFIX}sent:{user_id}:{slot}"
+
+def reminder_already_sent(user_id, slot):
+    client = get_redis()
+    return bool(slot and client is not None and client.exists(reminder_sent_key(user_id, slot)))
+
+def claim_reminder(user_id, slot):
+    """
+    Atomically record that the reminder for this user and slot is being sent.
+    Returns False if another task already claimed it.
+    """
+    client = get_redis()
+    if not slot or client is None:
+        return True
+    return bool(client.set(reminder_sent_key(user_id, slot), 1, nx=True, ex=REMINDER_DEDUPE_TTL))
+
+def release_reminder(user_id, slot):
+    # The send failed, let a retry or the next trigger try again
+    client = get_redis()
+    if slot and client is not None:
+        client.delete(reminder_sent_key(user_id, slot))
+
 @app.task
 def send_encouragement():
     nicosia_tz = pytz.timezone('Europe/Nicosia')
     now = datetime.now(nicosia_tz)
+    slot = reminder_slot(now)
     
     log_info(f"Running send_encouragement at {now}")
+
+    client = get_redis()
+    lock = client.lock(f"{REMINDER_KEY_PREFIX}lock", timeout=REMINDER_LOCK_TIMEOUT) if client else None
+    if lock and not lock.acquire(blocking=False):
+        log_info(f"send_encouragement is already running, skipping slot {slot}")
+        return
     
     try:
-        if ADMIN_ID:
-            log_info(f"Checking activity for ADMIN_ID: {ADMIN_ID}")
-            check_activity_and_send_encouragement.delay(1)
+        fanout_key = f"{REMINDER_KEY_PREFIX}fanout:{slot}"
+        if client and client.exists(fanout_key):
+            log_info(f"Encouragements for slot {slot} were already scheduled")
+            return
+
+        admin_id = control_plane.get_flag('admin_id')
+        if admin_id:
+            log_info(f"Checking activity for ADMIN_ID: {admin_id}")
+            check_activity_and_send_encouragement.delay(1, slot)
         else:
-            users = db.get_all_users()
-            log_info(f"Checking activity for {len(users)} users")
-            for user in users:
-                user_id = user[0]  # Assuming user[0] is the user_id
-                check_activity_and_send_encouragement.delay(user_id)
-                log_info(f"Scheduled activity check and encouragement for user {user_id}")
+            users = db.get_reachable_users()
+            log_info(f"Checking activity for {len(users)} reachable users")
+            if BROADCAST_BATCH_SIZE:
+                user_ids = [user[0] for user in users]
+                for start in range(0, len(user_ids), BROADCAST_BATCH_SIZE):
+                    send_encouragement_batch.delay(user_ids[start:start + BROADCAST_BATCH_SIZE], slot)
+                log_info(f"Scheduled encouragement batches of {BROADCAST_BATCH_SIZE} users")
+            else:
+                for user in users:
+                    user_id = user[0]  # Assuming user[0] is the user_id
+                    check_activity_and_send_encouragement.delay(user_id, slot)
+                    log_info(f"Scheduled activity check and encouragement for user {user_id}")
+
+        if client:
+            client.set(fanout_key, 1, ex=REMINDER_DEDUPE_TTL)
     except Exception as e:
         log_error(f"Failed in send_encouragement: {str(e)}")
+    finally:
+        if lock:
+            try:
+                lock.release()
+            except LockError:
+                log_error("send_encouragement lock expired before the fan-out finished")
 
 @app.task
-def check_activity_and_send_encouragement(user_id):
+def check_activity_and_send_encouragement(user_id, slot=None):
     nicosia_tz = pytz.timezone('Europe/Nicosia')
     now = datetime.now(nicosia_tz)
     today = now.date()
     
     try:
+        if reminder_already_sent(user_id, slot):
+            log_info(f"User {user_id} already got the {slot} encouragement, skipping")
+            return
+
         # Check if the user was active today
         was_active = db.was_user_active_today(user_id, today)
         
         log_info(f"User {user_id} activity check result: {'active' if was_active else 'not active'}")
         
         if not was_active:
-            send_encouragement_and_quote.delay(user_id)
+            send_encouragement_and_quote.delay(user_id, slot=slot)
             log_info(f"User {user_id} was not active today, sending encouragement")
         else:
             log_info(f"User {user_id} was already active today, skipping encouragement")
@@ -87,31 +232,334 @@ def check_activity_and_send_encouragement(user_id):
         log_error(f"Failed to check activity for user {user_id}: {str(e)}")
 
 @app.task
-def send_encouragement_and_quote(user_id, custom_message=None):
+def send_encouragement_and_quote(user_id, custom_message=None, slot=None):
     if custom_message:
         message = custom_message
     else:
-        message = get_random_encouragement() + "\n\n"
-        quote = get_random_quote()
-        message += f"Here's a quote to keep you motivated:\n\n{quote}"
+        message = create_encouragement_message()
     
     try:
+        if not claim_reminder(user_id, slot):
+            log_info(f"Encouragement for user {user_id} in slot {slot} was already sent, skipping")
+            return
+
         # Get user's telegram_id from the database
-        user = db.get_user_by_id(user_id)
-        if user:
-            telegram_id = user[1]  # Assuming telegram_id is the second column in the user tuple
-            log_info(f"Retrieved telegram_id {telegram_id} for user {user_id}")
-        else:
+        users = db.get_delivery_recipients([user_id])
+        if not users:
             log_error(f"User {user_id} not found in the database")
             return  # Exit the function if user is not found
-        
-        log_info(f"Attempting to send message to telegram_id {telegram_id}")
-        sent_message = bot.send_message(telegram_id, message)
-        log_info(f"Successfully sent message to user {user_id}. Message ID: {sent_message.message_id}")
-    except ApiTelegramException as api_error:
-        log_error(f"Telegram API error when sending message to user {user_id}: {str(api_error)}")
+        deliver_encouragement(users[0], message, slot)
     except Exception as e:
         log_error(f"Failed to send message to user {user_id}: {str(e)}")
+        release_reminder(user_id, slot)
+
+@app.task
+def send_encouragement_batch(user_ids, slot=None):
+    """
+    Send the encouragement to every user in user_ids who wasn't active today,
+    keeping up to BROADCAST_SEND_CONCURRENCY sends in flight. Returns the
+    outcome per user id (see deliver_encouragement).
+    """
+    nicosia_tz = pytz.timezone('Europe/Nicosia')
+    today = datetime.now(nicosia_tz).date()
+    results = {}
+
+    try:
+        active = db.get_users_active_on(user_ids, today)
+        recipients = []
+        for user in db.get_delivery_recipients(user_ids):
+            if user[0] in active:
+                results[user[0]] = 'active_today'
+            elif not claim_reminder(user[0], slot):
+                results[user[0]] = 'duplicate'
+            else:
+                recipients.append(user)
+    except Exception as e:
+        log_error(f"Failed to prepare encouragement batch of {len(user_ids)} users: {str(e)}")
+        return results
+
+    deliver_batch([(user, create_encouragement_message()) for user in recipients], slot, results)
+    for user_id in user_ids:
+        results.setdefault(user_id, 'not_found')
+
+    log_batch_outcomes("Encouragement", results)
+    return results
+
+def deliver_batch(messages, slot, results):
+    """
+    Deliver (get_delivery_recipients row, message) pairs with up to BROADCAST_SEND_CONCURRENCY
+    sends in flight, storing each user's outcome in results.
+    """
+    def send(user_message):
+        user, message = user_message
+        try:
+            return deliver_encouragement(user, message, slot, rate_limiter=send_rate_limiter)
+        except Exception as e:
+            log_error(f"Failed to send message to user {user[0]}: {str(e)}")
+            release_reminder(user[0], slot)
+            return 'failed'
+
+    with ThreadPoolExecutor(max_workers=BROADCAST_SEND_CONCURRENCY) as executor:
+        for (user, _), result in zip(messages, executor.map(send, messages)):
+            results[user[0]] = result
+
+def log_batch_outcomes(kind, results):
+    outcomes = {}
+    for result in results.values():
+        outcomes[result] = outcomes.get(result, 0) + 1
+    log_info(f"{kind} batch of {len(results)} users: {outcomes}")
+
+@app.task
+def send_weekly_digest():
+    """
+    Summarise the week ending today for every reachable user. All users are
+    read in one pass over a server-side cursor and each finished digest is
+    queued for send_digest_batch, BROADCAST_BATCH_SIZE at a time.
+    """
+    nicosia_tz = pytz.timezone('Europe/Nicosia')
+    today = datetime.now(nicosia_tz).date()
+    week_start = today - timedelta(days=6)
+    slot = f"digest:{week_start.isoformat()}"
+
+    client = get_redis()
+    fanout_key = f"{REMINDER_KEY_PREFIX}fanout:{slot}"
+    if client and not client.set(fanout_key, 1, nx=True, ex=REMINDER_DEDUPE_TTL):
+        log_info(f"Weekly digest for {week_start} was already scheduled")
+        return
+
+    admin_id = control_plane.get_flag('admin_id')
+    batch_size = BROADCAST_BATCH_SIZE or 1
+    batch, users, batches = [], 0, 0
+    try:
+        rows = db.stream_digest_rows(week_start - timedelta(days=digest.PREVIOUS_WEEK_DAYS), today + timedelta(days=1))
+        for user_digest in digest.user_digests(rows, week_start):
+            if admin_id and str(user_digest['telegram_id']) != str(admin_id):
+                continue
+            batch.append((user_digest['user_id'], digest.format_digest(user_digest)))
+            users += 1
+            if len(batch) >= batch_size:
+                send_digest_batch.delay(batch, slot)
+                batch, batches = [], batches + 1
+        if batch:
+            send_digest_batch.delay(batch, slot)
+            batches += 1
+        log_info(f"Scheduled weekly digests for {users} users in {batches} batches")
+    except Exception as e:
+        log_error(f"Failed in send_weekly_digest after {users} users: {str(e)}")
+        # Batches already queued are deduplicated per user if the digest runs again
+        if client:
+            client.delete(fanout_key)
+
+@app.task
+def send_digest_batch(digests, slot):
+    """Send (user_id, text) digests, see deliver_batch."""
+    results = {}
+    try:
+        texts = dict(digests)
+        messages = []
+        for user in db.get_delivery_recipients(list(texts)):
+            if not claim_reminder(user[0], slot):
+                results[user[0]] = 'duplicate'
+            else:
+                messages.append((user, texts[user[0]]))
+    except Exception as e:
+        log_error(f"Failed to prepare digest batch of {len(digests)} users: {str(e)}")
+        return results
+
+    deliver_batch(messages, slot, results)
+    for user_id, _ in digests:
+        results.setdefault(user_id, 'not_found')
+    log_batch_outcomes("Digest", results)
+    return results
+
+def deliver_encouragement(user, message, slot, rate_limiter=None):
+    """
+    Send message to user (a Database.get_delivery_recipients row) and record
+    the outcome on the users row.
+    The reminder for slot must already be claimed; it is released again if
+    the send fails. Returns 'sent', 'unreachable' or 'failed'.
+    """
+    user_id, telegram_id, delivery_status, delivery_failures = user
+    if delivery_status != 'active':
+        log_info(f"Skipping user {user_id}: delivery status is {delivery_status}")
+        return 'unreachable'
+
+    for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            log_info(f"Attempting to send message to telegram_id {telegram_id}")
+            sent_message = bot.send_message(telegram_id, message)
+            log_info(f"Successfully sent message to user {user_id}. Message ID: {sent_message.message_id}")
+            if delivery_failures:
+                db.mark_delivery_succeeded(user_id)
+            return 'sent'
+        except ApiTelegramException as api_error:
+            retry_after = (api_error.result_json.get('parameters') or {}).get('retry_after')
+            if api_error.error_code == 429 and retry_after and attempt < TELEGRAM_MAX_RETRIES:
+                log_info(f"Rate limited by Telegram, retrying user {user_id} in {retry_after}s")
+                if rate_limiter:
+                    rate_limiter.pause(retry_after)
+                else:
+                    time.sleep(retry_after)
+                continue
+            log_error(f"Telegram API error when sending message to user {user_id}: {str(api_error)}")
+            release_reminder(user_id, slot)
+            if not is_chat_delivery_error(api_error):
+                # Rate limits and server errors say nothing about the chat, so
+                # they don't count toward DELIVERY_MAX_FAILURES. A 5xx isn't
+                # retried: the message may have gone out anyway
+                return 'failed'
+            status = db.mark_delivery_failed(user_id, api_error.description or str(api_error),
+                                             permanent=is_permanent_delivery_error(api_error))
+            if status != 'active':
+                log_info(f"User {user_id} is now {status} and will be skipped by broadcasts")
+                return 'unreachable'
+            return 'failed'
+
+@app.task
+def create_activity_partitions():
+    try:
+        created = db.ensure_activity_partitions()
+        if created:
+            log_info(f"Created activity partitions: {', '.join(created)}")
+    except Exception as e:
+        log_error(f"Failed to create activity partitions: {str(e)}")
+
+REFERENCE_PURGE_LOCK_PREFIX = 'purge:reference:'
+
+@app.task(bind=True, ignore_result=False, max_retries=5, default_retry_delay=60)
+def purge_reference_activity(self, activity_id, user_id):
+    """
+    Remove the activities of a reference activity marked deleted by
+    Database.delete_reference_activity, REFERENCE_PURGE_BATCH_SIZE rows per
+    transaction, then the reference activity itself. Progress is reported as
+    a PROGRESS state with {'deleted', 'total'}. The hourly sweep enqueues
+    every pending purge again, so a purge already running is skipped.
+    """
+    client = get_redis()
+    lock = None
+    if client is not None:
+        lock = client.lock(f"{REFERENCE_PURGE_LOCK_PREFIX}{activity_id}", timeout=REFERENCE_PURGE_LOCK_TIMEOUT)
+        if not lock.acquire(blocking=False):
+            log_info(f"Reference activity {activity_id} of user {user_id} is already being purged")
+            return
+    try:
+        total = db.get_activity_count_for_reference(activity_id, user_id)
+        deleted = 0
+        while True:
+            batch = db.delete_activities_for_reference_batch(activity_id, user_id, REFERENCE_PURGE_BATCH_SIZE)
+            if not batch:
+                break
+            deleted += batch
+            self.update_state(state='PROGRESS', meta={'deleted': deleted, 'total': total})
+            time.sleep(REFERENCE_PURGE_BATCH_DELAY)
+
+        purged = db.purge_reference_activity(activity_id, user_id)
+        log_info(f"Purged reference activity {activity_id} of user {user_id}: {deleted} activities deleted")
+        return {'deleted': deleted, 'total': total, 'purged': purged}
+    except Exception as e:
+        log_error(f"Failed to purge reference activity {activity_id} of user {user_id}: {str(e)}")
+        raise self.retry(exc=e)
+    finally:
+        # Released before a retry runs, so the retry can take it again
+        if lock is not None:
+            try:
+                lock.release()
+            except LockError:
+                log_error(f"purge_reference_activity lock of {activity_id} expired before the purge finished")
+
+@app.task
+def purge_deleted_reference_activities():
+    try:
+        for activity_id, user_id in db.get_pending_reference_deletions():
+            purge_reference_activity.delay(activity_id, user_id)
+    except Exception as e:
+        log_error(f"Failed to schedule reference activity purges: {str(e)}")
+
+@app.task
+def rebuild_leaderboard(chat_id=None):
+    """
+    Reload the /ranking leaderboard from Postgres, see leaderboard.rebuild.
+    chat_id is told the outcome when an admin asked for the rebuild.
+    """
+    client = get_redis()
+    if client is None:
+        return
+    lock = client.lock(leaderboard.REBUILD_LOCK_KEY, timeout=LEADERBOARD_REBUILD_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        log_info("The leaderboard is already being rebuilt")
+        return
+    try:
+        users = leaderboard.rebuild(db.stream_leaderboard_rows())
+        if chat_id:
+            bot.send_message(chat_id, f"Ranking rebuilt for {users} users.")
+    except Exception as e:
+        log_error(f"Failed to rebuild the leaderboard: {str(e)}")
+        if chat_id:
+            bot.send_message(chat_id, GENERAL_ERROR_MESSAGE)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            log_error("rebuild_leaderboard lock expired before the rebuild finished")
+
+@app.task
+def send_progress_chart(chat_id, user_id, claimed_key=None, reply_to_message_id=None):
+    """
+    Send the user's /chart image, rendering and uploading it only when no
+    image of the same data has been uploaded before. claimed_key is the
+    render lock taken by the bot, released once the chart is sent.
+    """
+    try:
+        first_day = charts.chart_first_day()
+        rows = db.get_daily_activity_totals(user_id, first_day)
+        key = charts.chart_key(rows, first_day)
+        file_id = charts.get_cached_file_id(key)
+        if file_id:
+            bot.send_photo(chat_id, file_id, reply_to_message_id=reply_to_message_id)
+            return
+
+        started = time.monotonic()
+        image = charts.render_progress_chart(rows, first_day)
+        sent = bot.send_photo(chat_id, image, reply_to_message_id=reply_to_message_id)
+        # The largest size is the original upload
+        charts.cache_file_id(key, sent.photo[-1].file_id)
+        log_info(f"Rendered chart for user {user_id} in {time.monotonic() - started:.2f}s")
+    except Exception as e:
+        log_error(f"Failed to send chart to user {user_id}: {str(e)}")
+        try:
+            bot.send_message(chat_id, GENERAL_ERROR_MESSAGE)
+        except Exception:
+            pass
+    finally:
+        if claimed_key:
+            charts.release_render(claimed_key)
+
+# Errors meaning the chat will never accept messages again (until /start)
+PERMANENT_DELIVERY_ERRORS = (
+    'bot was blocked by the user',
+    'user is deactivated',
+    'chat not found',
+    'bot was kicked',
+    'peer_id_invalid',
+)
+
+def is_chat_delivery_error(api_error):
+    """Whether a failed send was refused because of the chat (a 4xx other than 429)."""
+    return 400 <= api_error.error_code < 500 and api_error.error_code != 429
+
+def is_permanent_delivery_error(api_error):
+    if api_error.error_code == 403:
+        return True
+    description = (api_error.description or '').lower()
+    return api_error.error_code == 400 and any(error in description for error in PERMANENT_DELIVERY_ERRORS)
+
+def create_encouragement_message():
+    message = get_random_encouragement() + "\n\n"
+    quote = get_random_quote()
+    message += f"Here's a quote to keep you motivated:\n\n{quote}"
+    return message
 
 def get_random_quote():
     return random.choice(QUOTES)
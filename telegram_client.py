@@ -0,0 +1,135 @@
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import apihelper
+from urllib3.util.retry import Retry
+
+from config import (TELEGRAM_API_URL, TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_MAX_RETRIES, TELEGRAM_POOL_SIZE,
+                    TELEGRAM_READ_TIMEOUT, TELEGRAM_STATS_LOG_INTERVAL)
+from logger import log_info
+
+# Latency samples kept per Bot API method for the percentiles
+MAX_SAMPLES = 1000
+
+
+class LatencyStats:
+    """Per Bot API method call counts, errors and latency percentiles."""
+
+    def __init__(self, max_samples=MAX_SAMPLES):
+        self.max_samples = max_samples
+        self._methods = {}
+        self._lock = threading.Lock()
+
+    def record(self, method, seconds, error=False):
+        with self._lock:
+            stats = self._methods.get(method)
+            if stats is None:
+                stats = self._methods[method] = {
+                    'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0,
+                    'samples': deque(maxlen=self.max_samples),
+                }
+            stats['count'] += 1
+            stats['errors'] += int(error)
+            stats['total'] += seconds
+            stats['max'] = max(stats['max'], seconds)
+            stats['samples'].append(seconds)
+
+    def summary(self):
+        with self._lock:
+            methods = {method: dict(stats, samples=sorted(stats['samples']))
+                       for method, stats in self._methods.items()}
+        return {
+            method: {
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'mean_ms': stats['total'] * 1000 / stats['count'],
+                'p50_ms': _percentile(stats['samples'], 0.5) * 1000,
+                'p95_ms': _percentile(stats['samples'], 0.95) * 1000,
+                'max_ms': stats['max'] * 1000,
+            }
+            for method, stats in methods.items()
+        }
+
+    def reset(self):
+        with self._lock:
+            self._methods.clear()
+
+
+def _percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+latency_stats = LatencyStats()
+_session = None
+_last_logged = time.monotonic()
+
+
+def _record_latency(response, *args, **kwargs):
+    global _last_logged
+    # The Bot API method is the last path segment (.../bot<token>/sendMessage)
+    method = urlparse(response.url).path.rsplit('/', 1)[-1]
+    latency_stats.record(method, response.elapsed.total_seconds(), error=not response.ok)
+
+    if TELEGRAM_STATS_LOG_INTERVAL and time.monotonic() - _last_logged > TELEGRAM_STATS_LOG_INTERVAL:
+        _last_logged = time.monotonic()
+        log_latency_stats()
+
+
+def log_latency_stats():
+    for method, stats in sorted(latency_stats.summary().items()):
+        log_info(f"Telegram {method}: {stats['count']} calls, {stats['errors']} errors, "
+                 f"mean {stats['mean_ms']:.0f}ms, p50 {stats['p50_ms']:.0f}ms, "
+                 f"p95 {stats['p95_ms']:.0f}ms, max {stats['max_ms']:.0f}ms")
+
+
+def create_session():
+    """
+    requests session for the Bot API: keep-alive connections pooled up to
+    TELEGRAM_POOL_SIZE (one per concurrent sender), retrying connection
+    failures with backoff. Every Bot API call is a POST, and a 5xx or a
+    read timeout may come after the message went out, so error responses
+    (429s included, which have to honour retry_after) are left to the caller.
+    """
+    retry = Retry(
+        total=TELEGRAM_MAX_RETRIES,
+        connect=TELEGRAM_MAX_RETRIES,
+        # A read timeout may mean the message went out; don't send it twice
+        read=0,
+        status=0,
+        backoff_factor=0.5,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=TELEGRAM_POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.hooks['response'].append(_record_latency)
+    return session
+
+
+def configure(reset=False):
+    """
+    Point telebot at the shared session. Call again with reset=True in a
+    forked process so it doesn't reuse the parent's sockets.
+    """
+    global _session
+    if _session is None or reset:
+        _session = create_session()
+        latency_stats.reset()
+    apihelper.session = _session
+    if reset:
+        # telebot caches the session per thread; replace this thread's copy
+        apihelper._get_req_session(reset=True)
+    apihelper.CONNECT_TIMEOUT = TELEGRAM_CONNECT_TIMEOUT
+    apihelper.READ_TIMEOUT = TELEGRAM_READ_TIMEOUT
+    # telebot otherwise replaces the session every ten minutes per thread
+    apihelper.SESSION_TIME_TO_LIVE = None
+    if TELEGRAM_API_URL:
+        apihelper.API_URL = TELEGRAM_API_URL
+    return _session
@@ -0,0 +1,36 @@
+from activity_names import ActivityNameIndex, parse_log_entries
+
+REFERENCES = [
+    (1, "Push-ups", "reps"),
+    (2, "Plank", "time"),
+    (3, "Pull ups", "reps"),
+    (4, "Squats", "reps"),
+]
+
+
+def test_parse_log_entries():
+    assert parse_log_entries("pushups 50, plank 1:30") == [("pushups", "50"), ("plank", "1:30")]
+    assert parse_log_entries("pull ups 10\nplank 0:02:00;") == [("pull ups", "10"), ("plank", "0:02:00")]
+    assert parse_log_entries("squats, 20") == [("squats", None), ("20", None)]
+
+
+def test_exact_match_ignores_case_and_separators():
+    index = ActivityNameIndex(REFERENCES)
+    assert index.match("pushups")[0] == 1
+    assert index.match("PUSH UPS")[0] == 1
+    assert index.match("pull-ups")[0] == 3
+
+
+def test_prefix_match():
+    index = ActivityNameIndex(REFERENCES)
+    assert index.match("pla")[0] == 2
+    assert index.match("sq")[0] == 4
+    # "pu" is ambiguous and too short to pick one by similarity
+    assert index.match("pu") is None
+
+
+def test_fuzzy_match():
+    index = ActivityNameIndex(REFERENCES)
+    assert index.match("squads")[0] == 4
+    assert index.match("planks")[0] == 2
+    assert index.match("burpees") is None
@@ -0,0 +1,58 @@
+from datetime import date, timedelta
+
+import numpy as np
+
+from analytics import ActivityHistory, compute_trends, day_number, moving_average, totals_by_type
+
+TODAY = date(2024, 3, 31)
+REFERENCES = [(1, 'Pushups', 'reps'), (2, 'Plank', 'time')]
+
+
+def history(entries):
+    """entries: (reference id, value, days before TODAY)"""
+    days = [day_number(TODAY - timedelta(days=ago)) for _, _, ago in entries]
+    return ActivityHistory(REFERENCES, [ref for ref, _, _ in entries], [value for _, value, _ in entries],
+                           days, [day * 86400 for day in days])
+
+
+def test_moving_average():
+    assert moving_average([7, 0, 0, 7], 7).tolist() == [1, 1, 1, 2]
+    assert np.allclose(moving_average([[2, 4], [0, 6]], 2), [[1, 3], [0, 3]])
+
+
+def test_compute_trends():
+    trends = compute_trends(history([
+        (1, 10, 0), (1, 15, 0), (1, 20, 1), (1, 40, 8),
+        (2, 60, 3),
+    ]), TODAY, weeks=2)
+
+    pushups, plank = trends
+    assert pushups['name'] == 'Pushups'
+    assert pushups['entries'] == 4
+    assert pushups['total'] == 85
+    assert pushups['days_active'] == 3
+    assert pushups['days_left'] == 97
+    assert pushups['best_entry'] == 40
+    assert pushups['best_day'] == 40
+    assert pushups['weekly'] == [40, 45]
+    assert pushups['average_7'] == 45 / 7
+    assert pushups['previous_average_7'] == 40 / 7
+    # 3 active days in the last 30: 97 days left at 0.1 per day
+    assert pushups['projected_finish'] == TODAY + timedelta(days=970)
+    assert pushups['current_streak'] == 2
+    assert plank['total'] == 60
+    assert plank['current_streak'] == 0
+    assert totals_by_type(trends) == (85, 60)
+
+
+def test_compute_trends_for_a_shorter_challenge():
+    pushups, = compute_trends(history([(1, 10, 1), (1, 10, 2), (1, 10, 3)]), TODAY, challenge_days=30,
+                              start_date=TODAY - timedelta(days=5))
+    assert pushups['days_left'] == 27
+    assert pushups['current_streak'] == 3
+    # 3 active days out of the challenge's 6: 27 days left at 0.5 per day
+    assert pushups['projected_finish'] == TODAY + timedelta(days=54)
+
+
+def test_compute_trends_empty():
+    assert compute_trends(history([]), TODAY) == []
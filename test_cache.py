@@ -0,0 +1,31 @@
+import cache
+from cache import UserCache
+
+
+def make_cache(monkeypatch):
+    monkeypatch.setattr(cache, 'get_redis', lambda: None)
+    return UserCache('test')
+
+
+def test_a_read_racing_an_invalidation_is_not_cached(monkeypatch):
+    user_cache = make_cache(monkeypatch)
+
+    def stale_read():
+        # The write commits and invalidates while the read is in flight
+        user_cache.invalidate(1, prefix='activities')
+        return 'before the write'
+
+    assert user_cache.get_or_set(1, 'activities:all', stale_read) == 'before the write'
+    assert user_cache.get(1, 'activities:all') is None
+    assert user_cache.get_or_set(1, 'activities:all', lambda: 'after the write') == 'after the write'
+    assert user_cache.get(1, 'activities:all') == 'after the write'
+
+
+def test_large_values_are_not_cached(monkeypatch):
+    user_cache = make_cache(monkeypatch)
+    monkeypatch.setattr(cache, 'CACHE_MAX_VALUE_BYTES', 100)
+
+    assert user_cache.get_or_set(1, 'activities:all', lambda: list(range(1000))) == list(range(1000))
+    assert user_cache.get(1, 'activities:all') is None
+    assert user_cache.get_or_set(1, 'activities:total_count', lambda: 3) == 3
+    assert user_cache.get(1, 'activities:total_count') == 3
@@ -0,0 +1,20 @@
+from datetime import date
+
+from catalog import alias_keys, parse_period, period_start, seed_aliases
+
+
+def test_spellings_share_alias_keys():
+    assert alias_keys("Push-ups") == ["pushups", "pushup"]
+    assert alias_keys("push up") == ["pushup"]
+    assert alias_keys("Press") == ["press"]
+    aliases = {(alias, activity_type): name for alias, activity_type, name in seed_aliases()}
+    assert aliases[("pushup", "reps")] == "Push-ups"
+    assert aliases[("plank", "time")] == "Plank"
+
+
+def test_periods():
+    assert parse_period("w") == "week"
+    assert parse_period("Monthly") == "month"
+    assert parse_period("pushups") is None
+    assert period_start("week", date(2024, 3, 28)) == date(2024, 3, 25)
+    assert period_start("month", date(2024, 3, 28)) == date(2024, 3, 1)
@@ -0,0 +1,38 @@
+from datetime import date, timedelta
+
+import numpy as np
+
+from charts import chart_data, chart_key, streak_lengths
+
+FIRST_DAY = date(2024, 1, 1)
+
+
+def day(n):
+    return FIRST_DAY + timedelta(days=n)
+
+
+def test_chart_key_changes_with_data_and_window():
+    rows = [(1, 'Pushups', 'reps', day(0), 20), (1, 'Pushups', 'reps', day(1), 30)]
+    key = chart_key(rows, FIRST_DAY)
+    assert key == chart_key(list(rows), FIRST_DAY)
+    assert key != chart_key(rows[:1], FIRST_DAY)
+    assert key != chart_key([rows[0], (1, 'Pushups', 'reps', day(1), 31)], FIRST_DAY)
+    assert key != chart_key(rows, day(1))
+
+
+def test_chart_data_orders_by_active_days():
+    rows = [
+        (1, 'Plank', 'time', day(0), 60),
+        (2, 'Pushups', 'reps', day(0), 20),
+        (2, 'Pushups', 'reps', day(2), 30),
+        (2, 'Pushups', 'reps', day(10), 99),  # outside the window
+    ]
+    names, types, values = chart_data(rows, FIRST_DAY, days=5, max_activities=1)
+    assert names == ['Pushups']
+    assert types == ['reps']
+    assert values.tolist() == [[20, 0, 30, 0, 0]]
+
+
+def test_streak_lengths():
+    active = np.array([[1, 1, 0, 1, 1, 1], [0, 0, 0, 0, 0, 1]], dtype=bool)
+    assert streak_lengths(active).tolist() == [[1, 2, 0, 1, 2, 3], [0, 0, 0, 0, 0, 1]]
@@ -0,0 +1,44 @@
+from unittest.mock import MagicMock
+
+from telebot.apihelper import ApiTelegramException
+
+from conversation import FlowMessage, cancel_keyboard
+
+
+def api_error(description):
+    return ApiTelegramException('editMessageText', None, {'error_code': 400, 'description': description})
+
+
+def test_flow_message_sends_once_then_edits():
+    bot = MagicMock()
+    bot.reply_to.return_value.message_id = 7
+    command = MagicMock()
+    command.chat.id = 1
+    flow = FlowMessage.for_message(bot, command)
+
+    flow.render("Choose an activity:", cancel_keyboard())
+    flow.render("Choose an activity:", cancel_keyboard(skip=True))
+    flow.render("How many reps?", cancel_keyboard())
+    flow.close("Added")
+
+    assert bot.reply_to.call_count == 1
+    assert bot.send_message.call_count == 0
+    assert bot.edit_message_reply_markup.call_count == 1
+    assert [call.args[:3] for call in bot.edit_message_text.call_args_list] == [
+        ("How many reps?", 1, 7), ("Added", 1, 7)]
+    assert bot.edit_message_text.call_args.kwargs['reply_markup'] is None
+
+
+def test_flow_message_ignores_unchanged_and_resends_lost_message():
+    bot = MagicMock()
+    bot.send_message.return_value.message_id = 8
+    flow = FlowMessage(bot, 1, message_id=7, text="Prompt")
+
+    bot.edit_message_reply_markup.side_effect = api_error("Bad Request: message is not modified")
+    flow.render("Prompt")
+    assert flow.message_id == 7
+
+    bot.edit_message_text.side_effect = api_error("Bad Request: message to edit not found")
+    flow.render("Next")
+    assert flow.message_id == 8
+    assert bot.send_message.call_args.args == (1, "Next")
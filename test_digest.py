@@ -0,0 +1,39 @@
+from datetime import date, timedelta
+
+from digest import current_streak, format_digest, user_digests
+
+WEEK_START = date(2024, 3, 25)
+
+
+def day(n):
+    return WEEK_START + timedelta(days=n)
+
+
+def test_user_digests_folds_one_user_at_a_time():
+    rows = iter([
+        (1, 101, 'Pushups', 'reps', day(0), 20),
+        (1, 101, 'Pushups', 'reps', day(6), 30),
+        (1, 101, 'Pushups', 'reps', day(-1), 40),
+        (1, 101, 'Plank', 'time', day(5), 90),
+        (2, 102, None, None, None, None),
+    ])
+    first, second = user_digests(rows, WEEK_START)
+
+    assert first['telegram_id'] == 101
+    assert first['workouts'] == 3
+    assert first['previous_workouts'] == 1
+    assert len(first['days']) == 3
+    assert first['activities']['Pushups'] == {'type': 'reps', 'volume': 50, 'previous_volume': 40}
+    assert current_streak(first) == 2
+    assert "Pushups: 50 reps (▲ 10 reps)" in format_digest(first)
+    assert "Plank: 00:01:30" in format_digest(first)
+
+    assert second['workouts'] == 0
+    assert "No workouts logged this week" in format_digest(second)
+
+
+def test_current_streak_spans_both_weeks():
+    rows = [(1, 101, 'Pushups', 'reps', day(n), 10) for n in range(-3, 6)]
+    (digest,) = user_digests(rows, WEEK_START)
+    # Ends the day before the week's last day
+    assert current_streak(digest) == 9
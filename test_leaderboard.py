@@ -0,0 +1,18 @@
+from datetime import date, datetime, timedelta, timezone
+
+from leaderboard import DAY_SCALE, day_number, days_active, score
+
+
+def test_day_number_uses_the_utc_day():
+    nicosia = timezone(timedelta(hours=3))
+    assert day_number(datetime(1970, 1, 2, 1, 0, tzinfo=nicosia)) == 0
+    assert day_number(date(1970, 1, 2)) == 1
+
+
+def test_more_days_outrank_a_later_last_day():
+    recent = score([day_number(date(2024, 3, 28))])
+    consistent = score([day_number(date(2024, 3, 1)), day_number(date(2024, 3, 2))])
+    assert consistent > recent
+    assert days_active(consistent) == 2
+    assert score([10, 12]) - score([10, 11]) == 1
+    assert score([10, 11]) == 2 * DAY_SCALE + 11
@@ -0,0 +1,54 @@
+from datetime import date, datetime, timedelta, timezone
+
+import metrics
+from metrics import EngagementStats, format_admin_stats, hour_key, sparkline
+
+NOW = datetime(2024, 3, 28, 15, 40, tzinfo=timezone.utc)
+
+
+class FakeDatabase:
+    def get_hourly_activity_counts(self, start_time, end_time):
+        return {NOW.replace(minute=0) - timedelta(hours=1): 4, NOW.replace(minute=0): 2}
+
+    def get_active_users_count(self, start_time, end_time):
+        return (end_time - start_time).days
+
+    def get_signups_count(self, start_time, end_time):
+        return 1
+
+    def get_total_users_count(self):
+        return 42
+
+    def get_daily_engagement(self, start_time, end_time):
+        return {date(2024, 3, 27): (30, 5, 1)}
+
+
+def test_hour_key_buckets_by_utc_hour():
+    nicosia_evening = datetime(2024, 3, 28, 1, 30, tzinfo=timezone(timedelta(hours=2)))
+    assert hour_key(nicosia_evening) == "metrics:activities:2024032723"
+
+
+def test_sparkline_scales_to_the_busiest_hour():
+    assert sparkline([0, 4, 8]) == "▁▅█"
+    assert sparkline([0, 0]) == "▁▁"
+
+
+def test_stats_fall_back_to_the_database_without_redis(monkeypatch):
+    monkeypatch.setattr(metrics, 'get_redis', lambda: None)
+    stats = EngagementStats(FakeDatabase(), now=NOW)
+
+    hourly = stats.hourly_activities()
+    assert len(hourly) == 24
+    assert hourly[-2:] == [4, 2]
+    assert stats.active_users(date(2024, 3, 22), date(2024, 3, 28)) == 7
+    assert stats.total_users() == 42
+    assert stats.history(3) == [
+        (date(2024, 3, 28), 0, 0, 0),
+        (date(2024, 3, 27), 30, 5, 1),
+        (date(2024, 3, 26), 0, 0, 0),
+    ]
+
+    text = format_admin_stats(EngagementStats(FakeDatabase(), now=NOW), 3)
+    assert "Activities: 2 this hour, 6 in the last 24 hours" in text
+    assert "Total users: 42" in text
+    assert "read from the database" in text
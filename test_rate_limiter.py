@@ -0,0 +1,39 @@
+from rate_limiter import TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_allows_burst_then_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(10, capacity=5, clock=clock, sleep=clock.sleep)
+    assert all(bucket.try_acquire() for _ in range(5))
+    assert not bucket.try_acquire()
+
+    clock.now += 0.1
+    assert bucket.try_acquire()
+    assert not bucket.try_acquire()
+
+
+def test_token_bucket_acquire_waits_for_tokens():
+    clock = FakeClock()
+    bucket = TokenBucket(10, capacity=1, clock=clock, sleep=clock.sleep)
+    for _ in range(11):
+        bucket.acquire()
+    assert abs(clock.now - 1.0) < 1e-9
+
+
+def test_token_bucket_pause():
+    clock = FakeClock()
+    bucket = TokenBucket(10, capacity=10, clock=clock, sleep=clock.sleep)
+    bucket.pause(2)
+    bucket.acquire()
+    assert abs(clock.now - 2.1) < 1e-9
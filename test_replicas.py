@@ -0,0 +1,79 @@
+import psycopg2
+
+import replicas
+from replicas import ReplicaRouter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class FakePool:
+    def __init__(self):
+        self.returned = []
+
+    def getconn(self):
+        return object()
+
+    def putconn(self, conn):
+        self.returned.append(conn)
+
+
+def make_router(monkeypatch, lags):
+    monkeypatch.setattr(replicas, 'get_redis', lambda: None)
+    clock = FakeClock()
+    router = ReplicaRouter([f"host=replica{i} dbname=hdays" for i in range(len(lags))],
+                           max_lag=5, check_interval=5, pin_seconds=3, clock=clock)
+    for replica, lag in zip(router.replicas, lags):
+        replica.pool = FakePool()
+        replica.measure_lag = lambda lag=lag: lag
+    return router, clock
+
+
+def test_without_replicas_everything_uses_the_primary(monkeypatch):
+    router, _ = make_router(monkeypatch, [])
+    assert router.getconn(user_id=1) is None
+    assert router.putconn(object()) is False
+
+
+def test_replicas_take_turns_and_connections_go_back_to_their_pool(monkeypatch):
+    router, _ = make_router(monkeypatch, [0, 1.5])
+    assert [router.choose().name for _ in range(3)] == ['replica0', 'replica1', 'replica0']
+
+    conn = router.getconn()
+    assert router.putconn(conn) is True
+    assert conn in router.replicas[1].pool.returned + router.replicas[0].pool.returned
+    assert router.putconn(object()) is False
+
+
+def test_lagging_or_broken_replicas_are_skipped_until_rechecked(monkeypatch):
+    router, clock = make_router(monkeypatch, [30, None])
+    assert router.choose() is None
+
+    def unreachable():
+        raise psycopg2.OperationalError("connection refused")
+
+    router.replicas[0].measure_lag = lambda: 0
+    router.replicas[1].measure_lag = unreachable
+    assert router.choose() is None
+    clock.now += 5
+    assert router.choose().name == 'replica0'
+    assert router.choose().name == 'replica0'
+
+
+def test_a_user_reads_from_the_primary_after_writing(monkeypatch):
+    router, clock = make_router(monkeypatch, [0])
+    # The pin outlasts the worst lag a replica in use can have
+    assert router.pin_seconds == 10
+
+    router.pin_user(7)
+    assert router.getconn(user_id=7) is None
+    assert router.getconn(user_id=8) is not None
+    assert router.getconn() is not None
+
+    clock.now += 10
+    assert router.getconn(user_id=7) is not None
@@ -0,0 +1,29 @@
+from telegram_client import LatencyStats
+
+
+def test_latency_stats_summary():
+    stats = LatencyStats(max_samples=100)
+    for ms in range(1, 101):
+        stats.record('sendMessage', ms / 1000)
+    stats.record('getUpdates', 0.5, error=True)
+
+    summary = stats.summary()
+    assert summary['sendMessage']['count'] == 100
+    assert summary['sendMessage']['errors'] == 0
+    assert round(summary['sendMessage']['p50_ms']) == 51
+    assert round(summary['sendMessage']['p95_ms']) == 96
+    assert round(summary['sendMessage']['max_ms']) == 100
+    assert summary['getUpdates']['errors'] == 1
+
+
+def test_latency_stats_keeps_recent_samples():
+    stats = LatencyStats(max_samples=10)
+    for _ in range(10):
+        stats.record('sendMessage', 1.0)
+    for _ in range(10):
+        stats.record('sendMessage', 0.01)
+
+    summary = stats.summary()['sendMessage']
+    assert summary['count'] == 20
+    assert round(summary['p95_ms']) == 10
+    assert round(summary['max_ms']) == 1000